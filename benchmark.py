@@ -0,0 +1,223 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT_DIR, "recompiler"))
+
+from recomp import EMIT_EXTENSIONS, Recompiler, default_build_dir, default_helper_lib, link_command
+
+BENCHMARK_DIR = os.path.join(ROOT_DIR, "benchmark")
+
+# "jit" runs the program through recomp.py --run instead of emitting and linking a file
+EMIT_MODES = [*EMIT_EXTENSIONS, "jit"]
+
+# lower is better for all of these, except for instructions per second
+METRICS = {
+    "recompile_s": False,
+    "link_s":      False,
+    "run_s":       False,
+    "guest_ips":   True,
+}
+
+def load_instruction_counts() -> dict:
+    # the number of executed guest instructions of a program can't be measured without slowing it down,
+    # so it's stored next to the programs instead
+    path = os.path.join(BENCHMARK_DIR, "instructions.json")
+    if not os.path.exists(path):
+        return {}
+
+    with open(path, "r") as file:
+        return json.load(file)
+
+def config_name(result:dict) -> str:
+    return f"{result['program']} {result['mode']} -O{result['opt_level']} {result['emit']}"
+
+def timed(func):
+    start = time.perf_counter()
+    value = func()
+    return time.perf_counter() - start, value
+
+def run_process(command:list[str], timeout:float|None) -> subprocess.CompletedProcess:
+    result = subprocess.run(command, capture_output=True, text=True, timeout=timeout)
+    if result.returncode != 0:
+        raise RuntimeError(f"{os.path.basename(command[0])} exited with {result.returncode}:\n{result.stderr.strip()}")
+    return result
+
+def reported_run_time(result:subprocess.CompletedProcess) -> float:
+    for line in reversed(result.stderr.splitlines()):
+        if line.startswith("run time: "):
+            return float(line.removeprefix("run time: ").removesuffix("s"))
+    raise RuntimeError(f"the run didn't report its run time:\n{result.stderr.strip()}")
+
+def benchmark_config(program:str, headless:bool, opt_level:int, emit:str, args, instruction_counts:dict) -> dict:
+    name = os.path.basename(program)
+    mode = "headless" if headless else "windowed"
+
+    result = {
+        "program":     name,
+        "mode":        mode,
+        "opt_level":   opt_level,
+        "emit":        emit,
+        "recompile_s": None,
+        "link_s":      None,
+        "run_s":       None,
+        "guest_instructions": instruction_counts.get(name),
+        "guest_ips":   None,
+        "error":       None,
+    }
+
+    stem = f"{os.path.splitext(name)[0]}_{mode}_O{opt_level}"
+    out_file = None if emit == "jit" else os.path.join(args.out_dir, stem + EMIT_EXTENSIONS[emit])
+    exe_file = os.path.join(args.out_dir, stem + (".exe" if sys.platform == "win32" else ""))
+
+    options = {
+        "headless":  headless,
+        "opt_level": opt_level,
+        "emit":      "ll" if emit == "jit" else emit,
+    }
+
+    try:
+        # the jit recompiles the program in the process that runs it,
+        # so only the recompilation itself (without writing a file) is timed here
+        result["recompile_s"] = min(
+            timed(lambda: Recompiler(program, out_file, **options).recompile())[0]
+            for _ in range(args.repeat)
+        )
+
+        if emit == "jit":
+            # the process also imports llvmlite, recompiles and jit compiles the program,
+            # so --time reports the time spent in the program itself
+            command = [
+                sys.executable, os.path.join(ROOT_DIR, "recompiler", "recomp.py"), program,
+                "--run", "--time", "--helper-lib", args.helper_lib, "--opt-level", str(opt_level),
+            ]
+            if headless:
+                command.append("--headless")
+
+            result["run_s"] = min(
+                reported_run_time(run_process(command, args.timeout))
+                for _ in range(args.repeat)
+            )
+        else:
+            # zig cc compiles ll and bc inputs again, -O0 keeps it from optimizing them beyond opt_level
+            result["link_s"], _ = timed(lambda: run_process(link_command(out_file, exe_file, args.lib_dir, "-O0"), None))
+
+            result["run_s"] = min(
+                timed(lambda: run_process([exe_file], args.timeout))[0]
+                for _ in range(args.repeat)
+            )
+    except subprocess.TimeoutExpired:
+        result["error"] = f"run timed out after {args.timeout}s"
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+
+    if result["run_s"] and result["guest_instructions"] is not None:
+        result["guest_ips"] = result["guest_instructions"] / result["run_s"]
+
+    return result
+
+def compare(results:list[dict], baseline:list[dict], threshold:float) -> list[dict]:
+    baseline_results = {config_name(result): result for result in baseline}
+
+    regressions = []
+    for result in results:
+        old = baseline_results.get(config_name(result))
+        if old is None:
+            continue
+
+        result["baseline"] = {}
+        for metric, higher_is_better in METRICS.items():
+            if result[metric] is None or not old.get(metric):
+                continue
+
+            ratio = result[metric] / old[metric]
+            result["baseline"][metric] = ratio
+
+            if (ratio < 1 - threshold) if higher_is_better else (ratio > 1 + threshold):
+                regressions.append({"config": config_name(result), "metric": metric, "ratio": ratio})
+
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the recompiler on every program in benchmark/.")
+
+    parser.add_argument("--programs", type=str, nargs="+", default=None, help="Programs to benchmark (default: every .mc file in benchmark/).")
+    parser.add_argument("--modes", type=str, nargs="+", default=["headless", "windowed"], choices=["headless", "windowed"], help="Run the programs headless and/or with a window.")
+    parser.add_argument("--opt-levels", type=int, nargs="+", default=list(range(4)), choices=range(4), help="LLVM optimization levels to benchmark.")
+    parser.add_argument("--emit", type=str, nargs="+", default=EMIT_MODES, choices=EMIT_MODES, help="Emission modes to benchmark, jit runs the program through recomp.py --run.")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of times every recompilation and run is repeated, the fastest one counts.")
+    parser.add_argument("--timeout", type=float, default=None, help="Maximum duration of a single run in seconds.")
+
+    parser.add_argument("--out-dir", type=str, default=os.path.join(default_build_dir(), "benchmark"), help="Directory for the recompiled and linked programs.")
+    parser.add_argument("--lib-dir", type=str, default=default_build_dir(), help="Directory containing the helper function and raylib libraries.")
+    parser.add_argument("--helper-lib", type=str, default=default_helper_lib(), help="Path to the shared helper function library used by the jit.")
+
+    parser.add_argument("--output", type=str, default=os.path.join(default_build_dir(), "benchmark", "results.json"), help="Path of the JSON results file.")
+    parser.add_argument("--baseline", type=str, default=os.path.join(BENCHMARK_DIR, "baseline.json"), help="Results file to compare against, if it exists.")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative slowdown compared to the baseline that counts as a regression.")
+    parser.add_argument("--save-baseline", action="store_true", help="Also store the results as the new baseline.")
+    args = parser.parse_args()
+
+    programs = args.programs or sorted(
+        os.path.join(BENCHMARK_DIR, name)
+        for name in os.listdir(BENCHMARK_DIR)
+        if name.endswith(".mc")
+    )
+    instruction_counts = load_instruction_counts()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    results = []
+    for program in programs:
+        for mode in args.modes:
+            for opt_level in args.opt_levels:
+                for emit in args.emit:
+                    result = benchmark_config(program, mode == "headless", opt_level, emit, args, instruction_counts)
+                    results.append(result)
+
+                    if result["error"] is not None:
+                        print(f"{config_name(result)}: {result['error']}", file=sys.stderr)
+                        continue
+
+                    print(
+                        f"{config_name(result)}: "
+                        f"recompile {result['recompile_s']:.3f}s, "
+                        + (f"link {result['link_s']:.3f}s, " if result["link_s"] is not None else "")
+                        + f"run {result['run_s']:.3f}s"
+                        + (f", {result['guest_ips'] / 1e6:.1f}M guest instructions/s" if result["guest_ips"] is not None else ""),
+                        file=sys.stderr,
+                    )
+
+    regressions = []
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as file:
+            regressions = compare(results, json.load(file)["results"], args.threshold)
+
+    report = {
+        "machine": {
+            "platform":  platform.platform(),
+            "processor": platform.processor(),
+            "python":    platform.python_version(),
+        },
+        "results":     results,
+        "regressions": regressions,
+    }
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=4)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(report, file, indent=4)
+
+    for regression in regressions:
+        print(f"REGRESSION {regression['config']}: {regression['metric']} is {regression['ratio']:.2f}x the baseline", file=sys.stderr)
+
+    failed = any(result["error"] is not None for result in results)
+    sys.exit(1 if regressions or failed else 0)
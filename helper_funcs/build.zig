@@ -31,6 +31,18 @@ pub fn build(b: *std.Build) void {
         .optimize = optimize,
     });
 
+    // shared build of the same module, loaded by the recompiler's in-process jit (--run)
+    const shared_lib = b.addSharedLibrary(.{
+        .name = "helper_funcs",
+        .root_module = lib_mod,
+        .optimize = optimize,
+    });
+
     b.installArtifact(raylib_artifact);
     b.installArtifact(lib);
+    b.installArtifact(shared_lib);
+
+    // llvm bitcode of the helper functions, linked with recompiled programs by zig cc -flto (recomp.py --batch --link --lto)
+    const bitcode = b.addInstallLibFile(lib.getEmittedLlvmBc(), "helper_funcs.bc");
+    b.getInstallStep().dependOn(&bitcode.step);
 }
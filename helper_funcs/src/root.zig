@@ -1,4 +1,5 @@
 const std = @import("std");
+const builtin = @import("builtin");
 const rl = @import("raylib");
 
 const SCALE = 16;
@@ -7,6 +8,40 @@ const TARGET_FPS = -1;
 var screen: rl.Image = undefined;
 var texture: rl.Texture2D = undefined;
 
+// the screen as a packed bitmap, bit x of row y is the pixel at (x, y)
+// the recompiled code draws into its own copy and hands it over with present_framebuffer(_headless)
+var bitmap: [32]u32 = .{0} ** 32;
+
+// the bitmap as of the last update_screen, and the frame that is currently shown in the window
+var frame: [32]u32 = .{0} ** 32;
+var frame_pending: bool = false;
+var presented: ?[32]u32 = null;
+
+// update_screen calls less than present_interval seconds after the last presented frame only record the frame,
+// so bursts of them (eg. one per drawn pixel) don't wait for the window, 0 presents every changed frame
+var present_interval: f64 = 0;
+var last_present: f64 = -std.math.inf(f64);
+
+// render thread mode: the window belongs to a thread of its own that presents the newest frame at its own pace,
+// the program hands frames over through a lock-free triple buffer and never waits for the display
+var render_thread: ?std.Thread = null;
+
+// the slot the program writes the next frame to, the slot the render thread shows,
+// and the newest finished frame in between, whose index frame_exchange holds (with FRAME_READY until the render thread took it)
+var frame_slots: [3][32]u32 = std.mem.zeroes([3][32]u32);
+var frame_exchange: u8 = 1;
+var write_slot: u8 = 0;
+var read_slot: u8 = 2;
+const FRAME_READY: u8 = 0b100;
+
+// written by the render thread, read by the program
+var controller_state: u8 = 0;
+var close_requested: bool = false;
+
+// written by the program, read by the render thread
+var stop_rendering: bool = false;
+var target_fps: i32 = -1;
+
 var char_buffer: [32]u8 = .{0} ** 32;
 var char_buffer_index: usize = 0;
 var char_mapping: [256]u8 = undefined;
@@ -16,11 +51,19 @@ var signedness: bool = false;
 
 var writer: std.fs.File.Writer = undefined;
 
+// block and edge execution counts of a --profile build, written out when the program exits
+var profile_path: ?[*:0]const u8 = null;
+var profile_keys: [*]const [*:0]const u8 = undefined;
+var profile_counts: [*]const u64 = undefined;
+var profile_len: usize = 0;
+
 pub export fn init_headless() void {
     writer = std.io.getStdOut().writer();
 }
 
 pub export fn deinit_headless() void {
+    write_profile();
+    finish_input_record();
     write_num();
     std.process.exit(0);
 }
@@ -37,59 +80,346 @@ pub export fn init() void {
     screen = rl.genImageColor(32, 32, rl.Color.black);
     texture = rl.loadTextureFromImage(screen) catch return;
 
+    // present at most at the refresh rate of the display by default
+    set_present_rate(rl.getMonitorRefreshRate(rl.getCurrentMonitor()));
+
     rl.beginDrawing();
-    clear_screen();
+    bitmap = .{0} ** 32;
 
     update_screen();
 }
 
+pub export fn init_render_thread() void {
+    writer = std.io.getStdOut().writer();
+
+    render_thread = std.Thread.spawn(.{}, render_loop, .{}) catch {
+        // without a thread the window is driven by the program itself
+        init();
+        return;
+    };
+}
+
 pub export fn deinit() void {
     writer.print("DEINITIALIZING\n", .{}) catch return;
-    screen.unload();
-    texture.unload();
 
-    rl.endDrawing();
-    rl.closeWindow();
+    if (render_thread) |thread| {
+        @atomicStore(bool, &stop_rendering, true, .release);
+        thread.join();
+    } else {
+        screen.unload();
+        texture.unload();
 
+        rl.endDrawing();
+        rl.closeWindow();
+    }
+
+    write_profile();
+    finish_input_record();
     write_num();
 
     std.process.exit(0);
 }
 
+pub export fn set_profile(path: [*:0]const u8, keys: [*]const [*:0]const u8, counts: [*]const u64, len: usize) void {
+    profile_path = path;
+    profile_keys = keys;
+    profile_counts = counts;
+    profile_len = len;
+}
+
+fn write_profile() void {
+    const path = profile_path orelse return;
+
+    const file = std.fs.cwd().createFileZ(path, .{}) catch return;
+    defer file.close();
+
+    var buffered = std.io.bufferedWriter(file.writer());
+    const profile_writer = buffered.writer();
+
+    for (0..profile_len) |i| {
+        profile_writer.print("{s} {}\n", .{ profile_keys[i], profile_counts[i] }) catch return;
+    }
+    buffered.flush() catch return;
+}
+
+// headless framebuffer: every update_screen appends the bitmap to a ring file, laid out as
+//   header (FRAMEBUFFER_HEADER_SIZE bytes): magic, version, slot count, frame size, number of frames written so far
+//   slot_count frames of FRAME_SIZE bytes, frame n is in slot n % slot_count
+// all little endian, the frame count is only increased after its frame has been written
+const FramebufferHeader = extern struct {
+    magic: [4]u8 = "BPFB".*,
+    version: u32 = 1,
+    slot_count: u32,
+    frame_size: u32 = FRAME_SIZE,
+    frame_count: u64 = 0,
+};
+
+const FRAMEBUFFER_HEADER_SIZE = 64;
+const FRAME_SIZE = @sizeOf(@TypeOf(bitmap));
+
+var framebuffer_file: ?std.fs.File = null;
+var framebuffer_map: ?[]align(std.heap.page_size_min) u8 = null;
+var framebuffer_slots: u32 = 0;
+var framebuffer_frames: u64 = 0;
+
+pub export fn init_headless_framebuffer(path: [*:0]const u8, slots: u32) void {
+    const file = std.fs.cwd().createFileZ(path, .{ .read = true, .truncate = true }) catch return;
+    const size = FRAMEBUFFER_HEADER_SIZE + @as(usize, slots) * FRAME_SIZE;
+    file.setEndPos(size) catch return;
+
+    framebuffer_file = file;
+    framebuffer_slots = slots;
+
+    // readers map the same file, windows gets the frames through plain positional writes instead
+    if (builtin.os.tag != .windows) {
+        framebuffer_map = std.posix.mmap(
+            null,
+            size,
+            std.posix.PROT.READ | std.posix.PROT.WRITE,
+            .{ .TYPE = .SHARED },
+            file.handle,
+            0,
+        ) catch null;
+    }
+
+    const header = FramebufferHeader{ .slot_count = slots };
+    write_framebuffer(0, std.mem.asBytes(&header));
+}
+
+fn write_framebuffer(offset: usize, bytes: []const u8) void {
+    if (framebuffer_map) |map| {
+        @memcpy(map[offset..][0..bytes.len], bytes);
+    } else if (framebuffer_file) |file| {
+        file.pwriteAll(bytes, offset) catch return;
+    }
+}
+
+fn update_screen_headless() void {
+    if (framebuffer_slots == 0) {
+        return;
+    }
+
+    const slot: usize = @intCast(framebuffer_frames % framebuffer_slots);
+    write_framebuffer(FRAMEBUFFER_HEADER_SIZE + slot * FRAME_SIZE, std.mem.asBytes(&bitmap));
+    framebuffer_frames += 1;
+
+    const count_offset = @offsetOf(FramebufferHeader, "frame_count");
+    if (framebuffer_map) |map| {
+        // readers poll the count, so it must not become visible before the frame itself
+        @atomicStore(u64, @as(*u64, @ptrCast(@alignCast(&map[count_offset]))), framebuffer_frames, .release);
+    } else {
+        write_framebuffer(count_offset, std.mem.asBytes(&framebuffer_frames));
+    }
+}
+
+// controller input trace: one byte per frame, the controller state a windowed run read last during it,
+// a frame ends at every present (port 245) and the file holds nothing else, so traces are easy to write by hand
+var input_record_file: ?std.fs.File = null;
+var input_replay: ?[]const u8 = null;
+var input_frame: usize = 0;
+var input_state: u8 = 0;
+
+pub export fn init_input_record(path: [*:0]const u8) void {
+    input_record_file = std.fs.cwd().createFileZ(path, .{}) catch return;
+}
+
+pub export fn init_input_replay(path: [*:0]const u8) void {
+    const file = std.fs.cwd().openFileZ(path, .{}) catch return;
+    defer file.close();
+
+    const size: usize = @intCast(file.getEndPos() catch return);
+    if (size == 0) {
+        input_replay = &[_]u8{};
+        return;
+    }
+
+    // the trace is mapped instead of read up front, windows (or a failed mapping) reads it into memory instead
+    if (builtin.os.tag != .windows) {
+        input_replay = std.posix.mmap(
+            null,
+            size,
+            std.posix.PROT.READ,
+            .{ .TYPE = .PRIVATE },
+            file.handle,
+            0,
+        ) catch null;
+    }
+    if (input_replay == null) {
+        input_replay = file.readToEndAlloc(std.heap.page_allocator, size) catch return;
+    }
+}
+
+pub export fn next_input_frame() void {
+    if (input_record_file) |file| {
+        file.writeAll(&[_]u8{input_state}) catch {};
+    }
+    input_frame += 1;
+}
+
+fn finish_input_record() void {
+    // the frame the program exits in is recorded too
+    const file = input_record_file orelse return;
+    file.writeAll(&[_]u8{input_state}) catch {};
+    file.close();
+    input_record_file = null;
+}
+
+fn replayed_controller(trace: []const u8) u8 {
+    // every button is released once the trace has ended
+    return if (input_frame < trace.len) trace[input_frame] else 0;
+}
+
+pub export fn get_controller_headless() u8 {
+    const trace = input_replay orelse return 0;
+    return replayed_controller(trace);
+}
+
 pub export fn raise_error() void {
     writer.print("CRITICAL ERROR\n", .{}) catch return;
     deinit_headless();
 }
 
-pub export fn draw_pixel(x: u8, y: u8) void {
-    screen.drawPixel(x, 31 - y, rl.Color.white);
+// the recompiled code keeps the screen bitmap itself and only hands it over to present it
+pub export fn present_framebuffer(framebuffer: *const [32]u32) void {
+    bitmap = framebuffer.*;
+    update_screen();
 }
 
-pub export fn clear_pixel(x: u8, y: u8) void {
-    screen.drawPixel(x, 31 - y, rl.Color.black);
+pub export fn present_framebuffer_headless(framebuffer: *const [32]u32) void {
+    bitmap = framebuffer.*;
+    update_screen_headless();
 }
 
-pub export fn get_pixel(x: u8, y: u8) u8 {
-    return screen.getColor(x, 31 - y).r & 1;
+pub export fn set_present_rate(rate: i32) void {
+    // frames per second, 0 (or less) presents every changed frame
+    present_interval = if (rate > 0) 1.0 / @as(f64, @floatFromInt(rate)) else 0;
+    @atomicStore(i32, &target_fps, @max(rate, 0), .monotonic);
 }
 
-pub export fn clear_screen() void {
-    screen.clearBackground(rl.Color.black);
+fn update_screen() void {
+    if (render_thread != null) {
+        publish_frame();
+        exit_if_close_requested();
+        return;
+    }
+
+    frame = bitmap;
+    frame_pending = true;
+
+    present_if_due();
 }
 
-pub export fn update_screen() void {
-    // this is probably the most inneficient way to do this
-    rl.updateTexture(texture, screen.data);
+pub export fn idle() void {
+    // called on every iteration of a jump to itself, the program won't update the screen anymore,
+    // so a frame held back by the present rate is shown right away
+    if (render_thread != null) {
+        exit_if_close_requested();
+    } else {
+        last_present = -std.math.inf(f64);
+        present_if_due();
+    }
+
+    std.time.sleep(std.time.ns_per_ms);
+}
+
+fn present_if_due() void {
+    const now = rl.getTime();
+    if (now - last_present < present_interval) {
+        return;
+    }
+    last_present = now;
+
+    // frames that look the same as the one in the window aren't uploaded and drawn again
+    if (frame_pending and (presented == null or !std.mem.eql(u32, &frame, &presented.?))) {
+        present();
+    } else {
+        // nothing new to draw, but the window still has to stay responsive
+        rl.pollInputEvents();
+    }
+    frame_pending = false;
+
+    if (rl.windowShouldClose()) {
+        deinit();
+        std.process.exit(0);
+    }
+}
+
+fn present() void {
+    upload_frame(&frame);
+
     rl.drawTextureEx(texture, .{ .x = 0, .y = 0 }, 0.0, SCALE, rl.Color.white);
     rl.endDrawing();
     rl.beginDrawing();
 
-    if (rl.windowShouldClose()) {
+    presented = frame;
+}
+
+fn upload_frame(rows: *const [32]u32) void {
+    const pixels: [*]rl.Color = @ptrCast(@alignCast(screen.data));
+    for (0..32) |y| {
+        for (0..32) |x| {
+            const on = ((rows[y] >> @intCast(x)) & 1) != 0;
+            pixels[(31 - y) * 32 + x] = if (on) rl.Color.white else rl.Color.black;
+        }
+    }
+
+    rl.updateTexture(texture, screen.data);
+}
+
+fn publish_frame() void {
+    // the finished frame is swapped into the middle slot, and the program continues with whatever frame was there before
+    frame_slots[write_slot] = bitmap;
+    write_slot = @atomicRmw(u8, &frame_exchange, .Xchg, write_slot | FRAME_READY, .acq_rel) & ~FRAME_READY;
+}
+
+fn exit_if_close_requested() void {
+    if (@atomicLoad(bool, &close_requested, .acquire)) {
         deinit();
-        std.process.exit(0);
     }
 }
 
+fn render_loop() void {
+    rl.initWindow(32 * SCALE, 32 * SCALE, "BatPU2 Recomp");
+
+    screen = rl.genImageColor(32, 32, rl.Color.black);
+    texture = rl.loadTextureFromImage(screen) catch {
+        rl.closeWindow();
+        @atomicStore(bool, &close_requested, true, .release);
+        return;
+    };
+
+    // -1 is the refresh rate of the display and 0 unlimited, like --present-rate
+    var fps: i32 = -2;
+
+    while (!@atomicLoad(bool, &stop_rendering, .acquire)) {
+        const wanted_fps = @atomicLoad(i32, &target_fps, .monotonic);
+        if (wanted_fps != fps) {
+            fps = wanted_fps;
+            rl.setTargetFPS(if (fps < 0) rl.getMonitorRefreshRate(rl.getCurrentMonitor()) else fps);
+        }
+
+        // only the newest frame is shown, frames the program finished in between are skipped
+        if ((@atomicLoad(u8, &frame_exchange, .acquire) & FRAME_READY) != 0) {
+            read_slot = @atomicRmw(u8, &frame_exchange, .Xchg, read_slot, .acq_rel) & ~FRAME_READY;
+            upload_frame(&frame_slots[read_slot]);
+        }
+
+        rl.beginDrawing();
+        rl.drawTextureEx(texture, .{ .x = 0, .y = 0 }, 0.0, SCALE, rl.Color.white);
+        // waits for the target fps and polls the input events
+        rl.endDrawing();
+
+        @atomicStore(u8, &controller_state, read_controller(), .release);
+        if (rl.windowShouldClose()) {
+            @atomicStore(bool, &close_requested, true, .release);
+        }
+    }
+
+    screen.unload();
+    texture.unload();
+    rl.closeWindow();
+}
+
 fn map_char(c: u8) u8 {
     if (c == 0) {
         return ' ';
@@ -147,6 +477,17 @@ pub export fn write_num() void {
 }
 
 pub export fn get_controller() u8 {
+    // the window is kept responsive while a trace is replayed, but the keyboard is ignored
+    const state = poll_controller();
+    if (input_replay) |trace| {
+        return replayed_controller(trace);
+    }
+
+    input_state = state;
+    return state;
+}
+
+fn poll_controller() u8 {
     // START  : enter
     // SELECT : space
     // A      : w
@@ -156,10 +497,24 @@ pub export fn get_controller() u8 {
     // DOWN   : down arrow
     // LEFT   : left arrow
 
-    var controller: u8 = 0;
+    if (render_thread != null) {
+        exit_if_close_requested();
+        return @atomicLoad(u8, &controller_state, .acquire);
+    }
+
+    // a frame skipped by the present rate would otherwise stay hidden while the program waits for input
+    if (frame_pending) {
+        present_if_due();
+    }
 
     rl.pollInputEvents();
 
+    return read_controller();
+}
+
+fn read_controller() u8 {
+    var controller: u8 = 0;
+
     // start
     if (rl.isKeyDown(rl.KeyboardKey.enter)) {
         controller |= 0b10000000;
@@ -206,5 +561,6 @@ pub export fn get_controller() u8 {
 }
 
 pub export fn get_random_num() u8 {
-    return @intCast(rl.getRandomValue(0, 256));
+    // both bounds are inclusive
+    return @intCast(rl.getRandomValue(0, 255));
 }
@@ -0,0 +1,247 @@
+import hashlib
+import importlib.metadata
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+
+# this module must not import llvmlite (or recomp, which does) unless a recompilation is actually needed,
+# a cache hit should only cost hashing the inputs and copying the results
+
+CACHE_VERSION = 1
+
+class LinkError(RuntimeError):
+    # the program recompiled, but couldn't be linked into an executable
+    pass
+
+def default_cache_dir() -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "build", "cache")
+
+def hash_file(path:str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# hash of the recompiler's sources, computed on first use
+source_hash = None
+
+def hash_sources() -> str:
+    # every module of the recompiler can change what it generates (the decoder lives in isa.py, for example),
+    # they are hashed once per process, as that's the code the process runs anyway
+    global source_hash
+    if source_hash is None:
+        source_dir = os.path.dirname(os.path.abspath(__file__))
+        digest = hashlib.sha256()
+        for name in sorted(os.listdir(source_dir)):
+            if name.endswith(".py"):
+                digest.update(f"{name}={hash_file(os.path.join(source_dir, name))}\n".encode())
+        source_hash = digest.hexdigest()
+    return source_hash
+
+class BuildCache:
+    def __init__(self, cache_dir:str, max_size:int=512 * 1024 * 1024) -> None:
+        self.cache_dir = cache_dir
+        self.max_size  = max_size
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, in_file:str, options:dict, libs:list[str]) -> str:
+        digest = hashlib.sha256()
+
+        def add(name, value):
+            digest.update(f"{name}={value}\n".encode())
+
+        add("version", CACHE_VERSION)
+        add("program", hash_file(in_file))
+        self.add_environment(add, options)
+
+        for lib in libs:
+            add(os.path.basename(lib), hash_file(lib) if os.path.exists(lib) else None)
+
+        return digest.hexdigest()
+
+    def region_key(self, facts:dict, options:dict) -> str:
+        # key of a single translation context of an incremental recompilation,
+        # facts holds its instructions and everything the whole program analyses found out about them
+        digest = hashlib.sha256()
+
+        def add(name, value):
+            digest.update(f"{name}={value}\n".encode())
+
+        add("version", CACHE_VERSION)
+        add("region", json.dumps(facts, sort_keys=True))
+        self.add_environment(add, options)
+
+        return digest.hexdigest()
+
+    @staticmethod
+    def add_environment(add, options:dict) -> None:
+        add("options", json.dumps(options, sort_keys=True))
+
+        # the recompiler and llvm themselves are inputs as well
+        add("recompiler", hash_sources())
+        add("llvmlite", importlib.metadata.version("llvmlite"))
+        add("platform", platform.platform())
+
+        # "host" means something different on every machine
+        if "host" in (options.get("cpu"), options.get("features")):
+            add("host", platform.node())
+
+    def entry_dir(self, key:str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key:str, name:str) -> str|None:
+        path = os.path.join(self.entry_dir(key), name)
+        try:
+            # entries are evicted least recently used first
+            os.utime(self.entry_dir(key))
+        except OSError:
+            return None
+
+        if not os.path.exists(path):
+            return None
+        return path
+
+    def fetch(self, key:str, name:str, out_file:str) -> bool:
+        path = self.get(key, name)
+        if path is None:
+            return False
+
+        shutil.copy2(path, out_file)
+        return True
+
+    def put(self, key:str, name:str, src_file:str) -> None:
+        entry_dir = self.entry_dir(key)
+        os.makedirs(entry_dir, exist_ok=True)
+
+        # write to a temporary file first, so concurrent readers never see a partial artifact
+        fd, tmp_path = tempfile.mkstemp(dir=entry_dir)
+        os.close(fd)
+        shutil.copy2(src_file, tmp_path)
+        os.replace(tmp_path, os.path.join(entry_dir, name))
+
+    def put_data(self, key:str, name:str, data:bytes) -> None:
+        entry_dir = self.entry_dir(key)
+        os.makedirs(entry_dir, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=entry_dir)
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, os.path.join(entry_dir, name))
+
+    def evict(self) -> None:
+        # walks the whole cache, so it's called once a build has put all of its entries instead of after every put
+        entries = []
+        total_size = 0
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+
+            for key in os.listdir(prefix_dir):
+                entry_dir = os.path.join(prefix_dir, key)
+                try:
+                    size = sum(
+                        os.path.getsize(os.path.join(entry_dir, name))
+                        for name in os.listdir(entry_dir)
+                    )
+                    entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+                except OSError:
+                    # removed by another process in the meantime
+                    continue
+
+                total_size += size
+
+        entries.sort()
+        for _, size, entry_dir in entries:
+            if total_size <= self.max_size:
+                break
+
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+
+def cached_recompile(cache:BuildCache, in_file:str, out_file:str, options:dict,
+                     exe_file:str|None=None, lib_dir:str|None=None, lto:bool=False) -> bool:
+    # returns whether everything came from the cache
+    from_cache = True
+
+    libs = []
+    if lib_dir is not None and os.path.isdir(lib_dir):
+        libs = [
+            os.path.join(lib_dir, name)
+            for name in sorted(os.listdir(lib_dir))
+            if "helper_funcs" in name or "raylib" in name
+        ]
+
+    # the executable also depends on how it was linked
+    key = cache.key(in_file, {**options, "lto": lto}, libs)
+    out_name = "out" + os.path.splitext(out_file)[1]
+
+    if not cache.fetch(key, out_name, out_file):
+        from_cache = False
+
+        import recomp
+        recomp.Recompiler(in_file, out_file, **options).recompile()
+        cache.put(key, out_name, out_file)
+
+    if exe_file is not None and not cache.fetch(key, "exe", exe_file):
+        from_cache = False
+
+        import recomp
+        recomp.link_program(out_file, exe_file, lib_dir, lto)
+
+        cache.put(key, "exe", exe_file)
+
+    if not from_cache:
+        cache.evict()
+
+    return from_cache
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Recompiles a BatPU-2 machine code file through a content addressed build cache.")
+    parser.add_argument("in_file", type=str, help="Path to the input .mc file.")
+    parser.add_argument("out_file", type=str, help="Path to the output file (LLVM IR unless --emit says otherwise).")
+
+    parser.add_argument("--headless", action="store_true", help="Run in headless mode without initializing the graphics library.")
+    parser.add_argument("--opt-level", type=int, default=0, choices=range(4), help="LLVM optimization level applied before the module is emitted.")
+    parser.add_argument("--emit", type=str, default="ll", choices=["ll", "bc", "obj", "asm"], help="Kind of output file: textual IR, bitcode, a native object file or native assembly.")
+    parser.add_argument("--cpu", type=str, default="host", help="Target CPU for native code generation.")
+    parser.add_argument("--features", type=str, default="host", help="Target CPU features for native code generation (eg. +avx2,-sse4a).")
+    parser.add_argument("--render-thread", action="store_true", help="Present the window from a separate thread, so the program doesn't wait for the display.")
+    parser.add_argument("--seed", type=int, default=None, help="Generate the random numbers inline with a xorshift32 generator seeded with SEED, instead of calling raylib.")
+
+    parser.add_argument("--link", type=str, metavar="EXE", help="Also link the program into the executable EXE (cached as well).")
+    parser.add_argument("--lto", action="store_true", help="Link against the bitcode of the helper functions with zig cc -flto (requires --emit bc or ll).")
+    parser.add_argument("--lib-dir", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "build"), help="Directory containing the helper function and raylib libraries.")
+    parser.add_argument("--cache-dir", type=str, default=default_cache_dir(), help="Directory of the build cache.")
+    parser.add_argument("--max-size", type=int, default=512, help="Maximum size of the build cache in MiB, least recently used entries are evicted first.")
+    args = parser.parse_args()
+
+    if args.lto and (args.link is None or args.emit not in ("bc", "ll")):
+        parser.error("--lto requires --link and --emit bc or ll")
+
+    from_cache = cached_recompile(
+        BuildCache(args.cache_dir, args.max_size * 1024 * 1024),
+        args.in_file,
+        args.out_file,
+        {
+            "headless":  args.headless,
+            "opt_level": args.opt_level,
+            "emit":      args.emit,
+            "cpu":       args.cpu,
+            "features":  args.features,
+            "render_thread": args.render_thread,
+            "seed":          args.seed,
+        },
+        args.link,
+        args.lib_dir,
+        args.lto,
+    )
+
+    print("cache hit" if from_cache else "cache miss", file=sys.stderr)
@@ -0,0 +1,79 @@
+import json
+import os
+import socket
+import sys
+
+# client for a recompiler started with recomp.py --serve,
+# like cache.py this must not import llvmlite (or recomp), skipping that import is the whole point of the server
+
+def default_socket_path() -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "build", "recomp.sock")
+
+class RecompilerClient:
+    def __init__(self, socket_path:str|None=None) -> None:
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(socket_path if socket_path is not None else default_socket_path())
+        self.file = self.socket.makefile("rwb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.file.close()
+        self.socket.close()
+
+    def recompile(self, in_file:str, out_file:str, **options) -> None:
+        # takes the same options as the Recompiler, the server resolves paths relative to its own working directory,
+        # so the input and output files are sent as absolute paths
+        request = {
+            "in_file":  os.path.abspath(in_file),
+            "out_file": os.path.abspath(out_file),
+            "options":  options,
+        }
+        self.file.write(json.dumps(request).encode() + b"\n")
+        self.file.flush()
+
+        line = self.file.readline()
+        if not line:
+            raise RuntimeError("the recompiler server closed the connection")
+
+        response = json.loads(line)
+        if not response["ok"]:
+            raise RuntimeError(response["error"])
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Recompiles a BatPU-2 machine code file through a running recomp.py --serve.")
+    parser.add_argument("in_file", type=str, help="Path to the input .mc file.")
+    parser.add_argument("out_file", type=str, help="Path to the output file (LLVM IR unless --emit says otherwise).")
+
+    parser.add_argument("--headless", action="store_true", help="Run in headless mode without initializing the graphics library.")
+    parser.add_argument("--opt-level", type=int, default=0, choices=range(4), help="LLVM optimization level applied before the module is emitted.")
+    parser.add_argument("--emit", type=str, default="ll", choices=["ll", "bc", "obj", "asm"], help="Kind of output file: textual IR, bitcode, a native object file or native assembly.")
+    parser.add_argument("--cpu", type=str, default="host", help="Target CPU for native code generation.")
+    parser.add_argument("--features", type=str, default="host", help="Target CPU features for native code generation (eg. +avx2,-sse4a).")
+    parser.add_argument("--render-thread", action="store_true", help="Present the window from a separate thread, so the program doesn't wait for the display.")
+    parser.add_argument("--seed", type=int, default=None, help="Generate the random numbers inline with a xorshift32 generator seeded with SEED, instead of calling raylib.")
+    parser.add_argument("--socket", type=str, default=default_socket_path(), help="Unix socket the server listens on.")
+    args = parser.parse_args()
+
+    options = {
+        "headless":  args.headless,
+        "opt_level": args.opt_level,
+        "emit":      args.emit,
+        "cpu":       args.cpu,
+        "features":  args.features,
+        "render_thread": args.render_thread,
+        "seed":          args.seed,
+    }
+
+    try:
+        with RecompilerClient(args.socket) as client:
+            client.recompile(args.in_file, args.out_file, **options)
+    except (OSError, RuntimeError) as e:
+        print(f"recompilation failed: {e}", file=sys.stderr)
+        sys.exit(1)
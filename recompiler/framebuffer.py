@@ -0,0 +1,118 @@
+import mmap
+import struct
+
+import numpy as np
+
+# reader for the ring file a headless run with --framebuffer appends its frames to,
+# the layout is defined next to update_screen_headless in helper_funcs/src/root.zig
+
+MAGIC = b"BPFB"
+VERSION = 1
+
+HEADER = struct.Struct("<4sIIIQ") # magic, version, slot count, frame size, frame count
+HEADER_SIZE = 64
+FRAME_COUNT_OFFSET = 16
+
+class FramebufferRing:
+    def __init__(self, path:str) -> None:
+        self.path = path
+
+        with open(path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.slot_count, frame_size, _ = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a framebuffer ring file")
+        if version != VERSION:
+            raise ValueError(f"{path} has framebuffer format version {version}, expected {VERSION}")
+        if frame_size != 32 * 4:
+            raise ValueError(f"{path} has frames of {frame_size} bytes, expected {32 * 4}")
+
+        # views straight into the mapped file, nothing is copied
+        self.slots = np.frombuffer(self.map, dtype="<u4", count=self.slot_count * 32, offset=HEADER_SIZE).reshape(self.slot_count, 32)
+        self.count = np.frombuffer(self.map, dtype="<u8", count=1, offset=FRAME_COUNT_OFFSET)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        # the mapping can only be closed once no views into it are left
+        del self.slots
+        del self.count
+        self.map.close()
+
+    @property
+    def frame_count(self) -> int:
+        # total number of frames written so far, the ring only holds the last slot_count of them
+        return int(self.count[0])
+
+    def oldest(self, count:int) -> int:
+        # frame count - slot_count shares its slot with the frame the writer writes next, so it can't be read safely
+        return max(0, count - self.slot_count + 1)
+
+    def frame(self, idx:int) -> np.ndarray:
+        # a copy of the packed rows of frame idx, bit x of row y is the pixel at (x, y)
+        count = self.frame_count
+        if idx < 0:
+            idx += count
+        if not self.oldest(count) <= idx < count:
+            raise IndexError(f"frame {idx} is not in the ring (frames {self.oldest(count)} to {count - 1} are)")
+
+        rows = self.slots[idx % self.slot_count].copy()
+
+        # the writer may have wrapped around to the slot while it was copied
+        if idx < self.oldest(self.frame_count):
+            raise IndexError(f"frame {idx} was overwritten while it was read")
+        return rows
+
+    def latest(self) -> np.ndarray|None:
+        if self.frame_count == 0:
+            return None
+        return self.frame(-1)
+
+    def frames(self, start:int=0):
+        # yields (index, packed rows) for every frame from start on that is still in the ring,
+        # a frame the writer has wrapped around to while it was being read is dropped
+        idx = max(start, self.oldest(self.frame_count))
+        while idx < self.frame_count:
+            try:
+                rows = self.frame(idx)
+            except IndexError:
+                idx = max(idx + 1, self.oldest(self.frame_count))
+                continue
+
+            yield idx, rows
+            idx += 1
+
+def unpack(rows:np.ndarray) -> np.ndarray:
+    # 32x32 bool array indexed [y, x]
+    return np.unpackbits(rows.astype("<u4").view(np.uint8).reshape(32, 4), axis=1, bitorder="little").astype(bool)
+
+def render(rows:np.ndarray) -> str:
+    # y = 0 is the bottom row of the screen
+    pixels = unpack(rows)
+    return "\n".join(
+        "".join("#" if pixel else "." for pixel in pixels[y])
+        for y in range(31, -1, -1)
+    )
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Prints the frames of a headless framebuffer ring file.")
+    parser.add_argument("path", type=str, help="Path to the ring file written by a program recompiled with --framebuffer.")
+    parser.add_argument("--frame", type=int, default=-1, help="Index of the frame to print, negative indices count from the last frame.")
+    parser.add_argument("--all", action="store_true", help="Print every frame that is still in the ring.")
+    args = parser.parse_args()
+
+    with FramebufferRing(args.path) as ring:
+        print(f"{ring.frame_count} frames written, the last {ring.frame_count - ring.oldest(ring.frame_count)} are in the ring")
+
+        if args.all:
+            for idx, rows in ring.frames():
+                print(f"frame {idx}:\n{render(rows)}")
+        elif ring.frame_count > 0:
+            print(render(ring.frame(args.frame)))
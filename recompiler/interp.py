@@ -0,0 +1,469 @@
+import numpy as np
+
+from isa import ZERO_SEED_STATE, Instruction, read_mc_words
+
+# a reference interpreter that runs many independent machines in lockstep,
+# used as a differential oracle for recompiled programs and as the baseline for speedups
+
+def seed_state(seeds) -> np.ndarray:
+    # xorshift32 gets stuck on 0, so a zero seed is replaced by a fixed nonzero one
+    states = np.asarray(seeds, dtype=np.uint64).astype(np.uint32)
+    return np.where(states == 0, np.uint32(ZERO_SEED_STATE), states)
+
+def map_char(c:int) -> str:
+    # same mapping as the helper functions
+    if c == 0:
+        return " "
+    if c < 27:
+        return chr(ord("A") + c - 1)
+    if c == 27:
+        return "."
+    if c == 28:
+        return "!"
+    if c == 29:
+        return "?"
+    return "-"
+
+class Interpreter:
+    # programs are padded to the full address space, so every jump target and pc+1 can be fetched
+    ADDRESS_SPACE = 1024 + 1
+
+    # not a real opcode, marks the words behind the end of a program (which exit like the recompiled code does)
+    OP_END = 16
+
+    RUNNING = 0
+    HALTED  = 1
+    ERROR   = 2
+
+    # up to this many machines are run one after another instead of in lockstep,
+    # the numpy overhead of a lockstep step costs more than stepping a few machines in plain python
+    SCALAR_INSTANCES = 16
+
+    def __init__(self, programs:list[list[Instruction]], instances:int|None=None, seeds=None,
+                 headless:bool=False, controller:int=0) -> None:
+        # instance i runs programs[i % len(programs)]
+        self.instances = instances if instances is not None else len(programs)
+        self.headless = headless
+        self.controller = controller
+
+        # the fields are decoded again for every step, which is cheaper than gathering each of them separately
+        self.words = np.full((len(programs), self.ADDRESS_SPACE), self.OP_END << 12, dtype=np.int32)
+        for p_idx, program in enumerate(programs):
+            for instr in program:
+                self.words[p_idx, instr.pc] = (instr.op << 12) | (instr.reg_a << 8) | (instr.reg_b << 4) | instr.reg_c
+
+        n = self.instances
+        self.program = np.arange(n) % len(programs)
+
+        # every word decoded once for the machines that are run on their own
+        self.decoded = [
+            [
+                (int(word) >> 12, (int(word) >> 8) & 0xf, (int(word) >> 4) & 0xf, int(word) & 0xf)
+                for word in words
+            ]
+            for words in self.words
+        ]
+
+        self.pc     = np.zeros(n, dtype=np.int32)
+        self.regs   = np.zeros((n, 16),  dtype=np.uint8)
+        self.flag_Z = np.zeros(n, dtype=bool)
+        self.flag_C = np.zeros(n, dtype=bool)
+        self.ram    = np.zeros((n, 256), dtype=np.uint8)
+        self.stack  = np.zeros((n, 16),  dtype=np.int32)
+        self.sp     = np.zeros(n, dtype=np.int32)
+
+        self.pixel_x = np.zeros(n, dtype=np.uint8)
+        self.pixel_y = np.zeros(n, dtype=np.uint8)
+        self.screen  = np.zeros((n, 32, 32), dtype=bool)
+        self.frames  = np.zeros(n, dtype=np.int64)
+
+        self.rng = seed_state(seeds if seeds is not None else np.arange(1, n + 1))
+
+        self.status = np.full(n, self.RUNNING, dtype=np.int8)
+        self.steps  = np.zeros(n, dtype=np.int64)
+
+        # the text and number outputs are rare enough to be handled one instance at a time
+        self.char_buffer = [[] for _ in range(n)]
+        self.num         = np.zeros(n, dtype=np.uint8)
+        self.signedness  = np.zeros(n, dtype=bool)
+        self.output      = [[] for _ in range(n)]
+
+    @classmethod
+    def from_file(cls, in_file:str, instances:int=1, **kwargs):
+        program = [Instruction.decode(pc, word) for pc, word in enumerate(read_mc_words(in_file))]
+        return cls([program], instances, **kwargs)
+
+    def run(self, max_steps:int|None=None) -> int:
+        # returns the number of lockstep steps taken
+        if self.instances <= self.SCALAR_INSTANCES:
+            return max((self.run_scalar(i, max_steps) for i in range(self.instances)), default=0)
+
+        step = 0
+        while max_steps is None or step < max_steps:
+            active = np.flatnonzero(self.status == self.RUNNING)
+            if active.size == 0:
+                break
+
+            self.step(active)
+            step += 1
+
+        return step
+
+    def step(self, active:np.ndarray) -> None:
+        words = self.words[self.program[active], self.pc[active]]
+        ops = words >> 12
+
+        self.steps[active] += 1
+        self.pc[active] += 1
+
+        counts = np.bincount(ops, minlength=self.OP_END + 1)
+        for op in np.flatnonzero(counts):
+            mask = ops == op
+            idx = active[mask]
+            word = words[mask]
+
+            match op:
+                case Instruction.NOP:
+                    ...
+                case Instruction.HLT | self.OP_END:
+                    self.exit(idx)
+                case Instruction.ADD | Instruction.SUB | Instruction.NOR | Instruction.AND | Instruction.XOR:
+                    self.alu(op, idx, word)
+                case Instruction.RSH:
+                    self.set_reg(idx, word & 0xf, self.regs[idx, (word >> 8) & 0xf] >> 1)
+                case Instruction.LDI:
+                    self.set_reg(idx, (word >> 8) & 0xf, word & 0xff)
+                case Instruction.ADI:
+                    reg = (word >> 8) & 0xf
+                    res = self.regs[idx, reg].astype(np.int32) + (word & 0xff)
+                    self.flag_Z[idx] = (res & 0xff) == 0
+                    self.flag_C[idx] = res > 0xff
+                    self.set_reg(idx, reg, res)
+                case Instruction.JMP:
+                    self.pc[idx] = word & 0x3ff
+                case Instruction.BRH:
+                    self.brh(idx, word)
+                case Instruction.CAL:
+                    self.cal(idx, word)
+                case Instruction.RET:
+                    self.ret(idx)
+                case Instruction.LOD:
+                    self.load(idx, word)
+                case Instruction.STR:
+                    self.store(idx, word)
+
+    def run_scalar(self, i:int, max_steps:int|None=None) -> int:
+        # runs machine i on its own, with the state that changes every step in local python values,
+        # the io ports go through the same (vectorized) code as in lockstep with a single machine
+        if self.status[i] != self.RUNNING:
+            return 0
+
+        code = self.decoded[self.program[i]]
+        idx = np.array([i])
+
+        regs  = self.regs[i].tolist()
+        ram   = self.ram[i].tolist()
+        stack = self.stack[i].tolist()
+        sp, pc = int(self.sp[i]), int(self.pc[i])
+        flag_Z, flag_C = bool(self.flag_Z[i]), bool(self.flag_C[i])
+        rng = int(self.rng[i])
+
+        # opcodes as locals, looking them up on the class every step is measurably slower
+        ADD, SUB, NOR, AND, XOR = Instruction.ADD, Instruction.SUB, Instruction.NOR, Instruction.AND, Instruction.XOR
+        RSH, LDI, ADI, JMP, BRH = Instruction.RSH, Instruction.LDI, Instruction.ADI, Instruction.JMP, Instruction.BRH
+        CAL, RET, LOD, STR, HLT = Instruction.CAL, Instruction.RET, Instruction.LOD, Instruction.STR, Instruction.HLT
+        OP_END = self.OP_END
+
+        step = 0
+        while max_steps is None or step < max_steps:
+            op, a, b, c = code[pc]
+            step += 1
+            pc += 1
+
+            if ADD <= op <= XOR:
+                x, y = regs[a], regs[b]
+                if op == ADD:
+                    res = x + y
+                    flag_C = res > 0xff
+                elif op == SUB:
+                    res = x - y
+                    flag_C = x >= y
+                elif op == NOR:
+                    res = ~(x | y)
+                elif op == AND:
+                    res = x & y
+                else:
+                    res = x ^ y
+                res &= 0xff
+                flag_Z = res == 0
+                if c:
+                    regs[c] = res
+            elif op == RSH:
+                if c:
+                    regs[c] = regs[a] >> 1
+            elif op == LDI:
+                if a:
+                    regs[a] = (b << 4) | c
+            elif op == ADI:
+                res = regs[a] + ((b << 4) | c)
+                flag_Z = (res & 0xff) == 0
+                flag_C = res > 0xff
+                if a:
+                    regs[a] = res & 0xff
+            elif op == JMP:
+                pc = ((a & 0x3) << 8) | (b << 4) | c
+            elif op == BRH:
+                flag = flag_Z if a < 0x8 else flag_C
+                if flag != bool(a & 0x4):
+                    pc = ((a & 0x3) << 8) | (b << 4) | c
+            elif op == CAL:
+                if sp >= 16:
+                    self.error(idx)
+                    break
+                stack[sp] = pc
+                sp += 1
+                pc = ((a & 0x3) << 8) | (b << 4) | c
+            elif op == RET:
+                if sp <= 0:
+                    self.error(idx)
+                    break
+                sp -= 1
+                pc = stack[sp]
+            elif op == LOD or op == STR:
+                addr = (regs[a] + (c - 16 if c & 0x8 else c)) & 0xff
+                if op == LOD:
+                    if addr == 244:
+                        val = 0 if self.headless else int(self.get_pixel(idx)[0])
+                    elif addr == 255:
+                        val = 0 if self.headless else self.controller
+                    elif addr == 254:
+                        # xorshift32 like random()
+                        rng ^= (rng << 13) & 0xffffffff
+                        rng ^= rng >> 17
+                        rng ^= (rng << 5) & 0xffffffff
+                        val = rng & 0xff
+                    else:
+                        val = ram[addr]
+                    if b:
+                        regs[b] = val
+                elif addr < 240:
+                    ram[addr] = regs[b]
+                else:
+                    self.store_port(addr, idx, np.array([regs[b]], dtype=np.uint8))
+                    if self.status[i] != self.RUNNING:
+                        break
+            elif op == HLT or op == OP_END:
+                self.exit(idx)
+                break
+
+        self.regs[i]  = regs
+        self.ram[i]   = ram
+        self.stack[i] = stack
+        self.sp[i], self.pc[i] = sp, pc
+        self.flag_Z[i], self.flag_C[i] = flag_Z, flag_C
+        self.rng[i] = rng
+        self.steps[i] += step
+
+        return step
+
+    def set_reg(self, idx, reg, val) -> None:
+        # r0 is hardwired to zero
+        keep = reg != 0
+        self.regs[idx[keep], reg[keep]] = val[keep] & 0xff
+
+    def alu(self, op, idx, word) -> None:
+        a = self.regs[idx, (word >> 8) & 0xf].astype(np.int32)
+        b = self.regs[idx, (word >> 4) & 0xf].astype(np.int32)
+
+        match op:
+            case Instruction.ADD:
+                res = a + b
+                self.flag_C[idx] = res > 0xff
+            case Instruction.SUB:
+                res = a - b
+                self.flag_C[idx] = a >= b
+            case Instruction.NOR:
+                res = ~(a | b)
+            case Instruction.AND:
+                res = a & b
+            case Instruction.XOR:
+                res = a ^ b
+
+        res &= 0xff
+        self.flag_Z[idx] = res == 0
+        self.set_reg(idx, word & 0xf, res)
+
+    def brh(self, idx, word) -> None:
+        cond = (word >> 10) & 0x3
+        flag = np.where(cond < 2, self.flag_Z[idx], self.flag_C[idx])
+        taken = flag ^ (cond & 1).astype(bool)
+
+        self.pc[idx] = np.where(taken, word & 0x3ff, self.pc[idx])
+
+    def cal(self, idx, word) -> None:
+        # the recompiled code has no defined behaviour on a stack overflow, it's treated as an error here
+        overflow = self.sp[idx] >= 16
+        self.error(idx[overflow])
+
+        idx, word = idx[~overflow], word[~overflow]
+        self.stack[idx, self.sp[idx]] = self.pc[idx]
+        self.sp[idx] += 1
+        self.pc[idx] = word & 0x3ff
+
+    def ret(self, idx) -> None:
+        underflow = self.sp[idx] <= 0
+        self.error(idx[underflow])
+
+        idx = idx[~underflow]
+        self.sp[idx] -= 1
+        self.pc[idx] = self.stack[idx, self.sp[idx]]
+
+    def address(self, idx, word) -> np.ndarray:
+        off = word & 0xf
+        off = np.where(off & 0x8, off - 16, off)
+        return (self.regs[idx, (word >> 8) & 0xf].astype(np.int32) + off) & 0xff
+
+    def load(self, idx, word) -> None:
+        addr = self.address(idx, word)
+        val = self.ram[idx, addr].astype(np.int32)
+
+        # headless programs read 0 from the screen and the controller
+        pixel = addr == 244
+        val[pixel] = 0 if self.headless else self.get_pixel(idx[pixel])
+
+        controller = addr == 255
+        val[controller] = 0 if self.headless else self.controller
+
+        random = addr == 254
+        if random.any():
+            val[random] = self.random(idx[random])
+
+        self.set_reg(idx, (word >> 4) & 0xf, val)
+
+    def store(self, idx, word) -> None:
+        addr = self.address(idx, word)
+        val = self.regs[idx, (word >> 4) & 0xf]
+
+        ram = addr < 240
+        self.ram[idx[ram], addr[ram]] = val[ram]
+
+        for port in np.unique(addr[~ram]):
+            mask = addr == port
+            self.store_port(int(port), idx[mask], val[mask])
+
+    def store_port(self, port, idx, val) -> None:
+        match port:
+            case 240:
+                self.pixel_x[idx] = val
+            case 241:
+                self.pixel_y[idx] = val
+            case 242 | 243:
+                if not self.headless:
+                    x, y = self.pixel_x[idx], self.pixel_y[idx]
+                    visible = (x < 32) & (y < 32)
+                    self.screen[idx[visible], y[visible], x[visible]] = port == 242
+            case 245:
+                if not self.headless:
+                    self.frames[idx] += 1
+            case 246:
+                if not self.headless:
+                    self.screen[idx] = False
+            case 247:
+                for i, c in zip(idx, val):
+                    if len(self.char_buffer[i]) < 32:
+                        self.char_buffer[i].append(map_char(int(c)))
+            case 248:
+                for i in idx:
+                    if self.char_buffer[i]:
+                        self.output[i].append("".join(self.char_buffer[i]).ljust(32, "\0"))
+                        self.char_buffer[i] = []
+            case 249:
+                for i in idx:
+                    self.char_buffer[i] = []
+            case 250:
+                self.num[idx] = val
+            case 251:
+                self.num[idx] = 0
+            case 252:
+                self.signedness[idx] = False
+            case 253:
+                self.signedness[idx] = True
+            case _:
+                # storing to the remaining io addresses raises an error in the recompiled code
+                self.error(idx)
+
+    def get_pixel(self, idx) -> np.ndarray:
+        x, y = self.pixel_x[idx], self.pixel_y[idx]
+        visible = (x < 32) & (y < 32)
+        return np.where(visible, self.screen[idx, y & 0x1f, x & 0x1f], False).astype(np.int32)
+
+    def random(self, idx) -> np.ndarray:
+        # xorshift32, the low byte of the new state is the random number
+        state = self.rng[idx]
+        state ^= state << np.uint32(13)
+        state ^= state >> np.uint32(17)
+        state ^= state << np.uint32(5)
+        self.rng[idx] = state
+        return (state & np.uint32(0xff)).astype(np.int32)
+
+    def exit(self, idx) -> None:
+        self.status[idx] = self.HALTED
+        for i in idx:
+            if not self.headless:
+                self.output[i].append("DEINITIALIZING")
+            self.write_num(i)
+
+    def error(self, idx) -> None:
+        self.status[idx] = self.ERROR
+        for i in idx:
+            self.output[i].append("CRITICAL ERROR")
+            self.write_num(i)
+
+    def write_num(self, i) -> None:
+        num = int(self.num[i])
+        if self.signedness[i]:
+            self.output[i].append(str((num & 0x7f) * -(num >> 7)))
+        else:
+            self.output[i].append(str(num))
+
+    def stdout(self, i) -> str:
+        # what the recompiled program would have printed
+        return "".join(line + "\n" for line in self.output[i])
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    import time
+
+    parser = argparse.ArgumentParser(description="Runs a BatPU-2 machine code file on many interpreted machines at once.")
+    parser.add_argument("in_file", type=str, help="Path to the input .mc file.")
+
+    parser.add_argument("--headless", action="store_true", help="Run without a screen and controller, like a headless recompilation.")
+    parser.add_argument("--instances", type=int, default=1, help="Number of machines to run in lockstep.")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed of the first machine, the others use the following seeds.")
+    parser.add_argument("--controller", type=int, default=0, help="Controller state read from port 255.")
+    parser.add_argument("--max-steps", type=int, default=None, help="Stop after this many instructions per machine.")
+    args = parser.parse_args()
+
+    interp = Interpreter.from_file(
+        args.in_file,
+        args.instances,
+        seeds=np.arange(args.seed, args.seed + args.instances),
+        headless=args.headless,
+        controller=args.controller,
+    )
+
+    start = time.perf_counter()
+    interp.run(args.max_steps)
+    duration = time.perf_counter() - start
+
+    # the output of the first machine, in the same format as the recompiled program
+    sys.stdout.write(interp.stdout(0))
+
+    print(
+        f"{args.instances} instances, {int(interp.steps.sum())} instructions in {duration:.3f}s "
+        f"({interp.steps.sum() / duration / 1e6:.2f}M instructions/s), "
+        f"{int((interp.status == Interpreter.HALTED).sum())} halted, {int((interp.status == Interpreter.ERROR).sum())} errors, "
+        f"{int((interp.status == Interpreter.RUNNING).sum())} still running",
+        file=sys.stderr,
+    )
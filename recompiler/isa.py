@@ -0,0 +1,101 @@
+import array
+import mmap
+import os
+import sys
+
+# the BatPU-2 instruction set and program files, shared by the recompiler, the interpreters and the tools around them,
+# like cache.py and client.py this must not import llvmlite
+
+class Instruction:
+    NOP = 0x0
+    HLT = 0x1
+    ADD = 0x2
+    SUB = 0x3
+    NOR = 0x4
+    AND = 0x5
+    XOR = 0x6
+    RSH = 0x7
+    LDI = 0x8
+    ADI = 0x9
+    JMP = 0xa
+    BRH = 0xb
+    CAL = 0xc
+    RET = 0xd
+    LOD = 0xe
+    STR = 0xf
+
+    # whole program corpora get decoded, so instructions shouldn't carry a __dict__ around
+    __slots__ = ("pc", "op", "reg_a", "reg_b", "reg_c", "off", "imm", "addr", "cond")
+
+    def __init__(self, pc, op, reg_a, reg_b, reg_c, off, imm, addr, cond) -> None:
+        self.pc = pc
+        self.op = op
+
+        self.reg_a = reg_a
+        self.reg_b = reg_b
+        self.reg_c = reg_c
+
+        self.off  = off
+        self.imm  = imm
+        self.addr = addr
+
+        self.cond = cond
+
+    @classmethod
+    def decode(cls, pc, word):
+        reg_c = word & 0xf
+
+        # positional arguments, this runs once for every word of the program
+        return cls(
+            pc,
+            word >> 12,                           # op
+
+            (word >> 8) & 0xf,                    # reg_a
+            (word >> 4) & 0xf,                    # reg_b
+            reg_c,
+
+            reg_c - 16 if reg_c & 0x8 else reg_c, # off
+            word & 0xff,                          # imm
+            word & 0x3ff,                         # addr
+
+            (word >> 10) & 0x3,                   # cond
+        )
+
+# packed programs store every instruction word as 2 little endian bytes instead of a line of 16 '0'/'1' characters
+PACKED_EXTENSION = ".bin"
+
+def read_mc_words(path:str) -> list[int]:
+    if os.path.splitext(path)[1] == PACKED_EXTENSION:
+        return read_packed_words(path)
+
+    with open(path, "r") as code:
+        return [int(line, 2) for line in code.read().splitlines()]
+
+def read_packed_words(path:str) -> list[int]:
+    with open(path, "rb") as code:
+        size = os.fstat(code.fileno()).st_size
+        if size % 2:
+            raise Exception(f"{path} holds {size} bytes, packed programs are made of 2 byte words")
+        if size == 0:
+            return []
+
+        with mmap.mmap(code.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if sys.byteorder == "little":
+                with memoryview(mapped) as view, view.cast("H") as words:
+                    return words.tolist()
+
+            words = array.array("H")
+            words.frombytes(mapped)
+            words.byteswap()
+            return words.tolist()
+
+def write_packed_file(words:list[int], path:str) -> None:
+    packed = array.array("H", words)
+    if sys.byteorder != "little":
+        packed.byteswap()
+
+    with open(path, "wb") as output:
+        packed.tofile(output)
+
+# state a zero seed of the random number generator is replaced with, xorshift32 would only ever produce 0 from it
+ZERO_SEED_STATE = 0x6d2b79f5
@@ -1,56 +1,144 @@
 from llvmlite import ir, binding
+from cache import BuildCache, LinkError, cached_recompile, default_cache_dir
+from client import default_socket_path
+from isa import ZERO_SEED_STATE, PACKED_EXTENSION, Instruction, read_mc_words, write_packed_file
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import ctypes
+import glob
+import json
 import os
-
-class Instruction:
-    NOP = 0x0
-    HLT = 0x1
-    ADD = 0x2
-    SUB = 0x3
-    NOR = 0x4
-    AND = 0x5
-    XOR = 0x6
-    RSH = 0x7
-    LDI = 0x8
-    ADI = 0x9
-    JMP = 0xa
-    BRH = 0xb
-    CAL = 0xc
-    RET = 0xd
-    LOD = 0xe
-    STR = 0xf
-
-    def __init__(self, pc, op, reg_a, reg_b, reg_c, off, imm, addr, cond) -> None:
-        self.pc = pc
-        self.op = op
-
-        self.reg_a = reg_a
-        self.reg_b = reg_b
-        self.reg_c = reg_c
-
-        self.off  = off
-        self.imm  = imm
-        self.addr = addr
-
-        self.cond = cond
+import socket
+import socketserver
+import stat
+import subprocess
+import sys
+import time
+
+def create_target_machine(triple:str, cpu:str, features:str, opt_level:int, reloc:str="default") -> binding.TargetMachine:
+    if cpu == "host":
+        cpu = binding.get_host_cpu_name()
+
+    if features == "host":
+        features = binding.get_host_cpu_features().flatten()
+
+    target = binding.Target.from_triple(triple)
+    return target.create_target_machine(
+        cpu      = cpu,
+        features = features,
+        opt      = opt_level,
+        reloc    = reloc,
+    )
 
 class Recompiler:
-    def __init__(self, in_file:str, out_file:str, headless:bool=False) -> None:
-        self.in_file  = in_file
-        self.out_file = out_file
-        self.headless = headless
+    FLAG_Z = 0b01
+    FLAG_C = 0b10
+
+    # memory mapped io ports that LOD/STR dispatch on, any other LOD address in 240-255 reads ram
+    LOD_PORTS = (244, 254, 255)
+    STR_PORTS = (240, 241, 242, 243, 245, 246, 247, 248, 249, 250, 251, 252, 253)
+
+    # number of times the register ranges at an instruction may grow before they are widened
+    RANGE_WIDENING_LIMIT = 8
+
+    # llvm is initialized once per process, a server or batch worker recompiles many programs with it
+    llvm_initialized = False
+
+    def __init__(self, in_file:str, out_file:str|None=None, headless:bool=False, opt_level:int=0,
+                 emit:str="ll", cpu:str="host", features:str="host", profile:str|None=None,
+                 profile_use:str|None=None, framebuffer:str|None=None, framebuffer_slots:int=256,
+                 present_rate:int|None=None, render_thread:bool=False,
+                 incremental:str|None=None, record_input:str|None=None, replay_input:str|None=None,
+                 seed:int|None=None) -> None:
+        self.in_file   = in_file
+        self.out_file  = out_file
+        self.headless  = headless
+        self.opt_level = opt_level
+
+        # path the block and edge counts are written to when the program exits, no instrumentation if None
+        self.profile = profile
+        # counts of a previous profiling run, used for branch weights and the block layout
+        self.profile_data = read_profile(profile_use) if profile_use is not None else None
+
+        # ring file every frame of a headless run is appended to, the screen isn't emulated in headless runs if None
+        self.framebuffer = framebuffer
+        self.framebuffer_slots = framebuffer_slots
+
+        # maximum number of frames per second the window presents, the display refresh rate if None and unlimited if 0
+        self.present_rate = present_rate
+        # present the window from a thread of its own, so the program never waits for the display
+        self.render_thread = render_thread
+
+        # controller trace file (one byte per frame) a windowed run records its input to, and the one a run reads its input from instead
+        self.record_input = record_input
+        self.replay_input = replay_input
+
+        # seed of the xorshift32 generator the random number port is inlined as, a call to the helper functions if None
+        self.seed = seed
+
+        # cache directory of the per region objects of an incremental recompilation, a single module if None
+        self.incremental = incremental
+        if self.incremental is not None and (emit != "obj" or self.out_file is None):
+            raise Exception("Incremental recompilation writes an archive of object files, it needs an output file and emit='obj'")
+        if self.incremental is not None and (self.profile is not None or self.profile_data is not None):
+            raise Exception("Incremental recompilation can't be combined with profiling")
+
+        self.emit     = emit
+        self.cpu      = cpu
+        self.features = features
 
         self.name = os.path.splitext(os.path.basename(self.in_file))[0]
         self.load_mc_file()
 
         self.init_llvm_binding()
+        self.init_target_machine()
         self.init_llvm_module()
         self.declare_helper_funcs()
 
     def recompile(self) -> None:
-        self.init_llvm_builder()
-
+        self.find_subroutines()
+        self.find_return_targets()
+        self.analyze_register_ranges()
         self.find_branch_targets()
-        self.build_llvm_blocks()
+        self.analyze_flag_liveness()
+        self.find_idioms()
+
+        if self.incremental is not None:
+            self.recompile_incremental()
+            return
+
+        self.build_contexts([None, *self.subroutines])
+
+        if self.out_file is not None:
+            self.write_output_file()
+
+    def build_contexts(self, contexts:list, split:bool=False) -> None:
+        # translates the given contexts (None for main, the entry address for a subroutine) into self.mod,
+        # a split module only holds some of them and shares everything that crosses contexts through external symbols
+        if None in contexts:
+            self.init_llvm_builder()
+
+        self.declare_subroutines(split)
+
+        if self.profile is not None:
+            self.declare_profile_counters()
+
+        if self.emulates_screen():
+            self.declare_screen_bitmap(split, None in contexts)
+
+        if self.seed is not None:
+            self.declare_rng_state(split, None in contexts)
+
+        if None in contexts:
+            self.build_main()
+
+        for entry in contexts:
+            if entry is not None:
+                self.build_subroutine(entry)
+
+    def build_main(self) -> None:
+        # translation context, None while translating main and the entry address while translating a subroutine
+        self.subroutine = None
+        self.build_llvm_blocks(self.find_block_addrs())
 
         self.builder.position_at_end(self.exit_block)
         self.build_exit_routine()
@@ -66,44 +154,199 @@ class Recompiler:
         self.builder.branch(self.blocks[0])
 
         for instr in self.instructions:
-            self.translate_instruction(instr)
+            if self.owners[instr.pc] is None:
+                self.translate_instruction(instr)
 
         self.terminate_all_blocks()
 
-        self.write_llvm_file()
+        if self.profile_data is not None:
+            self.layout_hot_blocks()
+
+    def recompile_incremental(self) -> None:
+        # every translation context becomes an object file of its own, cached under everything its translation depends on,
+        # so after an edit only the contexts it touched are translated and compiled again
+        cache = BuildCache(self.incremental)
+        options = {
+            "headless":  self.headless,
+            "opt_level": self.opt_level,
+            "cpu":       self.cpu,
+            "features":  self.features,
+            "framebuffer":       self.framebuffer,
+            "framebuffer_slots": self.framebuffer_slots,
+            "present_rate":  self.present_rate,
+            "render_thread": self.render_thread,
+            "record_input":  self.record_input,
+            "replay_input":  self.replay_input,
+            "seed":          self.seed,
+        }
+
+        members = []
+        self.reused_regions = 0
+        for context in [None, *self.subroutines]:
+            key = cache.region_key(self.region_facts(context), options)
+            name = "main.o" if context is None else f"sub_{context:04x}.o"
+
+            object_path = cache.get(key, "region.o")
+            symbols_path = cache.get(key, "region.sym")
+            if object_path is not None and symbols_path is not None:
+                with open(object_path, "rb") as file:
+                    data = file.read()
+                with open(symbols_path, "r") as file:
+                    symbols = file.read().split()
+                self.reused_regions += 1
+            else:
+                self.init_llvm_module()
+                self.declare_helper_funcs()
+                self.build_contexts([context], split=True)
+
+                llmod = self.build_llvm_module()
+                data = self.target_machine.emit_object(llmod)
+                # the archive index needs the symbols the object defines for the other ones
+                symbols = [
+                    value.name
+                    for value in [*llmod.functions, *llmod.global_variables]
+                    if not value.is_declaration and value.linkage == binding.Linkage.external
+                ]
+
+                cache.put_data(key, "region.o", data)
+                cache.put_data(key, "region.sym", "\n".join(symbols).encode())
+
+            members.append((name, data, symbols))
+
+        if self.reused_regions < len(members):
+            cache.evict()
+
+        write_archive(members, self.out_file)
+
+    def region_facts(self, context) -> dict:
+        # everything translating a context depends on, besides the recompiler options
+        pcs = self.context_pcs[context]
+
+        self.subroutine = context
+        block_addrs = self.find_block_addrs()
+
+        def idiom(pc):
+            if pc not in self.idioms:
+                return None
+            return [part.pc if isinstance(part, Instruction) else part for part in self.idioms[pc]]
+
+        return {
+            "context":  context,
+            "blocks":   block_addrs,
+            "instructions": [
+                [
+                    pc,
+                    (instr.op << 12) | (instr.reg_a << 8) | (instr.reg_b << 4) | instr.reg_c,
+                    # whether the instruction falls through into the next one of the context
+                    self.owner_of(pc + 1) == context and pc + 1 < len(self.instructions),
+                    self.live_flags[pc],
+                    self.address_ranges[pc],
+                    idiom(pc),
+                    pc in self.fused_pcs,
+                    # calls to a lifted subroutine become a function call, others push onto the emulated stack
+                    instr.op == Instruction.CAL and instr.addr in self.subroutines,
+                ]
+                for pc, instr in ((pc, self.instructions[pc]) for pc in pcs)
+            ],
+            "return_targets": self.return_targets if context is None else None,
+        }
+    def run(self, helper_lib:str|None, report_time:bool=False) -> int:
+        # the helper functions have to be visible to the jit before the module is compiled,
+        # None if they were registered with binding.add_symbol already (like the tests do)
+        if helper_lib is not None:
+            binding.load_library_permanently(helper_lib)
+
+        # mcjit places the code itself and breaks on position independent code, so it gets a target machine of its own
+        jit_target_machine = create_target_machine(self.mod.triple, self.cpu, self.features, self.opt_level)
+        engine = binding.create_mcjit_compiler(self.build_llvm_module(), jit_target_machine)
+        engine.finalize_object()
+        engine.run_static_constructors()
+
+        main_func = ctypes.CFUNCTYPE(ctypes.c_int32)(engine.get_function_address("main"))
+
+        # the helper functions exit the process from their deinit routines,
+        # so anything buffered on the python side has to be written out first
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        if not report_time:
+            return main_func()
+
+        # main usually never returns, so the time is reported from a c exit handler as well
+        start = time.perf_counter()
+        reported = False
+
+        def report():
+            nonlocal reported
+            if not reported:
+                reported = True
+                os.write(2, f"run time: {time.perf_counter() - start:.6f}s\n".encode())
+
+        # glibc only exports atexit's underlying __cxa_atexit
+        libc = ctypes.CDLL("ucrtbase" if sys.platform == "win32" else None)
+        if hasattr(libc, "atexit"):
+            self.exit_handler = ctypes.CFUNCTYPE(None)(report)
+            libc.atexit(self.exit_handler)
+        else:
+            self.exit_handler = ctypes.CFUNCTYPE(None, ctypes.c_void_p)(lambda _: report())
+            libc["__cxa_atexit"](self.exit_handler, None, None)
+
+        status = main_func()
+        report()
+        return status
 
     def translate_instruction(self, instr:Instruction):
+        # translated together with the idiom that starts before it
+        if instr.pc in self.fused_pcs:
+            return
+
         self.position_at_end_of_closest_block(instr.pc)
 
+        live_flags = self.live_flags[instr.pc]
+
+        match self.idioms.get(instr.pc):
+            case ("move", src, dest, carry):
+                self.idiom_move(src, dest, carry, live_flags)
+                return
+            case ("branch", brh):
+                self.idiom_branch(instr, brh)
+                return
+            case ("double", count):
+                self.idiom_double(instr.reg_a, count, self.live_flags[instr.pc + count - 1])
+                return
+            case ("multiply", count, src, products, last_factors):
+                self.idiom_multiply(src, products, last_factors, self.live_flags[instr.pc + count - 1])
+                return
+
         match instr.op:
             case Instruction.NOP:
                 ...
             case Instruction.HLT:
                 self.instr_hlt()
             case Instruction.ADD:
-                self.instr_add(instr.reg_a, instr.reg_b, instr.reg_c)
+                self.instr_add(instr.reg_a, instr.reg_b, instr.reg_c, live_flags)
             case Instruction.SUB:
-                self.instr_sub(instr.reg_a, instr.reg_b, instr.reg_c)
+                self.instr_sub(instr.reg_a, instr.reg_b, instr.reg_c, live_flags)
             case Instruction.NOR:
-                self.instr_nor(instr.reg_a, instr.reg_b, instr.reg_c)
+                self.instr_nor(instr.reg_a, instr.reg_b, instr.reg_c, live_flags)
             case Instruction.AND:
-                self.instr_and(instr.reg_a, instr.reg_b, instr.reg_c)
+                self.instr_and(instr.reg_a, instr.reg_b, instr.reg_c, live_flags)
             case Instruction.XOR:
-                self.instr_xor(instr.reg_a, instr.reg_b, instr.reg_c)
+                self.instr_xor(instr.reg_a, instr.reg_b, instr.reg_c, live_flags)
             case Instruction.RSH:
                 self.instr_rsh(instr.reg_a, instr.reg_c)
             case Instruction.LDI:
                 self.instr_ldi(instr.reg_a, instr.imm)
             case Instruction.ADI:
-                self.instr_adi(instr.reg_a, instr.imm)
+                self.instr_adi(instr.reg_a, instr.imm, live_flags)
             case Instruction.JMP:
-                self.instr_jmp(instr.addr)
+                self.instr_jmp(instr.pc, instr.addr)
             case Instruction.BRH:
-                self.instr_brh(instr.cond, instr.addr, instr.pc+1)
+                self.instr_brh(instr.pc, instr.cond, instr.addr, instr.pc+1)
             case Instruction.CAL:
                 self.instr_cal(instr.pc, instr.addr)
             case Instruction.RET:
-                self.instr_ret()
+                self.instr_ret(instr.pc)
             case Instruction.LOD:
                 self.instr_lod(instr.pc, instr.reg_a, instr.off, instr.reg_b)
             case Instruction.STR:
@@ -111,14 +354,25 @@ class Recompiler:
             case _:
                 raise Exception(f"Instruction {instr.op:01x} not yet implemented")
 
-    def init_llvm_binding(self) -> None:
+    @classmethod
+    def init_llvm_binding(cls) -> None:
+        if cls.llvm_initialized:
+            return
+
         binding.initialize()
         binding.initialize_native_target()
         binding.initialize_native_asmprinter()
+        cls.llvm_initialized = True
 
     def init_llvm_module(self) -> None:
+        # also called for every split module of an incremental recompilation, which all need the layout of the target
         self.mod = ir.Module(self.name)
         self.mod.triple = binding.get_default_triple()
+        self.mod.data_layout = str(self.target_machine.target_data)
+
+    def init_target_machine(self) -> None:
+        # the object files get linked into position independent executables
+        self.target_machine = create_target_machine(binding.get_default_triple(), self.cpu, self.features, self.opt_level, reloc="pic")
 
     def declare_helper_funcs(self) -> None:
         self.funcs = {
@@ -137,6 +391,11 @@ class Recompiler:
             ftype  = ir.FunctionType(ir.VoidType(), []),
             name   = "init",
         ),
+        "init_render_thread": ir.Function(
+            module = self.mod,
+            ftype  = ir.FunctionType(ir.VoidType(), []),
+            name   = "init_render_thread",
+        ),
         "deinit": ir.Function(
             module = self.mod,
             ftype  = ir.FunctionType(ir.VoidType(), []),
@@ -147,31 +406,6 @@ class Recompiler:
             ftype  = ir.FunctionType(ir.VoidType(), []),
             name   = "raise_error",
         ),
-        "draw_pixel": ir.Function(
-            module = self.mod,
-            ftype  = ir.FunctionType(ir.VoidType(), [ir.IntType(8), ir.IntType(8)]),
-            name   = "draw_pixel",
-        ),
-        "clear_pixel": ir.Function(
-            module = self.mod,
-            ftype  = ir.FunctionType(ir.VoidType(), [ir.IntType(8), ir.IntType(8)]),
-            name   = "clear_pixel",
-        ),
-        "get_pixel": ir.Function(
-            module = self.mod,
-            ftype  = ir.FunctionType(ir.IntType(8), [ir.IntType(8), ir.IntType(8)]),
-            name   = "get_pixel",
-        ),
-        "update_screen": ir.Function(
-            module = self.mod,
-            ftype  = ir.FunctionType(ir.VoidType(), []),
-            name   = "update_screen",
-        ),
-        "clear_screen": ir.Function(
-            module = self.mod,
-            ftype  = ir.FunctionType(ir.VoidType(), []),
-            name   = "clear_screen",
-        ),
         "push_char": ir.Function(
             module = self.mod,
             ftype  = ir.FunctionType(ir.VoidType(), [ir.IntType(8)]),
@@ -207,41 +441,285 @@ class Recompiler:
             ftype  = ir.FunctionType(ir.IntType(8), []),
             name   = "get_controller",
         ),
+        "get_controller_headless": ir.Function(
+            module = self.mod,
+            ftype  = ir.FunctionType(ir.IntType(8), []),
+            name   = "get_controller_headless",
+        ),
+        "init_input_record": ir.Function(
+            module = self.mod,
+            ftype  = ir.FunctionType(ir.VoidType(), [ir.PointerType(ir.IntType(8))]),
+            name   = "init_input_record",
+        ),
+        "init_input_replay": ir.Function(
+            module = self.mod,
+            ftype  = ir.FunctionType(ir.VoidType(), [ir.PointerType(ir.IntType(8))]),
+            name   = "init_input_replay",
+        ),
+        "next_input_frame": ir.Function(
+            module = self.mod,
+            ftype  = ir.FunctionType(ir.VoidType(), []),
+            name   = "next_input_frame",
+        ),
         "get_random_num": ir.Function(
             module = self.mod,
             ftype  = ir.FunctionType(ir.IntType(8), []),
             name   = "get_random_num",
         ),
+        "present_framebuffer": ir.Function(
+            module = self.mod,
+            ftype  = ir.FunctionType(ir.VoidType(), [ir.PointerType(ir.IntType(32))]),
+            name   = "present_framebuffer",
+        ),
+        "present_framebuffer_headless": ir.Function(
+            module = self.mod,
+            ftype  = ir.FunctionType(ir.VoidType(), [ir.PointerType(ir.IntType(32))]),
+            name   = "present_framebuffer_headless",
+        ),
+        "idle": ir.Function(
+            module = self.mod,
+            ftype  = ir.FunctionType(ir.VoidType(), []),
+            name   = "idle",
+        ),
+        "init_headless_framebuffer": ir.Function(
+            module = self.mod,
+            ftype  = ir.FunctionType(ir.VoidType(), [ir.PointerType(ir.IntType(8)), ir.IntType(32)]),
+            name   = "init_headless_framebuffer",
+        ),
+        "set_present_rate": ir.Function(
+            module = self.mod,
+            ftype  = ir.FunctionType(ir.VoidType(), [ir.IntType(32)]),
+            name   = "set_present_rate",
+        ),
+        "set_profile": ir.Function(
+            module = self.mod,
+            ftype  = ir.FunctionType(ir.VoidType(), [
+                ir.PointerType(ir.IntType(8)),
+                ir.PointerType(ir.PointerType(ir.IntType(8))),
+                ir.PointerType(ir.IntType(64)),
+                ir.IntType(64),
+            ]),
+            name   = "set_profile",
+        ),
     }
 
     def load_mc_file(self) -> None:
-        with open(self.in_file, "r") as code:
-            lines = code.read().splitlines()
-
-        self.instructions = []
-        for pc, line in enumerate(lines):
-            self.instructions.append(Instruction(
-                pc = pc,
-                op = int(line[:4], 2),
+        self.instructions = [
+            Instruction.decode(pc, word)
+            for pc, word in enumerate(read_mc_words(self.in_file))
+        ]
+
+    def build_llvm_module(self) -> binding.ModuleRef:
+        llmod = binding.parse_assembly(str(self.mod))
+        llmod.verify()
+
+        if self.opt_level > 0:
+            self.optimize_llvm_module(llmod)
+
+        return llmod
+
+    def optimize_llvm_module(self, llmod:binding.ModuleRef) -> None:
+        # the default pipelines promote the register/flag allocas to SSA (SROA/mem2reg)
+        # and run GVN and the loop passes on top of that
+        tuning = binding.create_pipeline_tuning_options(
+            speed_level = self.opt_level,
+            size_level  = 0,
+        )
+        tuning.loop_vectorization = self.opt_level >= 2
+        tuning.slp_vectorization  = self.opt_level >= 2
+
+        pass_builder = binding.create_pass_builder(self.target_machine, tuning)
+        pass_builder.getModulePassManager().run(llmod, pass_builder)
+
+    def write_output_file(self) -> None:
+        match self.emit:
+            case "ll":
+                self.write_llvm_file()
+            case "bc":
+                self.write_bitcode_file()
+            case "obj":
+                self.write_object_file()
+            case "asm":
+                self.write_assembly_file()
+            case _:
+                raise Exception(f"Unknown emission mode {self.emit}")
 
-                reg_a = int(line[4 :8 ], 2),
-                reg_b = int(line[8 :12], 2),
-                reg_c = int(line[12:16], 2),
+    def write_bitcode_file(self) -> None:
+        with open(self.out_file, "wb") as output:
+            output.write(self.build_llvm_module().as_bitcode())
 
-                off  = (int(line[12:16], 2) & 0x7) + bool(int(line[12:16], 2) & 0x8) * -8,
-                imm  = int(line[8:16], 2),
-                addr = int(line[6:16], 2),
+    def write_object_file(self) -> None:
+        with open(self.out_file, "wb") as output:
+            output.write(self.target_machine.emit_object(self.build_llvm_module()))
 
-                cond = int(line[4:6], 2),
-            ))
+    def write_assembly_file(self) -> None:
+        with open(self.out_file, "w") as output:
+            output.write(self.target_machine.emit_assembly(self.build_llvm_module()))
 
     def write_llvm_file(self) -> None:
         with open(self.out_file, "w") as output:
-            output.write(str(self.mod))
+            if self.opt_level > 0:
+                output.write(str(self.build_llvm_module()))
+            else:
+                output.write(str(self.mod))
+
+    def find_subroutines(self) -> None:
+        # subroutines that are only entered through CAL and only leave through RET get lifted into their own llvm function,
+        # everything else (jumps into the middle of a subroutine, falling into one, shared code, ...) stays in main
+        # and uses the switch based return scheme
+        self.local_preds = [[] for _ in self.instructions]
+        self.callers = {}
+        for instr in self.instructions:
+            for succ in self.local_successors(instr):
+                if succ < len(self.instructions):
+                    self.local_preds[succ].append(instr.pc)
+
+            if instr.op == Instruction.CAL:
+                self.callers.setdefault(instr.addr, []).append(instr.pc)
+
+        self.subroutines = {}
+        for entry in self.callers:
+            region = self.find_subroutine_region(entry)
+            if region is not None:
+                self.subroutines[entry] = region
+
+        changed = True
+        while changed:
+            changed = False
+
+            # number of subroutines every instruction belongs to
+            coverage = [0] * len(self.instructions)
+            for region in self.subroutines.values():
+                for pc in region:
+                    coverage[pc] += 1
+
+            for entry in list(self.subroutines.keys()):
+                if not self.is_regular_subroutine(entry, coverage):
+                    del self.subroutines[entry]
+                    changed = True
+
+        self.owners = [None] * len(self.instructions)
+        for entry, region in self.subroutines.items():
+            for pc in region:
+                self.owners[pc] = entry
+
+        # instructions of every translation context, main's are stored under None
+        self.context_pcs = {entry: region for entry, region in self.subroutines.items()}
+        self.context_pcs[None] = [pc for pc in range(len(self.instructions)) if self.owners[pc] is None]
+
+        self.subroutine_returns = {entry: [] for entry in self.subroutines}
+        for instr in self.instructions:
+            if instr.op == Instruction.CAL and instr.addr in self.subroutines:
+                self.subroutine_returns[instr.addr].append(instr.pc + 1)
+
+    def find_subroutine_region(self, entry) -> list[int]|None:
+        region = set()
+        worklist = [entry]
+        while worklist:
+            pc = worklist.pop()
+            if pc in region:
+                continue
+            if pc >= len(self.instructions):
+                # leaves the program
+                return None
+
+            region.add(pc)
+            worklist.extend(self.local_successors(self.instructions[pc]))
+
+        return sorted(region)
+
+    def local_successors(self, instr:Instruction) -> list[int]:
+        # successors within a subroutine, calls return to the next instruction and RET leaves it
+        match instr.op:
+            case Instruction.HLT | Instruction.RET:
+                return []
+            case Instruction.JMP:
+                return [instr.addr]
+            case Instruction.BRH:
+                return [instr.addr, instr.pc + 1]
+            case _:
+                return [instr.pc + 1]
+
+    def is_regular_subroutine(self, entry, coverage) -> bool:
+        region = set(self.subroutines[entry])
+
+        # the program starts at 0, which counts as an edge from outside
+        if 0 in region:
+            return False
+
+        for pc in region:
+            # shared with another subroutine
+            if coverage[pc] > 1:
+                return False
+
+            if any(pred not in region for pred in self.local_preds[pc]):
+                return False
+
+            if pc != entry and pc in self.callers:
+                return False
+
+            # a subroutine can only call other lifted subroutines
+            instr = self.instructions[pc]
+            if instr.op == Instruction.CAL and instr.addr not in self.subroutines:
+                return False
+
+        return True
+
+    def declare_subroutines(self, split:bool=False) -> None:
+        state_layout = self.state_layout()
+
+        self.subroutine_funcs = {}
+        for entry in self.subroutines:
+            func = ir.Function(
+                module = self.mod,
+                ftype  = ir.FunctionType(ir.VoidType(), [typ for _, typ in state_layout]),
+                name   = f"sub_{entry:04x}",
+            )
+            if not split:
+                func.linkage = "internal"
+            for arg, (name, _) in zip(func.args, state_layout):
+                arg.name = name
+                # every piece of state lives in its own alloca in main
+                arg.add_attribute("noalias")
+                arg.add_attribute("nocapture")
+
+            self.subroutine_funcs[entry] = func
+
+    def build_subroutine(self, entry) -> None:
+        func = self.subroutine_funcs[entry]
+
+        self.subroutine = entry
+        self.builder = ir.IRBuilder(func.append_basic_block(name = "entry"))
+        self.bind_state_pointers(func.args)
+
+        self.build_llvm_blocks(self.find_block_addrs())
+
+        self.builder.position_at_end(self.exit_block)
+        self.build_exit_routine()
+
+        self.builder.position_at_end(self.error_block)
+        self.build_error_routine()
+
+        self.builder.position_at_end(func.entry_basic_block)
+        self.builder.branch(self.blocks[entry])
+
+        for pc in self.subroutines[entry]:
+            self.translate_instruction(self.instructions[pc])
+
+        self.terminate_all_blocks()
+
+        if self.profile_data is not None:
+            self.layout_hot_blocks()
+
+    def find_return_targets(self) -> None:
+        self.return_targets = []
+
+        for instr in self.instructions:
+            if instr.op == Instruction.CAL and instr.addr not in self.subroutines:
+                self.return_targets.append(instr.pc + 1)
 
     def find_branch_targets(self) -> None:
         self.branch_targets = []
-        self.return_targets = []
 
         for instr in self.instructions:
             if instr.op == Instruction.JMP:
@@ -254,18 +732,313 @@ class Recompiler:
 
             elif instr.op == Instruction.CAL:
                 self.branch_targets.append(instr.addr)
-                self.return_targets.append(instr.pc + 1)
 
             elif instr.op == Instruction.RET:
                 # RET produces a block terminator, so a new block after it must be created
                 self.branch_targets.append(instr.pc + 1)
 
-            elif instr.op == Instruction.LOD:
+            # only the switch over the io ports splits the block, statically resolved accesses don't
+            elif instr.op == Instruction.LOD and self.needs_lod_dispatch(instr.pc):
                 self.branch_targets.append(instr.pc + 1)
 
-            elif instr.op == Instruction.STR:
+            elif instr.op == Instruction.STR and self.needs_str_dispatch(instr.pc):
                 self.branch_targets.append(instr.pc + 1)
 
+        # branch targets grouped by the translation context they belong to
+        self.context_targets = {}
+        for target in self.branch_targets:
+            self.context_targets.setdefault(self.owner_of(target), set()).add(target)
+
+    def instruction_successors(self, instr:Instruction) -> list[int]:
+        match instr.op:
+            case Instruction.HLT:
+                return []
+            case Instruction.JMP:
+                return [instr.addr]
+            case Instruction.BRH:
+                return [instr.addr, instr.pc + 1]
+            case Instruction.CAL:
+                # the instruction after the call is reached through the callee's RET
+                return [instr.addr]
+            case Instruction.RET:
+                # which call a RET returns from isn't known statically, so it can return to all of them
+                if self.owners[instr.pc] is not None:
+                    return self.subroutine_returns[self.owners[instr.pc]]
+                return self.return_targets
+            case _:
+                return [instr.pc + 1]
+
+    def analyze_register_ranges(self) -> None:
+        # forward dataflow analysis over the instruction graph,
+        # self.reg_ranges[pc] holds an inclusive (low, high) range for every register before instruction pc executes
+        # or None if pc is unreachable
+        self.reg_ranges = [None] * len(self.instructions)
+        if len(self.instructions) == 0:
+            self.address_ranges = []
+            return
+
+        # all registers start out as 0
+        self.reg_ranges[0] = ((0, 0),) * 16
+        growth = [0] * len(self.instructions)
+
+        worklist = [0]
+        while worklist:
+            pc = worklist.pop()
+            instr = self.instructions[pc]
+            state = self.transfer_register_ranges(instr, self.reg_ranges[pc])
+
+            for succ in self.instruction_successors(instr):
+                if succ >= len(self.instructions):
+                    continue
+
+                old = self.reg_ranges[succ]
+                if old is None:
+                    new = state
+                else:
+                    new = tuple(
+                        (min(a[0], b[0]), max(a[1], b[1]))
+                        for a, b in zip(old, state)
+                    )
+                    if new == old:
+                        continue
+
+                    growth[succ] += 1
+                    if growth[succ] > self.RANGE_WIDENING_LIMIT:
+                        new = tuple(
+                            new_range if new_range == old_range else (0, 255)
+                            for new_range, old_range in zip(new, old)
+                        )
+
+                self.reg_ranges[succ] = new
+                worklist.append(succ)
+
+        self.address_ranges = [None] * len(self.instructions)
+        for instr in self.instructions:
+            if instr.op in (Instruction.LOD, Instruction.STR) and self.reg_ranges[instr.pc] is not None:
+                self.address_ranges[instr.pc] = self.add_ranges(
+                    self.reg_ranges[instr.pc][instr.reg_a],
+                    (instr.off & 0xff, instr.off & 0xff),
+                )
+
+    def transfer_register_ranges(self, instr:Instruction, state:tuple) -> tuple:
+        full = (0, 255)
+        result = None
+        dest = None
+
+        ra = state[instr.reg_a]
+        rb = state[instr.reg_b]
+
+        match instr.op:
+            case Instruction.ADD:
+                dest = instr.reg_c
+                result = self.add_ranges(ra, rb)
+            case Instruction.SUB:
+                dest = instr.reg_c
+                result = self.add_ranges(ra, ((-rb[1]) & 0xff, (-rb[0]) & 0xff) if rb[0] > 0 or rb[1] == 0 else full)
+            case Instruction.NOR:
+                dest = instr.reg_c
+                result = full
+                if ra[0] == ra[1] and rb[0] == rb[1]:
+                    result = (~(ra[0] | rb[0]) & 0xff,) * 2
+            case Instruction.AND:
+                dest = instr.reg_c
+                result = (0, min(ra[1], rb[1]))
+                if ra[0] == ra[1] and rb[0] == rb[1]:
+                    result = (ra[0] & rb[0],) * 2
+            case Instruction.XOR:
+                dest = instr.reg_c
+                result = (0, (1 << max(ra[1], rb[1]).bit_length()) - 1)
+                if ra[0] == ra[1] and rb[0] == rb[1]:
+                    result = (ra[0] ^ rb[0],) * 2
+                elif ra == (0, 0):
+                    result = rb
+                elif rb == (0, 0):
+                    result = ra
+            case Instruction.RSH:
+                dest = instr.reg_c
+                result = (ra[0] >> 1, ra[1] >> 1)
+            case Instruction.LDI:
+                dest = instr.reg_a
+                result = (instr.imm, instr.imm)
+            case Instruction.ADI:
+                dest = instr.reg_a
+                result = self.add_ranges(ra, (instr.imm, instr.imm))
+            case Instruction.LOD:
+                dest = instr.reg_b
+                result = full
+
+        # writes to r0 are discarded
+        if not dest:
+            return state
+
+        return state[:dest] + (result,) + state[dest+1:]
+
+    @staticmethod
+    def add_ranges(a:tuple, b:tuple) -> tuple:
+        # 8 bit wrapping addition of two ranges, ranges that only partially wrap around become the full range
+        low  = a[0] + b[0]
+        high = a[1] + b[1]
+        if high <= 255:
+            return (low, high)
+        if low >= 256:
+            return (low - 256, high - 256)
+        return (0, 255)
+
+    def needs_lod_dispatch(self, pc) -> bool:
+        addr_range = self.address_ranges[pc]
+        if addr_range is None:
+            return False
+
+        low, high = addr_range
+        if low == high:
+            return False
+        return any(low <= port <= high for port in self.LOD_PORTS)
+
+    def needs_str_dispatch(self, pc) -> bool:
+        addr_range = self.address_ranges[pc]
+        if addr_range is None:
+            return False
+
+        low, high = addr_range
+        if low == high:
+            # storing to an unmapped io port raises an error, which is left to the switch
+            return low >= 240 and low not in self.STR_PORTS
+        return high >= 240
+
+    def analyze_flag_liveness(self) -> None:
+        # backwards dataflow analysis over the instruction graph,
+        # self.live_flags[pc] holds the flags that are still read after instruction pc executed
+        flag_uses = []
+        flag_defs = []
+        for instr in self.instructions:
+            uses = 0
+            defs = 0
+            if instr.op == Instruction.BRH:
+                uses = self.FLAG_Z if instr.cond in (0, 1) else self.FLAG_C
+            elif instr.op in (Instruction.ADD, Instruction.SUB, Instruction.ADI):
+                defs = self.FLAG_Z | self.FLAG_C
+            elif instr.op in (Instruction.NOR, Instruction.AND, Instruction.XOR):
+                defs = self.FLAG_Z
+
+            flag_uses.append(uses)
+            flag_defs.append(defs)
+
+        successors = [
+            [succ for succ in self.instruction_successors(instr) if succ < len(self.instructions)]
+            for instr in self.instructions
+        ]
+
+        live_in  = [0] * len(self.instructions)
+        live_out = [0] * len(self.instructions)
+
+        changed = True
+        while changed:
+            changed = False
+            for pc in reversed(range(len(self.instructions))):
+                out = 0
+                for succ in successors[pc]:
+                    out |= live_in[succ]
+
+                in_ = flag_uses[pc] | (out & ~flag_defs[pc])
+                if out != live_out[pc] or in_ != live_in[pc]:
+                    live_out[pc] = out
+                    live_in[pc]  = in_
+                    changed = True
+
+        self.live_flags = live_out
+
+    def find_idioms(self) -> None:
+        # recognizes common instruction sequences before translation, so they can be lowered with what they mean
+        # instead of instruction by instruction,
+        # self.idioms maps the first pc of every idiom to its description and self.fused_pcs holds the pcs it covers after that
+        self.idioms = {}
+        self.fused_pcs = set()
+
+        # an idiom can't extend into another block, as that block can also be entered from somewhere else
+        block_starts = {0} | set(self.return_targets) | set(self.branch_targets)
+
+        def continues_block(pc):
+            return (
+                pc < len(self.instructions)
+                and pc not in block_starts
+                and self.owners[pc] == self.owners[pc-1]
+            )
+
+        pc = 0
+        while pc < len(self.instructions):
+            instr = self.instructions[pc]
+            length = 1
+
+            multiply = self.find_multiply(pc, continues_block) if instr.op == Instruction.ADD and instr.reg_a == instr.reg_b != 0 else None
+            if multiply is not None:
+                self.idioms[pc] = multiply
+                length = multiply[1]
+
+            elif instr.op == Instruction.ADD and instr.reg_a == instr.reg_b == instr.reg_c != 0:
+                # add rX rX rX doubles rX, a run of them is a single shift
+                # (the flags of all but the last one are overwritten right away)
+                while (
+                    length < 7
+                    and continues_block(pc + length)
+                    and self.instructions[pc + length].op == Instruction.ADD
+                    and self.instructions[pc + length].reg_a == self.instructions[pc + length].reg_b == self.instructions[pc + length].reg_c == instr.reg_a
+                ):
+                    length += 1
+
+                if length > 1:
+                    self.idioms[pc] = ("double", length)
+
+            elif instr.op in (Instruction.ADD, Instruction.SUB, Instruction.XOR) and 0 in (instr.reg_a, instr.reg_b) and not (instr.op == Instruction.SUB and instr.reg_b != 0):
+                # adding, subtracting or xoring r0 moves a register, the carry of that is constant
+                src = instr.reg_a if instr.reg_b == 0 else instr.reg_b
+                carry = {Instruction.ADD: 0, Instruction.SUB: 1, Instruction.XOR: None}[instr.op]
+                self.idioms[pc] = ("move", src, instr.reg_c, carry)
+
+            elif instr.op in (Instruction.SUB, Instruction.AND, Instruction.XOR, Instruction.ADI) and continues_block(pc + 1):
+                # a flag setting instruction directly followed by a branch on that flag is a compare (or a counted loop with adi 255),
+                # the branch can test the operands instead of the flag
+                brh = self.instructions[pc + 1]
+                sets_flag = instr.op in (Instruction.SUB, Instruction.ADI) or brh.cond in (0, 1)
+                if brh.op == Instruction.BRH and sets_flag:
+                    self.idioms[pc] = ("branch", brh)
+                    length = 2
+
+            self.fused_pcs.update(range(pc + 1, pc + length))
+            pc += length
+
+    def find_multiply(self, start, continues_block):
+        # a shift/add multiply starts by doubling rX, and adds up registers that only hold multiples of rX from there on
+        # (eg. add r1 r1 r2, add r2 r2 r3, add r3 r2 r1 is r1 * 6), so every register it writes holds a constant times rX.
+        # factors maps every register to the factor its value is of the value rX had at the start
+        src = self.instructions[start].reg_a
+        factors = {0: 0, src: 1}
+        written = []
+        last_factors = None
+
+        pc = start
+        while pc < len(self.instructions) and (pc == start or continues_block(pc)):
+            instr = self.instructions[pc]
+            if instr.op != Instruction.ADD or instr.reg_a not in factors or instr.reg_b not in factors:
+                break
+
+            last_factors = (factors[instr.reg_a], factors[instr.reg_b])
+            if instr.reg_c != 0:
+                factors[instr.reg_c] = sum(last_factors) & 0xff
+                if instr.reg_c not in written:
+                    written.append(instr.reg_c)
+            pc += 1
+
+        length = pc - start
+        doubling = all(
+            self.instructions[i].reg_a == self.instructions[i].reg_b == self.instructions[i].reg_c == src
+            for i in range(start, pc)
+        )
+
+        # a single add is translated as it is, and runs of add rX rX rX are the shift of the double idiom
+        if length < 2 or doubling:
+            return None
+        return ("multiply", length, src, tuple((reg, factors[reg]) for reg in written), last_factors)
+
     def init_llvm_builder(self) -> None:
         main_func = ir.Function(
             module = self.mod,
@@ -276,58 +1049,227 @@ class Recompiler:
         self.entry = main_func.append_basic_block(name = "entry")
         self.builder = ir.IRBuilder(self.entry)
 
-    def build_llvm_blocks(self) -> None:
+    def find_block_addrs(self) -> list[int]:
+        # block addresses of the current translation context
+        if self.subroutine is None:
+            block_addrs = {0} | set(self.return_targets)
+        else:
+            block_addrs = {self.subroutine}
+
+        block_addrs |= self.context_targets.get(self.subroutine, set())
+
+        # code right after another context's code can't be fallen into, so it has to start its own block
+        for pc in self.context_pcs[self.subroutine]:
+            if pc > 0 and self.owners[pc-1] != self.subroutine:
+                block_addrs.add(pc)
+
+        # sorting the blocks isn't strictly necessary, but makes the emitted llvmir make more sense
+        return sorted(block_addrs)
+
+    @staticmethod
+    def block_key(addr) -> str:
+        return f"block_{addr:04x}"
+
+    @staticmethod
+    def edge_key(pc, target) -> str:
+        return f"edge_{pc:04x}_{target:04x}"
+
+    def declare_profile_counters(self) -> None:
+        # one counter per block address, blocks of different contexts at the same address share it
+        block_addrs = set()
+        for context in [None, *self.subroutines]:
+            self.subroutine = context
+            block_addrs.update(self.find_block_addrs())
+        self.subroutine = None
+
+        keys = [self.block_key(addr) for addr in sorted(block_addrs)]
+
+        # and one per control flow edge that depends on the machine state, keyed by the instruction and its target
+        for instr in self.instructions:
+            if instr.op == Instruction.BRH:
+                keys.append(self.edge_key(instr.pc, instr.addr))
+                keys.append(self.edge_key(instr.pc, instr.pc + 1))
+            elif instr.op == Instruction.RET and self.owners[instr.pc] is None:
+                keys.extend(self.edge_key(instr.pc, target) for target in self.return_targets)
+
+        keys = list(dict.fromkeys(keys))
+        self.profile_slots = {key: slot for slot, key in enumerate(keys)}
+
+        counts_type = ir.ArrayType(ir.IntType(64), len(keys))
+        self.profile_counts = ir.GlobalVariable(self.mod, counts_type, name="profile_counts")
+        self.profile_counts.linkage = "internal"
+        self.profile_counts.initializer = ir.Constant(counts_type, None)
+
+        # the keys are stored back to back in one string, which the key pointers point into
+        key_string = bytearray()
+        key_offsets = []
+        for key in keys:
+            key_offsets.append(len(key_string))
+            key_string += key.encode() + b"\0"
+
+        self.profile_key_string = self.declare_string_constant("profile_key_string", key_string)
+
+        keys_type = ir.ArrayType(ir.PointerType(ir.IntType(8)), len(keys))
+        self.profile_keys = ir.GlobalVariable(self.mod, keys_type, name="profile_keys")
+        self.profile_keys.linkage = "internal"
+        self.profile_keys.global_constant = True
+        self.profile_keys.initializer = ir.Constant(keys_type, [
+            self.profile_key_string.gep([ir.Constant(ir.IntType(32), 0), ir.Constant(ir.IntType(32), offset)])
+            for offset in key_offsets
+        ])
+
+        self.profile_path = self.declare_string_constant("profile_path", bytearray(self.profile.encode() + b"\0"))
+
+    def declare_string_constant(self, name, data:bytearray) -> ir.GlobalVariable:
+        string_type = ir.ArrayType(ir.IntType(8), len(data))
+        string = ir.GlobalVariable(self.mod, string_type, name=name)
+        string.linkage = "internal"
+        string.global_constant = True
+        string.initializer = ir.Constant(string_type, data)
+        return string
+
+    def increment_counter(self, builder, key, amount=None) -> None:
+        counter = builder.gep(
+            self.profile_counts,
+            [ir.Constant(ir.IntType(32), 0), ir.Constant(ir.IntType(32), self.profile_slots[key])],
+        )
+        builder.store(
+            builder.add(
+                builder.load(counter),
+                amount if amount is not None else ir.Constant(ir.IntType(64), 1),
+            ),
+            counter,
+        )
+
+    @staticmethod
+    def branch_weights(counts:list[int]) -> list[int]:
+        # branch weights are 32 bit, so large counts are scaled down (rounding up, so executed edges never get a weight of 0)
+        scale = max(1, -(-max(counts) // 0xffffffff))
+        return [-(-count // scale) for count in counts]
+
+    def layout_hot_blocks(self) -> None:
+        # starting at the entry of the context, the hottest not yet placed successor of the last placed block is placed next,
+        # so the hot path through every loop ends up contiguous (and in the same order the profile ran through it),
+        # blocks that never ran keep their order behind the hot ones
+        func = self.exit_block.parent
+        guest_blocks = {block: addr for addr, block in self.blocks.items()}
+
+        def heat(block):
+            return self.profile_data.get(self.block_key(guest_blocks[block]), 0)
+
+        by_heat = sorted(self.blocks.values(), key=heat, reverse=True)
+        placed = {func.entry_basic_block, self.exit_block, self.error_block}
+        order = []
+
+        block = self.blocks[0 if self.subroutine is None else self.subroutine]
+        while block is not None:
+            successors, helpers = self.block_successors(block, guest_blocks)
+
+            # the blocks of a LOD/STR/RET dispatch stay right behind the block they belong to
+            for b in [block, *helpers]:
+                if b not in placed:
+                    placed.add(b)
+                    order.append(b)
+
+            hot = [b for b in successors if b not in placed and heat(b) > 0]
+            if hot:
+                block = max(hot, key=heat)
+            else:
+                block = next((b for b in by_heat if b not in placed and heat(b) > 0), None)
+
+        func.blocks = [func.entry_basic_block, *order, *[b for b in func.blocks if b not in placed], self.exit_block, self.error_block]
+
+    def block_successors(self, block, guest_blocks) -> tuple[list, list]:
+        # the guest blocks a block branches to, looking through the helper blocks its dispatches branch through
+        successors = []
+        helpers = []
+
+        seen = {block}
+        pending = [block]
+        while pending:
+            terminator = pending.pop(0).terminator
+
+            if isinstance(terminator, ir.SwitchInstr):
+                targets = [terminator.default, *[target for _, target in terminator.cases]]
+            elif terminator is not None:
+                targets = [op for op in terminator.operands if isinstance(op, ir.Block)]
+            else:
+                targets = []
+
+            for target in targets:
+                if target in seen or target in (self.exit_block, self.error_block):
+                    continue
+                seen.add(target)
+
+                if target in guest_blocks:
+                    successors.append(target)
+                else:
+                    helpers.append(target)
+                    pending.append(target)
+
+        return successors, helpers
+
+    def owner_of(self, addr):
+        if addr >= len(self.instructions):
+            return None
+        return self.owners[addr]
+
+    def build_llvm_blocks(self, block_addrs:list[int]) -> None:
         self.exit_block  = self.builder.append_basic_block(name = "exit_block")
         self.error_block = self.builder.append_basic_block(name = "error_block")
 
         self.blocks = {}
 
-        zero_block = self.builder.append_basic_block(name = f"block_{0:04x}")
-        self.blocks.update({0: zero_block})
+        for addr in block_addrs:
+            block = self.builder.append_basic_block(name = f"block_{addr:04x}")
+            self.blocks.update({addr: block})
 
-        # sorting the blocks isn't strictly necessary, but makes the emitted llvmir make more sense
-        all_targets = sorted(list(set(self.branch_targets) | set(self.return_targets)))
-        for target in all_targets:
-            block = self.builder.append_basic_block(name = f"block_{target:04x}")
-            self.blocks.update({target: block})
+            if self.profile is not None:
+                # emitted before any instruction is translated into the block
+                self.increment_counter(ir.IRBuilder(block), self.block_key(addr))
+
+        # the block every instruction of the context is translated into and the block that follows it,
+        # built once so translating an instruction doesn't have to search the blocks
+        self.closest_blocks = {}
+        self.next_blocks = {}
+
+        block_idx = 0
+        closest_block = None
+        for pc in self.context_pcs[self.subroutine]:
+            while block_idx < len(block_addrs) and block_addrs[block_idx] <= pc:
+                closest_block = self.blocks[block_addrs[block_idx]]
+                block_idx += 1
+
+            self.closest_blocks[pc] = closest_block
+            if block_idx < len(block_addrs):
+                self.next_blocks[pc] = self.blocks[block_addrs[block_idx]]
+            else:
+                self.next_blocks[pc] = self.exit_block
 
     def terminate_all_blocks(self) -> None:
         block_addrs = sorted(list(self.blocks.keys()))
         for idx in range(len(block_addrs)):
-            if idx >= len(block_addrs) - 1:
-                if not self.blocks[block_addrs[idx]].is_terminated:
-                    self.builder.position_at_end(self.blocks[block_addrs[idx]])
-                    self.builder.branch(self.exit_block)
-            if not self.blocks[block_addrs[idx]].is_terminated:
-                self.builder.position_at_end(self.blocks[block_addrs[idx]])
-                self.builder.branch(self.blocks[block_addrs[idx+1]])
+            if self.blocks[block_addrs[idx]].is_terminated:
+                continue
+
+            # find where the last instruction of the block falls through to
+            next_pc = block_addrs[idx]
+            next_addr = block_addrs[idx+1] if idx < len(block_addrs) - 1 else None
+            while next_pc != next_addr and self.owner_of(next_pc) == self.subroutine and next_pc < len(self.instructions):
+                next_pc += 1
+
+            self.builder.position_at_end(self.blocks[block_addrs[idx]])
+            if next_pc == next_addr:
+                self.builder.branch(self.blocks[next_addr])
+            else:
+                # falls off the end of the program (or the instruction before is a HLT)
+                self.builder.branch(self.exit_block)
 
     def find_closest_block(self, target_addr):
-        closest_addr  = 0
-        closest_block = self.blocks[0]
-        for addr, block in sorted(self.blocks.items(), key=lambda item: item[0]):
-            if addr > target_addr:
-                break
-
-            closest_addr  = addr
-            closest_block = block
-
-        return closest_block
+        return self.closest_blocks[target_addr]
 
     def find_next_closest_block(self, target_addr):
-        closest_addr = 0
-        block_idx = 0
-        block_addrs = list(self.blocks.keys())
-        while block_idx < len(block_addrs):
-            if block_addrs[block_idx] > target_addr:
-                break
-
-            block_idx += 1
-
-        if block_idx == len(block_addrs) - 1:
-            return self.exit_block
-
-        return self.blocks[block_addrs[block_idx]]
+        return self.next_blocks[target_addr]
 
     def position_at_end_of_closest_block(self, target_addr) -> None:
         closest_block = self.find_closest_block(target_addr)
@@ -338,6 +1280,13 @@ class Recompiler:
         self.ram   = self.builder.alloca(ir.IntType(8),  size=256, name="ram")
         self.stack = self.builder.alloca(ir.IntType(16), size=16,  name="stack")
         self.sp    = self.builder.alloca(ir.IntType(8),  name="sp")
+
+        # the ram starts out zeroed like in the interpreter, reading uninitialized memory would be undefined
+        ram_type = ir.ArrayType(ir.IntType(8), 256)
+        self.builder.store(
+            ir.Constant(ram_type, None),
+            self.builder.bitcast(self.ram, ir.PointerType(ram_type)),
+        )
         self.builder.store(ir.Constant(ir.IntType(8), 0), self.sp)
 
         self.regs = []
@@ -359,6 +1308,36 @@ class Recompiler:
         self.builder.store(ir.Constant(ir.IntType(8), 0), self.pixel_x)
         self.builder.store(ir.Constant(ir.IntType(8), 0), self.pixel_y)
 
+    def state_layout(self) -> list[tuple]:
+        # the machine state shared between main and the lifted subroutines, in argument order
+        return [
+            ("ram",   ir.PointerType(ir.IntType(8))),
+            ("stack", ir.PointerType(ir.IntType(16))),
+            ("sp",    ir.PointerType(ir.IntType(8))),
+            *[(f"r{r_idx}", ir.PointerType(ir.IntType(8))) for r_idx in range(16)],
+            ("flag_Z",  ir.PointerType(ir.IntType(1))),
+            ("flag_C",  ir.PointerType(ir.IntType(1))),
+            ("pixel_x", ir.PointerType(ir.IntType(8))),
+            ("pixel_y", ir.PointerType(ir.IntType(8))),
+        ]
+
+    def state_pointers(self) -> list:
+        return [
+            self.ram,
+            self.stack,
+            self.sp,
+            *self.regs,
+            self.flag_Z,
+            self.flag_C,
+            self.pixel_x,
+            self.pixel_y,
+        ]
+
+    def bind_state_pointers(self, pointers) -> None:
+        self.ram, self.stack, self.sp = pointers[:3]
+        self.regs = list(pointers[3:19])
+        self.flag_Z, self.flag_C, self.pixel_x, self.pixel_y = pointers[19:]
+
     def init_runtime(self) -> None:
         if self.headless:
             self.builder.call(
@@ -366,12 +1345,124 @@ class Recompiler:
                 [],
             )
 
+        elif self.render_thread:
+            self.builder.call(
+                self.funcs["init_render_thread"],
+                [],
+            )
+
         else:
             self.builder.call(
                 self.funcs["init"],
                 [],
             )
 
+        if not self.headless and self.present_rate is not None:
+            self.builder.call(
+                self.funcs["set_present_rate"],
+                [ir.Constant(ir.IntType(32), self.present_rate)],
+            )
+
+        if self.headless and self.framebuffer is not None:
+            path = self.declare_string_constant("framebuffer_path", bytearray(self.framebuffer.encode() + b"\0"))
+            zero = ir.Constant(ir.IntType(32), 0)
+            self.builder.call(
+                self.funcs["init_headless_framebuffer"],
+                [
+                    self.builder.gep(path, [zero, zero]),
+                    ir.Constant(ir.IntType(32), self.framebuffer_slots),
+                ],
+            )
+
+        for name, path in (("record", self.record_input), ("replay", self.replay_input)):
+            if path is not None:
+                path_constant = self.declare_string_constant(f"input_{name}_path", bytearray(path.encode() + b"\0"))
+                zero = ir.Constant(ir.IntType(32), 0)
+                self.builder.call(
+                    self.funcs[f"init_input_{name}"],
+                    [self.builder.gep(path_constant, [zero, zero])],
+                )
+
+        if self.profile is not None:
+            # the helper functions write the counts out from their deinit routines
+            zero = ir.Constant(ir.IntType(32), 0)
+            self.builder.call(
+                self.funcs["set_profile"],
+                [
+                    self.builder.gep(self.profile_path,   [zero, zero]),
+                    self.builder.gep(self.profile_keys,   [zero, zero]),
+                    self.builder.gep(self.profile_counts, [zero, zero]),
+                    ir.Constant(ir.IntType(64), len(self.profile_slots)),
+                ],
+            )
+
+    def emulates_screen(self) -> bool:
+        return not self.headless or self.framebuffer is not None
+
+    def traces_input(self) -> bool:
+        # the controller trace has one entry per frame, so every frame has to be counted
+        return self.record_input is not None or self.replay_input is not None
+
+    def screen_func(self, name) -> ir.Function:
+        # headless runs with a framebuffer use the variants that write to the ring file instead of the window
+        if self.headless:
+            return self.funcs[f"{name}_headless"]
+        return self.funcs[name]
+
+    def declare_screen_bitmap(self, split:bool=False, defined:bool=True) -> None:
+        # the screen is owned by the generated code, as a packed bitmap where bit x of row y is the pixel at (x, y),
+        # the helper functions only get to see it when a frame is presented
+        bitmap_type = ir.ArrayType(ir.IntType(32), 32)
+        self.screen_bitmap = ir.GlobalVariable(self.mod, bitmap_type, name="screen_bitmap")
+        if not split:
+            self.screen_bitmap.linkage = "internal"
+        # split modules share the one defined next to main
+        if defined:
+            self.screen_bitmap.initializer = ir.Constant(bitmap_type, None)
+
+    def declare_rng_state(self, split:bool=False, defined:bool=True) -> None:
+        # xorshift32 gets stuck on 0, so a zero seed is replaced by the same fixed nonzero one as in the interpreter
+        state = self.seed & 0xffffffff
+        self.rng_state = ir.GlobalVariable(self.mod, ir.IntType(32), name="rng_state")
+        if not split:
+            self.rng_state.linkage = "internal"
+        if defined:
+            self.rng_state.initializer = ir.Constant(ir.IntType(32), state if state != 0 else ZERO_SEED_STATE)
+
+    def inline_random_num(self) -> ir.Value:
+        # the low byte of the new state is the random number, bit for bit the sequence interp.py produces for the same seed
+        state = self.builder.load(self.rng_state)
+        for op, shift in ((self.builder.shl, 13), (self.builder.lshr, 17), (self.builder.shl, 5)):
+            state = self.builder.xor(state, op(state, ir.Constant(ir.IntType(32), shift)))
+        self.builder.store(state, self.rng_state)
+
+        return self.builder.trunc(state, ir.IntType(8))
+
+    def screen_pixel(self) -> tuple:
+        # the row of the current pixel and the mask of its bit in it, the mask is 0 for pixels outside of the screen
+        x = self.builder.load(self.pixel_x)
+        y = self.builder.load(self.pixel_y)
+
+        on_screen = self.builder.and_(
+            self.builder.icmp_unsigned("<", x, ir.Constant(ir.IntType(8), 32)),
+            self.builder.icmp_unsigned("<", y, ir.Constant(ir.IntType(8), 32)),
+        )
+
+        row_ptr = self.builder.gep(
+            self.screen_bitmap,
+            [
+                ir.Constant(ir.IntType(32), 0),
+                self.builder.zext(self.builder.and_(y, ir.Constant(ir.IntType(8), 31)), ir.IntType(32)),
+            ],
+        )
+        bit = self.builder.shl(
+            ir.Constant(ir.IntType(32), 1),
+            self.builder.zext(self.builder.and_(x, ir.Constant(ir.IntType(8), 31)), ir.IntType(32)),
+        )
+        mask = self.builder.select(on_screen, bit, ir.Constant(ir.IntType(32), 0))
+
+        return row_ptr, mask
+
     def build_exit_routine(self) -> None:
         if self.headless:
             self.builder.call(
@@ -383,14 +1474,22 @@ class Recompiler:
                 self.funcs["deinit"],
                 [],
             )
-        self.builder.ret(ir.Constant(ir.IntType(32), 0))
+
+        if self.subroutine is None:
+            self.builder.ret(ir.Constant(ir.IntType(32), 0))
+        else:
+            self.builder.ret_void()
 
     def build_error_routine(self) -> None:
         self.builder.call(
             self.funcs["raise_error"],
             [],
         )
-        self.builder.ret(ir.Constant(ir.IntType(32), 1))
+
+        if self.subroutine is None:
+            self.builder.ret(ir.Constant(ir.IntType(32), 1))
+        else:
+            self.builder.ret_void()
 
     def instr_hlt(self) -> None:
         if self.headless:
@@ -404,7 +1503,7 @@ class Recompiler:
                 [],
             )
 
-    def instr_add(self, ra, rb, rc) -> None:
+    def instr_add(self, ra, rb, rc, live_flags) -> None:
         ra_val = self.builder.load(self.regs[ra])
         sum_ = self.builder.add(
             ra_val,
@@ -417,24 +1516,27 @@ class Recompiler:
                 self.regs[rc]
             )
 
-        self.builder.store(
-            self.builder.icmp_unsigned(
-                "==",
-                sum_,
-                ir.Constant(ir.IntType(8), 0)
-            ),
-            self.flag_Z
-        )
-        self.builder.store(
-            self.builder.icmp_unsigned(
-                "<",
-                sum_,
-                ra_val,
-            ),
-            self.flag_C
-        )
+        if live_flags & self.FLAG_Z:
+            self.builder.store(
+                self.builder.icmp_unsigned(
+                    "==",
+                    sum_,
+                    ir.Constant(ir.IntType(8), 0)
+                ),
+                self.flag_Z
+            )
 
-    def instr_sub(self, ra, rb, rc) -> None:
+        if live_flags & self.FLAG_C:
+            self.builder.store(
+                self.builder.icmp_unsigned(
+                    "<",
+                    sum_,
+                    ra_val,
+                ),
+                self.flag_C
+            )
+
+    def instr_sub(self, ra, rb, rc, live_flags) -> None:
         ra_val = self.builder.load(self.regs[ra])
         diff = self.builder.sub(
             ra_val,
@@ -447,24 +1549,27 @@ class Recompiler:
                 self.regs[rc],
             )
 
-        self.builder.store(
-            self.builder.icmp_unsigned(
-                "==",
-                diff,
-                ir.Constant(ir.IntType(8), 0)
-            ),
-            self.flag_Z,
-        )
-        self.builder.store(
-            self.builder.icmp_unsigned(
-                "<=",
-                diff,
-                ra_val,
-            ),
-            self.flag_C
-        )
+        if live_flags & self.FLAG_Z:
+            self.builder.store(
+                self.builder.icmp_unsigned(
+                    "==",
+                    diff,
+                    ir.Constant(ir.IntType(8), 0)
+                ),
+                self.flag_Z,
+            )
+
+        if live_flags & self.FLAG_C:
+            self.builder.store(
+                self.builder.icmp_unsigned(
+                    "<=",
+                    diff,
+                    ra_val,
+                ),
+                self.flag_C
+            )
 
-    def instr_nor(self, ra, rb, rc) -> None:
+    def instr_nor(self, ra, rb, rc, live_flags) -> None:
         res = self.builder.not_(
             self.builder.or_(
                 self.builder.load(self.regs[ra]),
@@ -478,16 +1583,17 @@ class Recompiler:
                 self.regs[rc]
             )
 
-        self.builder.store(
-            self.builder.icmp_unsigned(
-                "==",
-                res,
-                ir.Constant(ir.IntType(8), 0),
-            ),
-            self.flag_Z
-        )
+        if live_flags & self.FLAG_Z:
+            self.builder.store(
+                self.builder.icmp_unsigned(
+                    "==",
+                    res,
+                    ir.Constant(ir.IntType(8), 0),
+                ),
+                self.flag_Z
+            )
 
-    def instr_and(self, ra, rb, rc) -> None:
+    def instr_and(self, ra, rb, rc, live_flags) -> None:
         res = self.builder.and_(
             self.builder.load(self.regs[ra]),
             self.builder.load(self.regs[rb]),
@@ -499,16 +1605,17 @@ class Recompiler:
                 self.regs[rc],
             )
 
-        self.builder.store(
-            self.builder.icmp_unsigned(
-                "==",
-                res,
-                ir.Constant(ir.IntType(8), 0),
-            ),
-            self.flag_Z
-        )
+        if live_flags & self.FLAG_Z:
+            self.builder.store(
+                self.builder.icmp_unsigned(
+                    "==",
+                    res,
+                    ir.Constant(ir.IntType(8), 0),
+                ),
+                self.flag_Z
+            )
 
-    def instr_xor(self, ra, rb, rc) -> None:
+    def instr_xor(self, ra, rb, rc, live_flags) -> None:
         res = self.builder.xor(
             self.builder.load(self.regs[ra]),
             self.builder.load(self.regs[rb]),
@@ -520,14 +1627,15 @@ class Recompiler:
                 self.regs[rc],
             )
 
-        self.builder.store(
-            self.builder.icmp_unsigned(
-                "==",
-                res,
-                ir.Constant(ir.IntType(8), 0),
-            ),
-            self.flag_Z
-        )
+        if live_flags & self.FLAG_Z:
+            self.builder.store(
+                self.builder.icmp_unsigned(
+                    "==",
+                    res,
+                    ir.Constant(ir.IntType(8), 0),
+                ),
+                self.flag_Z
+            )
 
     def instr_rsh(self, ra, rc) -> None:
         res = self.builder.lshr(
@@ -550,7 +1658,7 @@ class Recompiler:
             self.regs[reg],
         )
 
-    def instr_adi(self, reg, imm) -> None:
+    def instr_adi(self, reg, imm, live_flags) -> None:
         reg_val = self.builder.load(self.regs[reg])
         res = self.builder.add(
             reg_val,
@@ -563,30 +1671,182 @@ class Recompiler:
                 self.regs[reg],
             )
 
-        self.builder.store(
-            self.builder.icmp_unsigned(
-                "==",
-                res,
-                ir.Constant(ir.IntType(8), 0),
-            ),
-            self.flag_Z
+        if live_flags & self.FLAG_Z:
+            self.builder.store(
+                self.builder.icmp_unsigned(
+                    "==",
+                    res,
+                    ir.Constant(ir.IntType(8), 0),
+                ),
+                self.flag_Z
+            )
+
+        if live_flags & self.FLAG_C:
+            self.builder.store(
+                self.builder.icmp_unsigned(
+                    "<",
+                    res,
+                    reg_val,
+                ),
+                self.flag_C
+            )
+
+    def idiom_move(self, src, dest, carry, live_flags) -> None:
+        val = self.builder.load(self.regs[src])
+
+        if dest != 0:
+            self.builder.store(
+                val,
+                self.regs[dest],
+            )
+
+        if live_flags & self.FLAG_Z:
+            self.builder.store(
+                self.builder.icmp_unsigned(
+                    "==",
+                    val,
+                    ir.Constant(ir.IntType(8), 0),
+                ),
+                self.flag_Z
+            )
+
+        if live_flags & self.FLAG_C and carry is not None:
+            self.builder.store(
+                ir.Constant(ir.IntType(1), carry),
+                self.flag_C
+            )
+
+    def idiom_double(self, reg, count, live_flags) -> None:
+        # count times add reg reg reg, with the flags of the last one
+        reg_val = self.builder.load(self.regs[reg])
+        res = self.builder.shl(
+            reg_val,
+            ir.Constant(ir.IntType(8), count),
         )
 
         self.builder.store(
-            self.builder.icmp_unsigned(
-                "<",
-                res,
-                reg_val,
-            ),
-            self.flag_C
+            res,
+            self.regs[reg],
         )
 
-    def instr_jmp(self, addr) -> None:
+        if live_flags & self.FLAG_Z:
+            self.builder.store(
+                self.builder.icmp_unsigned(
+                    "==",
+                    res,
+                    ir.Constant(ir.IntType(8), 0),
+                ),
+                self.flag_Z
+            )
+
+        if live_flags & self.FLAG_C:
+            # the bit the last add shifts out
+            self.builder.store(
+                self.builder.trunc(
+                    self.builder.lshr(
+                        reg_val,
+                        ir.Constant(ir.IntType(8), 8 - count),
+                    ),
+                    ir.IntType(1),
+                ),
+                self.flag_C
+            )
+
+    def idiom_multiply(self, src, products, last_factors, live_flags) -> None:
+        # every register written by the sequence gets its product of src, the flags are those of its last add
+        src_val = self.builder.load(self.regs[src])
+
+        def times(factor):
+            return self.builder.mul(
+                src_val,
+                ir.Constant(ir.IntType(8), factor),
+            )
+
+        for reg, factor in products:
+            self.builder.store(
+                times(factor),
+                self.regs[reg],
+            )
+
+        if live_flags & self.FLAG_Z:
+            self.builder.store(
+                self.builder.icmp_unsigned(
+                    "==",
+                    times(sum(last_factors) & 0xff),
+                    ir.Constant(ir.IntType(8), 0),
+                ),
+                self.flag_Z
+            )
+
+        if live_flags & self.FLAG_C:
+            # the last add carries if its result wrapped around below its first operand
+            first = times(last_factors[0])
+            self.builder.store(
+                self.builder.icmp_unsigned(
+                    "<",
+                    self.builder.add(first, times(last_factors[1])),
+                    first,
+                ),
+                self.flag_C
+            )
+
+    def idiom_branch(self, instr:Instruction, brh:Instruction) -> None:
+        # the condition is computed from the operands before the instruction overwrites them
+        ra_val = self.builder.load(self.regs[instr.reg_a])
+
+        match instr.op:
+            case Instruction.SUB:
+                rb_val = self.builder.load(self.regs[instr.reg_b])
+                if brh.cond in (0, 1):
+                    flag = self.builder.icmp_unsigned("==", ra_val, rb_val)
+                else:
+                    flag = self.builder.icmp_unsigned(">=", ra_val, rb_val)
+            case Instruction.AND:
+                flag = self.builder.icmp_unsigned(
+                    "==",
+                    self.builder.and_(ra_val, self.builder.load(self.regs[instr.reg_b])),
+                    ir.Constant(ir.IntType(8), 0),
+                )
+            case Instruction.XOR:
+                flag = self.builder.icmp_unsigned("==", ra_val, self.builder.load(self.regs[instr.reg_b]))
+            case Instruction.ADI:
+                # ra + imm wraps to 0 exactly for ra == -imm, and carries for ra >= 256 - imm
+                if brh.cond in (0, 1):
+                    flag = self.builder.icmp_unsigned("==", ra_val, ir.Constant(ir.IntType(8), -instr.imm & 0xff))
+                elif instr.imm == 0:
+                    flag = ir.Constant(ir.IntType(1), 0)
+                else:
+                    flag = self.builder.icmp_unsigned(">=", ra_val, ir.Constant(ir.IntType(8), 256 - instr.imm))
+
+        val = flag if brh.cond in (0, 2) else self.builder.not_(flag)
+
+        # the flags themselves are only needed if something after the branch still reads them
+        live_flags = self.live_flags[brh.pc]
+        match instr.op:
+            case Instruction.SUB:
+                self.instr_sub(instr.reg_a, instr.reg_b, instr.reg_c, live_flags)
+            case Instruction.AND:
+                self.instr_and(instr.reg_a, instr.reg_b, instr.reg_c, live_flags)
+            case Instruction.XOR:
+                self.instr_xor(instr.reg_a, instr.reg_b, instr.reg_c, live_flags)
+            case Instruction.ADI:
+                self.instr_adi(instr.reg_a, instr.imm, live_flags)
+
+        self.branch_on(brh.pc, val, brh.addr, brh.pc + 1)
+
+    def instr_jmp(self, pc, addr) -> None:
+        # a program that is done spins on a jump to itself, the window has to show its last frame and stay responsive
+        if addr == pc and not self.headless:
+            self.builder.call(
+                self.funcs["idle"],
+                [],
+            )
+
         self.builder.branch(
             self.blocks[addr]
         )
 
-    def instr_brh(self, cond, true_addr, false_addr) -> None:
+    def instr_brh(self, pc, cond, true_addr, false_addr) -> None:
         val = None
         if cond == 0:
             val = self.builder.icmp_unsigned(
@@ -613,13 +1873,35 @@ class Recompiler:
                 ir.Constant(ir.IntType(1), 1)
             )
 
-        self.builder.cbranch(
+        self.branch_on(pc, val, true_addr, false_addr)
+
+    def branch_on(self, pc, val, true_addr, false_addr) -> None:
+        if self.profile is not None:
+            self.increment_counter(self.builder, self.edge_key(pc, true_addr), self.builder.zext(val, ir.IntType(64)))
+            self.increment_counter(self.builder, self.edge_key(pc, false_addr), self.builder.zext(self.builder.not_(val), ir.IntType(64)))
+
+        branch = self.builder.cbranch(
             val,
             self.blocks[true_addr],
             self.blocks[false_addr],
         )
 
+        if self.profile_data is not None:
+            counts = [
+                self.profile_data.get(self.edge_key(pc, true_addr), 0),
+                self.profile_data.get(self.edge_key(pc, false_addr), 0),
+            ]
+            if any(counts):
+                branch.set_weights(self.branch_weights(counts))
+
     def instr_cal(self, pc, addr) -> None:
+        if addr in self.subroutine_funcs:
+            self.builder.call(
+                self.subroutine_funcs[addr],
+                self.state_pointers(),
+            )
+            return
+
         sp0 = self.builder.load(self.sp)
         elem_ptr = self.builder.gep(
             self.stack,
@@ -640,7 +1922,11 @@ class Recompiler:
             self.blocks[addr]
         )
 
-    def instr_ret(self) -> None:
+    def instr_ret(self, pc) -> None:
+        if self.subroutine is not None:
+            self.builder.ret_void()
+            return
+
         new_sp = self.builder.sub(
             self.builder.load(self.sp),
             ir.Constant(ir.IntType(8), 1),
@@ -661,14 +1947,44 @@ class Recompiler:
         )
 
         for ret_target in self.return_targets:
-            switch.add_case(ir.Constant(ir.IntType(16), ret_target), self.blocks[ret_target])
+            target_block = self.blocks[ret_target]
+
+            if self.profile is not None:
+                # every return edge gets its own block to count in
+                target_block = self.builder.append_basic_block()
+                edge_builder = ir.IRBuilder(target_block)
+                self.increment_counter(edge_builder, self.edge_key(pc, ret_target))
+                edge_builder.branch(self.blocks[ret_target])
+
+            switch.add_case(ir.Constant(ir.IntType(16), ret_target), target_block)
+
+        if self.profile_data is not None:
+            counts = [self.profile_data.get(self.edge_key(pc, ret_target), 0) for ret_target in self.return_targets]
+            if any(counts):
+                # the default case (an invalid return address) never runs
+                switch.set_weights(self.branch_weights([0, *counts]))
 
     def instr_lod(self, pc, ra, off, rb) -> None:
+        addr_range = self.address_ranges[pc]
+        if addr_range is not None and addr_range[0] == addr_range[1]:
+            # the address is known at compile time, so only its action has to be emitted
+            addr = addr_range[0]
+            if addr in self.LOD_PORTS:
+                self.load_port(addr, rb)
+            else:
+                self.load_ram(ir.Constant(ir.IntType(8), addr), rb)
+            return
+
         calc_addr = self.builder.add(
             self.builder.load(self.regs[ra]),
             ir.Constant(ir.IntType(8), off),
         )
 
+        if not self.needs_lod_dispatch(pc):
+            # none of the io ports can be hit (or the instruction is unreachable)
+            self.load_ram(calc_addr, rb)
+            return
+
         unmapped_ram_case = self.builder.append_basic_block()
 
         self.builder.position_after(calc_addr)
@@ -678,75 +1994,96 @@ class Recompiler:
         )
 
         self.builder.position_at_start(unmapped_ram_case)
-        elem_ptr = self.builder.gep(
+        self.load_ram(calc_addr, rb)
+        self.builder.branch(self.find_next_closest_block(pc))
+
+        for port in self.LOD_PORTS:
+            port_case = self.builder.append_basic_block()
+            self.builder.position_at_start(port_case)
+            self.load_port(port, rb)
+            self.builder.branch(self.find_next_closest_block(pc))
+            switch.add_case(ir.Constant(ir.IntType(8), port), port_case)
+
+    def ram_ptr(self, addr) -> ir.Value:
+        # the address is unsigned, as an i8 index the gep would sign extend 128-255 to negative offsets
+        return self.builder.gep(
             self.ram,
-            [calc_addr],
+            [self.builder.zext(addr, ir.IntType(32))],
         )
+
+    def load_ram(self, addr, rb) -> None:
+        elem_ptr = self.ram_ptr(addr)
         if rb != 0:
             self.builder.store(
                 self.builder.load(elem_ptr),
                 self.regs[rb],
             )
-        self.builder.branch(self.find_next_closest_block(pc))
 
-        get_pixel_case = self.builder.append_basic_block()
-        self.builder.position_at_start(get_pixel_case)
-        if self.headless:
-            self.builder.store(
-                ir.Constant(ir.IntType(8), 0),
-                self.regs[rb],
-            )
-        else:
-            val = self.builder.call(
-                self.funcs["get_pixel"],
-                [
-                    self.builder.load(self.pixel_x),
-                    self.builder.load(self.pixel_y),
-                ],
-            )
-            if rb != 0:
-                self.builder.store(
-                    val,
-                    self.regs[rb],
-                )
-        self.builder.branch(self.find_next_closest_block(pc))
-        switch.add_case(ir.Constant(ir.IntType(8), 244), get_pixel_case)
+    def load_port(self, port, rb) -> None:
+        val = None
+        match port:
+            case 244:
+                if not self.emulates_screen():
+                    val = ir.Constant(ir.IntType(8), 0)
+                else:
+                    row_ptr, mask = self.screen_pixel()
+                    val = self.builder.zext(
+                        self.builder.icmp_unsigned(
+                            "!=",
+                            self.builder.and_(self.builder.load(row_ptr), mask),
+                            ir.Constant(ir.IntType(32), 0),
+                        ),
+                        ir.IntType(8),
+                    )
+            case 254:
+                if self.seed is not None:
+                    val = self.inline_random_num()
+                else:
+                    val = self.builder.call(
+                        self.funcs["get_random_num"],
+                        [],
+                    )
+            case 255:
+                if self.headless and self.replay_input is not None:
+                    val = self.builder.call(
+                        self.funcs["get_controller_headless"],
+                        [],
+                    )
+                elif self.headless:
+                    val = ir.Constant(ir.IntType(8), 0)
+                else:
+                    val = self.builder.call(
+                        self.funcs["get_controller"],
+                        [],
+                    )
 
-        get_random_num_case = self.builder.append_basic_block()
-        self.builder.position_at_start(get_random_num_case)
-        val = self.builder.call(
-            self.funcs["get_random_num"],
-            [],
-        )
         if rb != 0:
             self.builder.store(
                 val,
                 self.regs[rb],
             )
-        self.builder.branch(self.find_next_closest_block(pc))
-        switch.add_case(ir.Constant(ir.IntType(8), 254), get_random_num_case)
 
-        get_controller_case = self.builder.append_basic_block()
-        self.builder.position_at_start(get_controller_case)
-        if self.headless:
-            self.builder.store(
-                ir.Constant(ir.IntType(8), 0),
-                self.regs[rb],
-            )
-        else:
-            val = self.builder.call(
-                self.funcs["get_controller"],
-                [],
-            )
-            if rb != 0:
-                self.builder.store(
-                    val,
-                    self.regs[rb],
+    def instr_str(self, pc, ra, off, rb) -> None:
+        if not self.needs_str_dispatch(pc):
+            addr_range = self.address_ranges[pc]
+            if addr_range is not None and addr_range[0] == addr_range[1]:
+                # the address is known at compile time, so only its action has to be emitted
+                addr = addr_range[0]
+                if addr in self.STR_PORTS:
+                    self.store_port(addr, rb)
+                else:
+                    self.store_ram(ir.Constant(ir.IntType(8), addr), rb)
+            else:
+                # the address is provably below 240 (or the instruction is unreachable), so the bounds check can be dropped
+                self.store_ram(
+                    self.builder.add(
+                        self.builder.load(self.regs[ra]),
+                        ir.Constant(ir.IntType(8), off),
+                    ),
+                    rb,
                 )
-        self.builder.branch(self.find_next_closest_block(pc))
-        switch.add_case(ir.Constant(ir.IntType(8), 255), get_controller_case)
+            return
 
-    def instr_str(self, pc, ra, off, rb) -> None:
         calc_addr = self.builder.add(
             self.builder.load(self.regs[ra]),
             ir.Constant(ir.IntType(8), off),
@@ -773,157 +2110,425 @@ class Recompiler:
             valid_ram_block,
         )
         self.builder.position_at_start(valid_ram_block)
-        elem_ptr = self.builder.gep(
-            self.ram,
-            [calc_addr],
-        )
-        self.builder.store(
-            self.builder.load(self.regs[rb]),
-            elem_ptr,
-        )
+        self.store_ram(calc_addr, rb)
         self.builder.branch(self.find_next_closest_block(pc))
 
-        store_pixel_x_case = self.builder.append_basic_block()
-        self.builder.position_at_start(store_pixel_x_case)
-        self.builder.store(
-            self.builder.load(self.regs[rb]),
-            self.pixel_x,
-        )
-        self.builder.branch(self.find_next_closest_block(pc))
-        switch.add_case(ir.Constant(ir.IntType(8), 240), store_pixel_x_case)
+        for port in self.STR_PORTS:
+            port_case = self.builder.append_basic_block()
+            self.builder.position_at_start(port_case)
+            self.store_port(port, rb)
+            self.builder.branch(self.find_next_closest_block(pc))
+            switch.add_case(ir.Constant(ir.IntType(8), port), port_case)
 
-        store_pixel_y_case = self.builder.append_basic_block()
-        self.builder.position_at_start(store_pixel_y_case)
+    def store_ram(self, addr, rb) -> None:
+        elem_ptr = self.ram_ptr(addr)
         self.builder.store(
             self.builder.load(self.regs[rb]),
-            self.pixel_y,
-        )
-        self.builder.branch(self.find_next_closest_block(pc))
-        switch.add_case(ir.Constant(ir.IntType(8), 241), store_pixel_y_case)
-
-        draw_pixel_case = self.builder.append_basic_block()
-        self.builder.position_at_start(draw_pixel_case)
-        if not self.headless:
-            self.builder.call(
-                self.funcs["draw_pixel"],
-                [
-                    self.builder.load(self.pixel_x),
-                    self.builder.load(self.pixel_y),
-                ],
-            )
-        self.builder.branch(self.find_next_closest_block(pc))
-        switch.add_case(ir.Constant(ir.IntType(8), 242), draw_pixel_case)
-
-        clear_pixel_case = self.builder.append_basic_block()
-        self.builder.position_at_start(clear_pixel_case)
-        if not self.headless:
-            self.builder.call(
-                self.funcs["clear_pixel"],
-                [
-                    self.builder.load(self.pixel_x),
-                    self.builder.load(self.pixel_y),
-                ],
-            )
-        self.builder.branch(self.find_next_closest_block(pc))
-        switch.add_case(ir.Constant(ir.IntType(8), 243), clear_pixel_case)
-
-        update_screen_case = self.builder.append_basic_block()
-        self.builder.position_at_start(update_screen_case)
-        if not self.headless:
-            self.builder.call(
-                self.funcs["update_screen"],
-                [],
-            )
-        self.builder.branch(self.find_next_closest_block(pc))
-        switch.add_case(ir.Constant(ir.IntType(8), 245), update_screen_case)
-
-        clear_screen_case = self.builder.append_basic_block()
-        self.builder.position_at_start(clear_screen_case)
-        if not self.headless:
-            self.builder.call(
-                self.funcs["clear_screen"],
-                [],
-            )
-        self.builder.branch(self.find_next_closest_block(pc))
-        switch.add_case(ir.Constant(ir.IntType(8), 246), clear_screen_case)
-
-        push_char_case = self.builder.append_basic_block()
-        self.builder.position_at_start(push_char_case)
-        self.builder.call(
-            self.funcs["push_char"],
-            [self.builder.load(self.regs[rb])],
-        )
-        self.builder.branch(self.find_next_closest_block(pc))
-        switch.add_case(ir.Constant(ir.IntType(8), 247), push_char_case)
-
-        flush_char_buffer_case = self.builder.append_basic_block()
-        self.builder.position_at_start(flush_char_buffer_case)
-        self.builder.call(
-            self.funcs["flush_char_buffer"],
-            [],
-        )
-        self.builder.branch(self.find_next_closest_block(pc))
-        switch.add_case(ir.Constant(ir.IntType(8), 248), flush_char_buffer_case)
-
-        clear_char_buffer_case = self.builder.append_basic_block()
-        self.builder.position_at_start(clear_char_buffer_case)
-        self.builder.call(
-            self.funcs["clear_char_buffer"],
-            [],
-        )
-        self.builder.branch(self.find_next_closest_block(pc))
-        switch.add_case(ir.Constant(ir.IntType(8), 249), clear_char_buffer_case)
-
-        set_num_to_val_case = self.builder.append_basic_block()
-        self.builder.position_at_start(set_num_to_val_case)
-        self.builder.call(
-            self.funcs["set_num"],
-            [self.builder.load(self.regs[rb])],
-        )
-        self.builder.branch(self.find_next_closest_block(pc))
-        switch.add_case(ir.Constant(ir.IntType(8), 250), set_num_to_val_case)
-
-        set_num_to_zero_case = self.builder.append_basic_block()
-        self.builder.position_at_start(set_num_to_zero_case)
-        self.builder.call(
-            self.funcs["set_num"],
-            [ir.Constant(ir.IntType(8), 0)],
+            elem_ptr,
         )
-        self.builder.branch(self.find_next_closest_block(pc))
-        switch.add_case(ir.Constant(ir.IntType(8), 251), set_num_to_zero_case)
 
-        unset_signedness_case = self.builder.append_basic_block()
-        self.builder.position_at_start(unset_signedness_case)
-        self.builder.call(
-            self.funcs["set_signedness"],
-            [ir.Constant(ir.IntType(1), 0)],
-        )
-        self.builder.branch(self.find_next_closest_block(pc))
-        switch.add_case(ir.Constant(ir.IntType(8), 252), unset_signedness_case)
+    def store_port(self, port, rb) -> None:
+        match port:
+            case 240:
+                self.builder.store(
+                    self.builder.load(self.regs[rb]),
+                    self.pixel_x,
+                )
+            case 241:
+                self.builder.store(
+                    self.builder.load(self.regs[rb]),
+                    self.pixel_y,
+                )
+            case 242:
+                if self.emulates_screen():
+                    row_ptr, mask = self.screen_pixel()
+                    self.builder.store(
+                        self.builder.or_(self.builder.load(row_ptr), mask),
+                        row_ptr,
+                    )
+            case 243:
+                if self.emulates_screen():
+                    row_ptr, mask = self.screen_pixel()
+                    self.builder.store(
+                        self.builder.and_(self.builder.load(row_ptr), self.builder.not_(mask)),
+                        row_ptr,
+                    )
+            case 245:
+                if self.emulates_screen():
+                    zero = ir.Constant(ir.IntType(32), 0)
+                    self.builder.call(
+                        self.screen_func("present_framebuffer"),
+                        [self.builder.gep(self.screen_bitmap, [zero, zero])],
+                    )
+                if self.traces_input():
+                    self.builder.call(
+                        self.funcs["next_input_frame"],
+                        [],
+                    )
+            case 246:
+                if self.emulates_screen():
+                    self.builder.store(
+                        ir.Constant(self.screen_bitmap.value_type, None),
+                        self.screen_bitmap,
+                    )
+            case 247:
+                self.builder.call(
+                    self.funcs["push_char"],
+                    [self.builder.load(self.regs[rb])],
+                )
+            case 248:
+                self.builder.call(
+                    self.funcs["flush_char_buffer"],
+                    [],
+                )
+            case 249:
+                self.builder.call(
+                    self.funcs["clear_char_buffer"],
+                    [],
+                )
+            case 250:
+                self.builder.call(
+                    self.funcs["set_num"],
+                    [self.builder.load(self.regs[rb])],
+                )
+            case 251:
+                self.builder.call(
+                    self.funcs["set_num"],
+                    [ir.Constant(ir.IntType(8), 0)],
+                )
+            case 252:
+                self.builder.call(
+                    self.funcs["set_signedness"],
+                    [ir.Constant(ir.IntType(1), 0)],
+                )
+            case 253:
+                self.builder.call(
+                    self.funcs["set_signedness"],
+                    [ir.Constant(ir.IntType(1), 1)],
+                )
 
-        set_signedness_case = self.builder.append_basic_block()
-        self.builder.position_at_start(set_signedness_case)
-        self.builder.call(
-            self.funcs["set_signedness"],
-            [ir.Constant(ir.IntType(1), 1)],
-        )
-        self.builder.branch(self.find_next_closest_block(pc))
-        switch.add_case(ir.Constant(ir.IntType(8), 253), set_signedness_case)
+def write_archive(members:list[tuple[str, bytes, list[str]]], path:str) -> None:
+    # writes (name, object file, defined symbols) members into a static library in the common (gnu and coff) ar format,
+    # which starts with an index of the symbols every member defines
+    def header(name:str, size:int) -> bytes:
+        return f"{name:<16}{0:<12}{0:<6}{0:<6}{644:<8}{size:<10}`\n".encode()
+
+    def padded(data:bytes) -> bytes:
+        return data + b"\n" * (len(data) % 2)
+
+    symbol_names = b"".join(symbol.encode() + b"\0" for _, _, symbols in members for symbol in symbols)
+    symbol_count = sum(len(symbols) for _, _, symbols in members)
+    index_size = 4 + 4 * symbol_count + len(symbol_names)
+
+    offsets = []
+    offset = 8 + 60 + index_size + index_size % 2
+    for name, data, symbols in members:
+        offsets.extend([offset] * len(symbols))
+        offset += 60 + len(data) + len(data) % 2
+
+    index = symbol_count.to_bytes(4, "big") + b"".join(member_offset.to_bytes(4, "big") for member_offset in offsets) + symbol_names
+
+    with open(path, "wb") as output:
+        output.write(b"!<arch>\n")
+        output.write(header("/", index_size))
+        output.write(padded(index))
+        for name, data, _ in members:
+            output.write(header(f"{name}/", len(data)))
+            output.write(padded(data))
+
+def read_profile(path:str) -> dict[str, int]:
+    # counts of the same block or edge are summed up, so the profiles of several runs can simply be concatenated
+    counts = {}
+    with open(path, "r") as profile:
+        for line in profile.read().splitlines():
+            if not line.strip():
+                continue
+
+            key, count = line.split()
+            counts[key] = counts.get(key, 0) + int(count)
+
+    return counts
+
+EMIT_EXTENSIONS = {
+    "ll":  ".ll",
+    "bc":  ".bc",
+    "obj": ".o",
+    "asm": ".s",
+}
+
+def default_build_dir() -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "build")
+
+def default_helper_lib() -> str:
+    build_dir = default_build_dir()
+
+    if sys.platform == "win32":
+        return os.path.join(build_dir, "helper_funcs.dll")
+    if sys.platform == "darwin":
+        return os.path.join(build_dir, "libhelper_funcs.dylib")
+    return os.path.join(build_dir, "libhelper_funcs.so")
+
+def link_command(in_file:str, exe_file:str, lib_dir:str, opt:str="-O3", lto:bool=False) -> list[str]:
+    # same invocation as the recompile scripts, opt also applies to textual IR and bitcode inputs, which zig cc compiles again.
+    # with lto the helper functions are linked as the bitcode the setup script writes, and optimized together with the program
+    # by zig's own llvm, which can read both that bitcode and the older one llvmlite writes
+    lto_flags = ["-flto"] if lto else []
+
+    if sys.platform == "win32":
+        return [
+            "zig", "cc", in_file,
+            os.path.join(lib_dir, "helper_funcs.bc" if lto else "helper_funcs.lib"),
+            os.path.join(lib_dir, "raylib.lib"),
+            "-lopengl32", "-lwinmm", "-lgdi32", "-luser32", "-lkernel32",
+            *lto_flags, opt, "-o", exe_file,
+        ]
+
+    return [
+        "zig", "cc", in_file,
+        os.path.join(lib_dir, "helper_funcs.bc" if lto else "libhelper_funcs.a"),
+        os.path.join(lib_dir, "libraylib.a"),
+        *lto_flags, opt, "-o", exe_file,
+    ]
+
+def link_program(out_file:str, exe_file:str, lib_dir:str, lto:bool=False) -> None:
+    try:
+        result = subprocess.run(link_command(out_file, exe_file, lib_dir, lto=lto), capture_output=True, text=True)
+    except OSError as e:
+        raise LinkError(f"linking failed: {e}")
+
+    if result.returncode != 0:
+        raise LinkError(f"linking failed:\n{result.stderr.strip()}")
+
+def recompile_batch_file(in_file:str, out_dir:str, options:dict, link:bool, lib_dir:str,
+                         cache_dir:str|None=None, lto:bool=False) -> tuple[str, str|None]:
+    # runs in a worker process, returns the input file and an error message (None if everything worked)
+    name = os.path.splitext(os.path.basename(in_file))[0]
+    out_file = os.path.join(out_dir, name + EMIT_EXTENSIONS[options["emit"]])
+    exe_file = os.path.join(out_dir, name + (".exe" if sys.platform == "win32" else ""))
+
+    # errors are reported the same way whether or not the build cache is used
+    try:
+        if cache_dir is not None:
+            cached_recompile(BuildCache(cache_dir), in_file, out_file, options, exe_file if link else None, lib_dir, lto)
+            return in_file, None
+
+        Recompiler(in_file, out_file, **options).recompile()
+        if link:
+            link_program(out_file, exe_file, lib_dir, lto)
+    except LinkError as e:
+        return in_file, str(e)
+    except Exception as e:
+        return in_file, f"recompilation failed: {type(e).__name__}: {e}"
+
+    return in_file, None
+
+def batch_recompile(in_dir:str, out_dir:str, options:dict, link:bool=False, lib_dir:str|None=None, jobs:int|None=None,
+                    cache_dir:str|None=None, lto:bool=False) -> int:
+    if lib_dir is None:
+        lib_dir = default_build_dir()
+
+    in_files = sorted(
+        glob.glob(os.path.join(in_dir, "*.mc")) +
+        glob.glob(os.path.join(in_dir, "*" + PACKED_EXTENSION))
+    )
+    os.makedirs(out_dir, exist_ok=True)
+
+    # a failing program only shows up in the report, it doesn't stop the others
+    failures = {}
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            pool.submit(recompile_batch_file, in_file, out_dir, options, link, lib_dir, cache_dir, lto): in_file
+            for in_file in in_files
+        }
+        for future in as_completed(futures):
+            in_file = futures[future]
+            try:
+                _, error = future.result()
+            except Exception as e:
+                # the worker process itself died
+                error = f"worker failed: {type(e).__name__}: {e}"
+
+            if error is None:
+                print(f"ok      {in_file}")
+            else:
+                print(f"FAILED  {in_file}")
+                failures[in_file] = error
+
+    print(f"\n{len(in_files) - len(failures)}/{len(in_files)} programs recompiled successfully")
+    for in_file, error in sorted(failures.items()):
+        print(f"\n{in_file}:\n{error}")
+
+    return 1 if failures else 0
+
+class RecompileRequestHandler(socketserver.StreamRequestHandler):
+    # one json request per line: {"in_file": ..., "out_file": ..., "options": {...}} with the options of the Recompiler,
+    # answered with {"ok": true} or {"ok": false, "error": ...}
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                Recompiler(request["in_file"], request["out_file"], **request.get("options", {})).recompile()
+                response = {"ok": True}
+            except Exception as e:
+                response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+def serve(socket_path:str) -> None:
+    # llvmlite is imported and llvm initialized once for every recompilation the server does (the recompilers skip it then),
+    # requests are handled one at a time, as llvm's global context isn't thread safe
+    Recompiler.init_llvm_binding()
+
+    # only a socket left behind by an earlier server is replaced, never some other file
+    if os.path.lexists(socket_path):
+        if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+            raise Exception(f"{socket_path} exists and isn't a socket, not replacing it")
+        os.remove(socket_path)
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+
+    with socketserver.UnixStreamServer(socket_path, RecompileRequestHandler) as server:
+        print(f"serving on {socket_path}", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
 
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description="Recompiles a BatPU-2 machine code file to LLVM IR.")
-    parser.add_argument("in_file", type=str, help="Path to the input .mc file.")
-    parser.add_argument("out_file", type=str, help="Path to the output LLVM IR file.")
+    parser.add_argument("in_file", type=str, nargs="?", help="Path to the input .mc file.")
+    parser.add_argument("out_file", type=str, nargs="?", help="Path to the output file (LLVM IR unless --emit says otherwise).")
 
     parser.add_argument("--headless", action="store_true", help="Run in headless mode without initializing the graphics library.")
+    parser.add_argument("--opt-level", type=int, default=0, choices=range(4), help="LLVM optimization level applied before the module is emitted.")
+    parser.add_argument("--emit", type=str, default="ll", choices=["ll", "bc", "obj", "asm"], help="Kind of output file: textual IR, bitcode, a native object file or native assembly.")
+    parser.add_argument("--cpu", type=str, default="host", help="Target CPU for native code generation.")
+    parser.add_argument("--features", type=str, default="host", help="Target CPU features for native code generation (eg. +avx2,-sse4a).")
+    parser.add_argument("--run", action="store_true", help="JIT compile the recompiled program and run it in-process.")
+    parser.add_argument("--helper-lib", type=str, default=default_helper_lib(), help="Path to the shared helper function library used by --run.")
+    parser.add_argument("--time", action="store_true", help="Print the time spent running the program (without recompiling and jit compiling it) to stderr after --run.")
+    parser.add_argument("--profile", type=str, nargs="?", const="profile.txt", default=None, metavar="PATH", help="Count how often every block and branch edge is executed and write the counts to PATH (default: profile.txt) when the program exits.")
+    parser.add_argument("--profile-use", type=str, default=None, metavar="PATH", help="Use the counts of a previous --profile run of the same program for branch weights and the block layout.")
+    parser.add_argument("--framebuffer", type=str, default=None, metavar="PATH", help="Emulate the screen of a headless run and append every frame to the ring file PATH (read it with framebuffer.py).")
+    parser.add_argument("--framebuffer-slots", type=int, default=256, help="Number of frames the --framebuffer ring file holds.")
+    parser.add_argument("--present-rate", type=int, default=None, metavar="FPS", help="Present at most FPS frames per second in the window (default: the display refresh rate, 0: every changed frame).")
+    parser.add_argument("--incremental", type=str, nargs="?", const=default_cache_dir(), default=None, metavar="DIR", help="Compile every subroutine and main into an object of its own, cached in DIR (default: the build cache), and write them into a static library (requires --emit obj).")
+    parser.add_argument("--render-thread", action="store_true", help="Present the window from a separate thread, so the program doesn't wait for the display.")
+    parser.add_argument("--record-input", type=str, default=None, metavar="PATH", help="Record the controller state of every frame of a windowed run to the trace file PATH.")
+    parser.add_argument("--replay-input", type=str, default=None, metavar="PATH", help="Read the controller state of every frame from the trace file PATH (eg. one written by --record-input) instead of the keyboard, also in headless runs.")
+    parser.add_argument("--seed", type=int, default=None, help="Generate the random numbers inline with a xorshift32 generator seeded with SEED (the same sequence as interp.py --seed), instead of calling raylib.")
+    parser.add_argument("--pack", action="store_true", help=f"Only convert the input program into a packed binary ({PACKED_EXTENSION}) output file.")
+
+    parser.add_argument("--serve", type=str, nargs="?", const=default_socket_path(), default=None, metavar="SOCKET", help="Serve recompilations (see client.py) on the unix socket SOCKET (default: build/recomp.sock) instead of recompiling a single file.")
+    parser.add_argument("--batch", type=str, metavar="DIR", help="Recompile every .mc file in DIR concurrently instead of a single file.")
+    parser.add_argument("--out", type=str, metavar="DIR", help="Output directory for --batch.")
+    parser.add_argument("--link", action="store_true", help="Link every program recompiled by --batch against the helper functions and raylib.")
+    parser.add_argument("--lto", action="store_true", help="Link against the bitcode of the helper functions with zig cc -flto instead, so they are optimized together with the program (requires --link and --emit bc or ll).")
+    parser.add_argument("--lib-dir", type=str, default=default_build_dir(), help="Directory containing the static helper function and raylib libraries used by --link.")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of worker processes used by --batch (defaults to the number of CPUs).")
+    parser.add_argument("--cache-dir", type=str, default=None, help="Look up and store the results of --batch in the build cache in this directory.")
     args = parser.parse_args()
-    
+
+    if args.serve is not None:
+        if not hasattr(socket, "AF_UNIX"):
+            parser.error("--serve requires unix socket support")
+        if args.in_file is not None or args.batch is not None or args.run:
+            parser.error("--serve can't be combined with an input file, --batch or --run")
+
+        serve(args.serve)
+        sys.exit(0)
+
+    if args.framebuffer is not None and not args.headless:
+        parser.error("--framebuffer requires --headless")
+    if args.framebuffer_slots < 2:
+        parser.error("--framebuffer-slots must be at least 2, the slot written next can't be read")
+    if args.render_thread and args.headless:
+        parser.error("--render-thread can't be combined with --headless")
+    if args.record_input is not None and args.headless:
+        parser.error("--record-input can't be combined with --headless, there is no controller to record")
+    if args.record_input is not None and args.replay_input is not None:
+        parser.error("--record-input can't be combined with --replay-input")
+
+    if args.batch is not None:
+        if args.out is None:
+            parser.error("--batch requires --out")
+        if args.in_file is not None or args.run:
+            parser.error("--batch can't be combined with an input file or --run")
+        if args.lto and (not args.link or args.emit not in ("bc", "ll")):
+            parser.error("--lto requires --link and --emit bc or ll, zig cc can only optimize llvm ir across the program and the helper functions")
+        # these name a file of a single program, every program of the batch would share it
+        for option, value in (("--profile", args.profile), ("--profile-use", args.profile_use), ("--framebuffer", args.framebuffer), ("--record-input", args.record_input)):
+            if value is not None:
+                parser.error(f"--batch can't be combined with {option}")
+        if args.incremental is not None:
+            parser.error("--batch can't be combined with --incremental, use --cache-dir to skip unchanged programs")
+
+        sys.exit(batch_recompile(
+            args.batch,
+            args.out,
+            {
+                "headless":  args.headless,
+                "opt_level": args.opt_level,
+                "emit":      args.emit,
+                "cpu":       args.cpu,
+                "features":  args.features,
+                "present_rate":  args.present_rate,
+                "render_thread": args.render_thread,
+                "replay_input":  args.replay_input,
+                "seed":          args.seed,
+            },
+            args.link,
+            args.lib_dir,
+            args.jobs,
+            args.cache_dir,
+            args.lto,
+        ))
+
+    if args.in_file is None:
+        parser.error("an input file is required unless --batch is given")
+    if args.out_file is None and not args.run:
+        parser.error("an output file is required unless --run is given")
+
+    if args.lto:
+        parser.error("--lto only applies to --batch --link, link a single program with zig cc -flto and build/helper_funcs.bc instead")
+    if args.incremental is not None:
+        if args.emit != "obj" or args.run:
+            parser.error("--incremental requires --emit obj and an output file")
+        if args.profile is not None or args.profile_use is not None:
+            parser.error("--incremental can't be combined with --profile or --profile-use")
+
+    if args.pack:
+        write_packed_file(read_mc_words(args.in_file), args.out_file)
+        sys.exit(0)
+
     recompiler = Recompiler(
         args.in_file,
         args.out_file,
         args.headless,
+        args.opt_level,
+        args.emit,
+        args.cpu,
+        args.features,
+        args.profile,
+        args.profile_use,
+        args.framebuffer,
+        args.framebuffer_slots,
+        args.present_rate,
+        args.render_thread,
+        args.incremental,
+        args.record_input,
+        args.replay_input,
+        args.seed,
     )
 
     recompiler.recompile()
+
+    if args.incremental is not None:
+        print(f"{recompiler.reused_regions}/{len(recompiler.subroutines) + 1} regions reused", file=sys.stderr)
+
+    if args.run:
+        sys.exit(recompiler.run(args.helper_lib, args.time))
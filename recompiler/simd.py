@@ -0,0 +1,623 @@
+import ctypes
+
+import numpy as np
+from llvmlite import ir, binding
+
+from interp import Interpreter, map_char, seed_state
+from isa import Instruction, read_mc_words
+from recomp import Recompiler, create_target_machine
+
+# a backend that recompiles a program into a function running `lanes` independent headless machines in lockstep,
+# every register and flag is a vector with one element per machine and the ram holds one row of lanes per address.
+# lanes that diverge are regrouped by their pc: every round of the dispatch loop picks the next higher pc any running lane is at,
+# wrapping around to the lowest one, and runs that block for all lanes that are there.
+# lanes that took different paths forward line up again where those paths meet, and a lane spinning in a loop
+# can't starve the lanes at higher pcs, every pc that is occupied gets its turn once per sweep
+
+class SimdRecompiler:
+    def __init__(self, in_file:str, lanes:int=8, opt_level:int=3, cpu:str="host", features:str="host") -> None:
+        self.in_file   = in_file
+        self.lanes     = lanes
+        self.opt_level = opt_level
+        self.cpu       = cpu
+        self.features  = features
+
+        self.instructions = [
+            Instruction.decode(pc, word)
+            for pc, word in enumerate(read_mc_words(self.in_file))
+        ]
+
+        Recompiler.init_llvm_binding()
+        self.mod = ir.Module("simd")
+        self.mod.triple = binding.get_default_triple()
+        self.init_target_machine()
+
+    def init_target_machine(self) -> None:
+        # the code is only ever run by mcjit, which needs the default relocation model
+        self.target_machine = create_target_machine(self.mod.triple, self.cpu, self.features, self.opt_level)
+        self.mod.data_layout = str(self.target_machine.target_data)
+
+    def vec(self, bits:int) -> ir.VectorType:
+        return ir.VectorType(ir.IntType(bits), self.lanes)
+
+    def splat(self, bits:int, value:int) -> ir.Constant:
+        return ir.Constant(self.vec(bits), [value] * self.lanes)
+
+    def recompile(self) -> None:
+        # the state arrays, all of them lane minor:
+        # regs [16][lanes] u8, flags [2][lanes] u8 (Z, C), ram [256][lanes] u8, stack [16][lanes] u16, sp [lanes] u8,
+        # pc [lanes] u16, status [lanes] u8, steps [lanes] u64, rng [lanes] u32, controller [lanes] u8, num [lanes] u8, signedness [lanes] u8,
+        # followed by the callback for the text ports and the maximum number of rounds
+        self.io_type = ir.FunctionType(ir.VoidType(), [ir.IntType(32), ir.IntType(32), ir.IntType(8)])
+        func_type = ir.FunctionType(ir.IntType(64), [
+            ir.PointerType(ir.IntType(8)),
+            ir.PointerType(ir.IntType(8)),
+            ir.PointerType(ir.IntType(8)),
+            ir.PointerType(ir.IntType(16)),
+            ir.PointerType(ir.IntType(8)),
+            ir.PointerType(ir.IntType(16)),
+            ir.PointerType(ir.IntType(8)),
+            ir.PointerType(ir.IntType(64)),
+            ir.PointerType(ir.IntType(32)),
+            ir.PointerType(ir.IntType(8)),
+            ir.PointerType(ir.IntType(8)),
+            ir.PointerType(ir.IntType(8)),
+            ir.PointerType(self.io_type),
+            ir.IntType(64),
+        ])
+        self.func = ir.Function(self.mod, func_type, name="run_lanes")
+        for arg in self.func.args[:12]:
+            arg.add_attribute("noalias")
+
+        (self.regs_arg, self.flags_arg, self.ram, self.stack_arg, self.sp_arg, self.pc_arg, self.status_arg,
+         self.steps_arg, self.rng_arg, self.controller_arg, self.num_arg, self.signedness_arg, self.io, budget) = self.func.args
+
+        self.umin = ir.Function(
+            self.mod,
+            ir.FunctionType(ir.IntType(16), [self.vec(16)]),
+            name=f"llvm.vector.reduce.umin.v{self.lanes}i16",
+        )
+
+        self.builder = ir.IRBuilder(self.func.append_basic_block("entry"))
+        self.load_state()
+        self.rounds = self.builder.alloca(ir.IntType(64), name="rounds")
+        self.builder.store(ir.Constant(ir.IntType(64), 0), self.rounds)
+        self.last_pc = self.builder.alloca(ir.IntType(16), name="last_pc")
+        self.builder.store(ir.Constant(ir.IntType(16), 0xffff), self.last_pc)
+
+        loop_block = self.func.append_basic_block("dispatch")
+        save_block = self.func.append_basic_block("save")
+        self.builder.branch(loop_block)
+
+        # returns the number of rounds run, the state is written back so a later call continues where this one stopped
+        self.builder.position_at_end(save_block)
+        self.save_state()
+        self.builder.ret(self.builder.load(self.rounds))
+
+        self.find_blocks()
+        self.blocks = {
+            start: self.func.append_basic_block(f"block_{start:04x}")
+            for start in self.block_starts
+        }
+        end_block = self.func.append_basic_block("end")
+
+        # dispatch on the pcs of the running lanes in turn, until none are left or the budget is used up
+        self.builder.position_at_end(loop_block)
+        running = self.running()
+        rounds = self.builder.load(self.rounds)
+        go_on = self.builder.and_(
+            self.any_lane(running),
+            self.builder.icmp_unsigned("<", rounds, budget),
+        )
+        dispatch_block = self.func.append_basic_block("pick")
+        self.builder.cbranch(go_on, dispatch_block, save_block)
+
+        self.builder.position_at_end(dispatch_block)
+        self.builder.store(self.builder.add(rounds, ir.Constant(ir.IntType(64), 1)), self.rounds)
+        pcs = self.builder.load(self.pc)
+        ahead = self.builder.and_(
+            running,
+            self.builder.icmp_unsigned(">", pcs, self.splat_value(16, self.builder.load(self.last_pc))),
+        )
+        next_pc = self.builder.call(self.umin, [self.builder.select(ahead, pcs, self.splat(16, 0xffff))])
+        lowest_pc = self.builder.call(self.umin, [self.builder.select(running, pcs, self.splat(16, 0xffff))])
+        self.current_pc = self.builder.select(
+            self.builder.icmp_unsigned("==", next_pc, ir.Constant(ir.IntType(16), 0xffff)),
+            lowest_pc,
+            next_pc,
+        )
+        self.builder.store(self.current_pc, self.last_pc)
+        switch = self.builder.switch(self.current_pc, end_block)
+        for start, block in self.blocks.items():
+            switch.add_case(ir.Constant(ir.IntType(16), start), block)
+
+        self.loop_block = loop_block
+
+        for start, end in zip(self.block_starts, self.block_ends):
+            self.builder.position_at_end(self.blocks[start])
+            self.build_block(start, end)
+
+        # every pc past the end of the program exits, like the end of the recompiled program does
+        self.builder.position_at_end(end_block)
+        self.mask = self.lanes_at(self.current_pc)
+        self.executed = 1
+        self.set_status(Interpreter.HALTED)
+        self.builder.branch(loop_block)
+
+    def load_state(self) -> None:
+        def vector_ptr(ptr, bits, idx):
+            return self.builder.bitcast(
+                self.builder.gep(ptr, [ir.Constant(ir.IntType(32), idx * self.lanes)]),
+                ir.PointerType(self.vec(bits)),
+            )
+
+        # every piece of state is a vector in an alloca (promoted to registers), only the ram stays in the caller's memory
+        def alloca(name, bits, ptr, idx=0):
+            slot = self.builder.alloca(self.vec(bits), name=name)
+            self.builder.store(self.builder.load(vector_ptr(ptr, bits, idx), align=1), slot)
+            self.saved.append((slot, vector_ptr(ptr, bits, idx)))
+            return slot
+
+        self.saved = []
+        self.regs  = [alloca(f"r{idx}", 8, self.regs_arg, idx) for idx in range(16)]
+        self.stack = [alloca(f"stack{idx}", 16, self.stack_arg, idx) for idx in range(16)]
+        self.sp         = alloca("sp", 8, self.sp_arg)
+        self.pc         = alloca("pc", 16, self.pc_arg)
+        self.status     = alloca("status", 8, self.status_arg)
+        self.steps      = alloca("steps", 64, self.steps_arg)
+        self.rng        = alloca("rng", 32, self.rng_arg)
+        self.num        = alloca("num", 8, self.num_arg)
+        self.signedness = alloca("signedness", 8, self.signedness_arg)
+        self.flag_Z     = alloca("flag_Z", 8, self.flags_arg, 0)
+        self.flag_C     = alloca("flag_C", 8, self.flags_arg, 1)
+
+        self.controller = self.builder.load(vector_ptr(self.controller_arg, 8, 0), align=1)
+
+    def save_state(self) -> None:
+        for slot, ptr in self.saved:
+            self.builder.store(self.builder.load(slot), ptr, align=1)
+
+    def find_blocks(self) -> None:
+        starts = {0}
+        for instr in self.instructions:
+            if instr.op in (Instruction.JMP, Instruction.BRH, Instruction.CAL) and instr.addr < len(self.instructions):
+                starts.add(instr.addr)
+            if instr.op in (Instruction.HLT, Instruction.JMP, Instruction.BRH, Instruction.CAL, Instruction.RET):
+                starts.add(instr.pc + 1)
+
+        self.block_starts = sorted(start for start in starts if start < len(self.instructions))
+        self.block_ends = self.block_starts[1:] + [len(self.instructions)]
+
+    def running(self):
+        return self.builder.icmp_unsigned("==", self.builder.load(self.status), self.splat(8, Interpreter.RUNNING))
+
+    def lanes_at(self, pc):
+        return self.builder.and_(
+            self.running(),
+            self.builder.icmp_unsigned("==", self.builder.load(self.pc), self.splat_value(16, pc)),
+        )
+
+    def splat_value(self, bits, value):
+        vector = self.builder.insert_element(ir.Constant(self.vec(bits), None), value, ir.Constant(ir.IntType(32), 0))
+        return self.builder.shuffle_vector(vector, vector, ir.Constant(self.vec(32), [0] * self.lanes))
+
+    def any_lane(self, mask):
+        return self.builder.icmp_unsigned(
+            "!=",
+            self.builder.bitcast(mask, ir.IntType(self.lanes)),
+            ir.Constant(ir.IntType(self.lanes), 0),
+        )
+
+    def masked_store(self, value, slot) -> None:
+        # lanes outside of the mask keep their value
+        self.builder.store(self.builder.select(self.mask, value, self.builder.load(slot)), slot)
+
+    def set_reg(self, reg, value) -> None:
+        # writes to r0 are discarded
+        if reg != 0:
+            self.masked_store(value, self.regs[reg])
+
+    def set_flag(self, flag, value) -> None:
+        self.masked_store(self.builder.zext(value, self.vec(8)), flag)
+
+    def flag(self, flag):
+        return self.builder.icmp_unsigned("!=", self.builder.load(flag), self.splat(8, 0))
+
+    def count_steps(self, lanes) -> None:
+        # the lanes leaving the block ran its instructions up to the current one
+        self.builder.store(
+            self.builder.select(
+                lanes,
+                self.builder.add(self.builder.load(self.steps), self.splat(64, self.executed)),
+                self.builder.load(self.steps),
+            ),
+            self.steps,
+        )
+
+    def set_status(self, status, lanes=None) -> None:
+        # lanes that halt or fail don't run the rest of the block
+        lanes = self.mask if lanes is None else self.builder.and_(self.mask, lanes)
+        self.builder.store(
+            self.builder.select(lanes, self.splat(8, status), self.builder.load(self.status)),
+            self.status,
+        )
+        self.count_steps(lanes)
+        self.mask = self.builder.and_(self.mask, self.builder.not_(lanes))
+
+    def build_block(self, start, end) -> None:
+        self.mask = self.lanes_at(ir.Constant(ir.IntType(16), start))
+
+        for pc in range(start, end):
+            self.executed = pc - start + 1
+            if self.translate(self.instructions[pc]):
+                # the instruction decided where its lanes continue
+                self.count_steps(self.mask)
+                self.builder.branch(self.loop_block)
+                return
+
+        self.count_steps(self.mask)
+        self.masked_store(self.splat(16, end), self.pc)
+        self.builder.branch(self.loop_block)
+
+    def translate(self, instr:Instruction) -> bool:
+        # returns whether the instruction ends its block
+        reg = lambda idx: self.builder.load(self.regs[idx])
+        zero = self.splat(8, 0)
+
+        match instr.op:
+            case Instruction.NOP:
+                ...
+            case Instruction.HLT:
+                self.set_status(Interpreter.HALTED)
+                return True
+            case Instruction.ADD:
+                a = reg(instr.reg_a)
+                res = self.builder.add(a, reg(instr.reg_b))
+                self.set_flag(self.flag_C, self.builder.icmp_unsigned("<", res, a))
+                self.set_flag(self.flag_Z, self.builder.icmp_unsigned("==", res, zero))
+                self.set_reg(instr.reg_c, res)
+            case Instruction.SUB:
+                a, b = reg(instr.reg_a), reg(instr.reg_b)
+                res = self.builder.sub(a, b)
+                self.set_flag(self.flag_C, self.builder.icmp_unsigned(">=", a, b))
+                self.set_flag(self.flag_Z, self.builder.icmp_unsigned("==", res, zero))
+                self.set_reg(instr.reg_c, res)
+            case Instruction.NOR | Instruction.AND | Instruction.XOR:
+                a, b = reg(instr.reg_a), reg(instr.reg_b)
+                match instr.op:
+                    case Instruction.NOR:
+                        res = self.builder.not_(self.builder.or_(a, b))
+                    case Instruction.AND:
+                        res = self.builder.and_(a, b)
+                    case Instruction.XOR:
+                        res = self.builder.xor(a, b)
+                self.set_flag(self.flag_Z, self.builder.icmp_unsigned("==", res, zero))
+                self.set_reg(instr.reg_c, res)
+            case Instruction.RSH:
+                self.set_reg(instr.reg_c, self.builder.lshr(reg(instr.reg_a), self.splat(8, 1)))
+            case Instruction.LDI:
+                self.set_reg(instr.reg_a, self.splat(8, instr.imm))
+            case Instruction.ADI:
+                a = reg(instr.reg_a)
+                res = self.builder.add(a, self.splat(8, instr.imm))
+                self.set_flag(self.flag_C, self.builder.icmp_unsigned("<", res, a))
+                self.set_flag(self.flag_Z, self.builder.icmp_unsigned("==", res, zero))
+                self.set_reg(instr.reg_a, res)
+            case Instruction.JMP:
+                self.masked_store(self.splat(16, instr.addr), self.pc)
+                return True
+            case Instruction.BRH:
+                flag = self.flag(self.flag_Z if instr.cond in (0, 1) else self.flag_C)
+                if instr.cond in (1, 3):
+                    flag = self.builder.not_(flag)
+                self.masked_store(
+                    self.builder.select(flag, self.splat(16, instr.addr), self.splat(16, instr.pc + 1)),
+                    self.pc,
+                )
+                return True
+            case Instruction.CAL:
+                self.instr_cal(instr)
+                return True
+            case Instruction.RET:
+                self.instr_ret()
+                return True
+            case Instruction.LOD:
+                self.instr_lod(instr)
+            case Instruction.STR:
+                self.instr_str(instr)
+
+        return False
+
+    def instr_cal(self, instr:Instruction) -> None:
+        # the recompiled code has no defined behaviour on a stack overflow, it's an error here like in the interpreter
+        sp = self.builder.load(self.sp)
+        self.set_status(Interpreter.ERROR, self.builder.icmp_unsigned(">=", sp, self.splat(8, 16)))
+
+        # the stack slot every lane pushes to differs, so each slot selects the lanes whose sp points at it
+        for idx, slot in enumerate(self.stack):
+            here = self.builder.and_(self.mask, self.builder.icmp_unsigned("==", sp, self.splat(8, idx)))
+            self.builder.store(self.builder.select(here, self.splat(16, instr.pc + 1), self.builder.load(slot)), slot)
+
+        self.masked_store(self.builder.add(sp, self.splat(8, 1)), self.sp)
+        self.masked_store(self.splat(16, instr.addr), self.pc)
+
+    def instr_ret(self) -> None:
+        sp = self.builder.load(self.sp)
+        self.set_status(Interpreter.ERROR, self.builder.icmp_unsigned("==", sp, self.splat(8, 0)))
+
+        new_sp = self.builder.sub(sp, self.splat(8, 1))
+        ret_addr = self.splat(16, 0)
+        for idx, slot in enumerate(self.stack):
+            ret_addr = self.builder.select(
+                self.builder.icmp_unsigned("==", new_sp, self.splat(8, idx)),
+                self.builder.load(slot),
+                ret_addr,
+            )
+
+        self.masked_store(new_sp, self.sp)
+        self.masked_store(ret_addr, self.pc)
+
+    def address(self, instr:Instruction):
+        return self.builder.add(self.builder.load(self.regs[instr.reg_a]), self.splat(8, instr.off & 0xff))
+
+    def ram_ptr(self, addr, lane:int):
+        # element (addr, lane) of the lane minor ram
+        idx = self.builder.add(
+            self.builder.mul(self.builder.zext(addr, ir.IntType(32)), ir.Constant(ir.IntType(32), self.lanes)),
+            ir.Constant(ir.IntType(32), lane),
+        )
+        return self.builder.gep(self.ram, [idx])
+
+    def ram_row(self, addr:int):
+        # all lanes of a fixed address at once
+        return self.builder.bitcast(
+            self.builder.gep(self.ram, [ir.Constant(ir.IntType(32), addr * self.lanes)]),
+            ir.PointerType(self.vec(8)),
+        )
+
+    def instr_lod(self, instr:Instruction) -> None:
+        addr = self.address(instr)
+
+        if instr.reg_a == 0:
+            val = self.builder.load(self.ram_row(instr.off & 0xff), align=1)
+        else:
+            val = ir.Constant(self.vec(8), None)
+            for lane in range(self.lanes):
+                lane_idx = ir.Constant(ir.IntType(32), lane)
+                lane_val = self.builder.load(self.ram_ptr(self.builder.extract_element(addr, lane_idx), lane))
+                val = self.builder.insert_element(val, lane_val, lane_idx)
+
+        is_port = lambda port: self.builder.icmp_unsigned("==", addr, self.splat(8, port))
+
+        # xorshift32 like the interpreter, only lanes that actually read the port advance their generator
+        state = self.builder.load(self.rng)
+        new_state = state
+        for op, shift in ((self.builder.shl, 13), (self.builder.lshr, 17), (self.builder.shl, 5)):
+            new_state = self.builder.xor(new_state, op(new_state, ir.Constant(self.vec(32), [shift] * self.lanes)))
+        random = is_port(254)
+        self.builder.store(
+            self.builder.select(self.builder.and_(self.mask, random), new_state, state),
+            self.rng,
+        )
+
+        # the screen isn't emulated, so pixels read as 0
+        val = self.builder.select(is_port(244), self.splat(8, 0), val)
+        val = self.builder.select(random, self.builder.trunc(new_state, self.vec(8)), val)
+        val = self.builder.select(is_port(255), self.controller, val)
+
+        self.set_reg(instr.reg_b, val)
+
+    def instr_str(self, instr:Instruction) -> None:
+        addr = self.address(instr)
+        val = self.builder.load(self.regs[instr.reg_b])
+        is_port = lambda port: self.builder.icmp_unsigned("==", addr, self.splat(8, port))
+
+        ram = self.builder.and_(self.mask, self.builder.icmp_unsigned("<", addr, self.splat(8, 240)))
+        if instr.reg_a == 0:
+            row = self.ram_row(instr.off & 0xff)
+            self.builder.store(self.builder.select(ram, val, self.builder.load(row, align=1)), row, align=1)
+        else:
+            # every lane stores unconditionally, lanes that don't store write back what was there
+            for lane in range(self.lanes):
+                lane_idx = ir.Constant(ir.IntType(32), lane)
+                ptr = self.ram_ptr(self.builder.extract_element(addr, lane_idx), lane)
+                self.builder.store(
+                    self.builder.select(
+                        self.builder.extract_element(ram, lane_idx),
+                        self.builder.extract_element(val, lane_idx),
+                        self.builder.load(ptr),
+                    ),
+                    ptr,
+                )
+
+        # the number display
+        self.masked_store(self.builder.select(is_port(250), val, self.builder.load(self.num)), self.num)
+        self.masked_store(self.builder.select(is_port(251), self.splat(8, 0), self.builder.load(self.num)), self.num)
+        self.masked_store(self.builder.select(is_port(252), self.splat(8, 0), self.builder.load(self.signedness)), self.signedness)
+        self.masked_store(self.builder.select(is_port(253), self.splat(8, 1), self.builder.load(self.signedness)), self.signedness)
+
+        # text is rare, the lanes writing it are handed to the callback one at a time
+        text = self.builder.and_(
+            self.mask,
+            self.builder.and_(
+                self.builder.icmp_unsigned(">=", addr, self.splat(8, 247)),
+                self.builder.icmp_unsigned("<=", addr, self.splat(8, 249)),
+            ),
+        )
+        with self.builder.if_then(self.any_lane(text), likely=False):
+            for lane in range(self.lanes):
+                lane_idx = ir.Constant(ir.IntType(32), lane)
+                with self.builder.if_then(self.builder.extract_element(text, lane_idx)):
+                    self.builder.call(self.io, [
+                        lane_idx,
+                        self.builder.zext(self.builder.extract_element(addr, lane_idx), ir.IntType(32)),
+                        self.builder.extract_element(val, lane_idx),
+                    ])
+
+        # storing to the input ports raises an error in the recompiled code
+        error = self.splat(1, 0)
+        for port in Recompiler.LOD_PORTS:
+            error = self.builder.or_(error, is_port(port))
+        self.set_status(Interpreter.ERROR, error)
+
+    def build(self) -> binding.ModuleRef:
+        llmod = binding.parse_assembly(str(self.mod))
+        llmod.verify()
+
+        if self.opt_level > 0:
+            tuning = binding.create_pipeline_tuning_options(speed_level=self.opt_level, size_level=0)
+            pass_builder = binding.create_pass_builder(self.target_machine, tuning)
+            pass_builder.getModulePassManager().run(llmod, pass_builder)
+
+        return llmod
+
+    def compile(self):
+        # jit compiles the module and returns the run_lanes function of it, which is only valid as long as the recompiler is alive
+        self.recompile()
+
+        self.engine = binding.create_mcjit_compiler(self.build(), self.target_machine)
+        self.engine.finalize_object()
+
+        self.run_lanes = ctypes.CFUNCTYPE(
+            ctypes.c_int64,
+            *[ctypes.c_void_p] * 12,
+            ctypes.CFUNCTYPE(None, ctypes.c_int32, ctypes.c_int32, ctypes.c_uint8),
+            ctypes.c_int64,
+        )(self.engine.get_function_address("run_lanes"))
+
+        return self.run_lanes
+
+class SimdMachines:
+    # the state of one group of lanes, in the layout run_lanes works on
+    def __init__(self, recompiler:SimdRecompiler, seeds, controllers) -> None:
+        # the recompiler owns the jitted code
+        self.recompiler = recompiler
+        lanes = self.lanes = recompiler.lanes
+
+        self.regs       = np.zeros((16, lanes),  dtype=np.uint8)
+        self.flags      = np.zeros((2, lanes),   dtype=np.uint8)
+        self.ram        = np.zeros((256, lanes), dtype=np.uint8)
+        self.stack      = np.zeros((16, lanes),  dtype=np.uint16)
+        self.sp         = np.zeros(lanes, dtype=np.uint8)
+        self.pc         = np.zeros(lanes, dtype=np.uint16)
+        self.status     = np.full(lanes, Interpreter.RUNNING, dtype=np.uint8)
+        self.steps      = np.zeros(lanes, dtype=np.uint64)
+        self.rng        = seed_state(seeds)
+        self.controller = np.asarray(controllers, dtype=np.uint8)
+        self.num        = np.zeros(lanes, dtype=np.uint8)
+        self.signedness = np.zeros(lanes, dtype=np.uint8)
+
+        self.char_buffer = [[] for _ in range(lanes)]
+        self.output      = [[] for _ in range(lanes)]
+
+        # kept alive for as long as the jitted code can call it
+        self.io = ctypes.CFUNCTYPE(None, ctypes.c_int32, ctypes.c_int32, ctypes.c_uint8)(self.store_text)
+
+    def store_text(self, lane, port, val) -> None:
+        # same as the text ports of the interpreter
+        match port:
+            case 247:
+                if len(self.char_buffer[lane]) < 32:
+                    self.char_buffer[lane].append(map_char(val))
+            case 248:
+                if self.char_buffer[lane]:
+                    self.output[lane].append("".join(self.char_buffer[lane]).ljust(32, "\0"))
+                    self.char_buffer[lane] = []
+            case 249:
+                self.char_buffer[lane] = []
+
+    def run(self, max_rounds:int|None=None, slice_rounds:int=1 << 20) -> None:
+        # the jitted code returns every slice_rounds rounds, so a long run can still be interrupted
+        rounds = 0
+        while (self.status == Interpreter.RUNNING).any() and (max_rounds is None or rounds < max_rounds):
+            budget = slice_rounds if max_rounds is None else min(slice_rounds, max_rounds - rounds)
+            rounds += self.recompiler.run_lanes(
+                *[array.ctypes.data for array in (
+                    self.regs, self.flags, self.ram, self.stack, self.sp, self.pc, self.status,
+                    self.steps, self.rng, self.controller, self.num, self.signedness,
+                )],
+                self.io,
+                budget,
+            )
+
+        for lane in range(self.lanes):
+            if self.status[lane] == Interpreter.ERROR:
+                self.output[lane].append("CRITICAL ERROR")
+            if self.status[lane] != Interpreter.RUNNING:
+                num = int(self.num[lane])
+                self.output[lane].append(str((num & 0x7f) * -(num >> 7)) if self.signedness[lane] else str(num))
+
+    def stdout(self, lane) -> str:
+        # what the recompiled headless program would have printed
+        return "".join(line + "\n" for line in self.output[lane])
+
+def run_sweep(in_file:str, seeds, controllers=None, lanes:int=8, max_rounds:int|None=None, **options) -> list[tuple[SimdMachines, int]]:
+    # runs one machine per seed, in groups of `lanes` machines, the last group is padded with halted lanes
+    seeds = np.asarray(seeds)
+    controllers = np.zeros(len(seeds), dtype=np.uint8) if controllers is None else np.asarray(controllers)
+
+    recompiler = SimdRecompiler(in_file, lanes, **options)
+    recompiler.compile()
+
+    groups = []
+    for start in range(0, len(seeds), lanes):
+        count = min(lanes, len(seeds) - start)
+        machines = SimdMachines(
+            recompiler,
+            np.resize(seeds[start:start+count], lanes),
+            np.resize(controllers[start:start+count], lanes),
+        )
+        machines.status[count:] = Interpreter.HALTED
+        machines.run(max_rounds)
+        groups.append((machines, count))
+
+    return groups
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    import time
+
+    parser = argparse.ArgumentParser(description="Runs many headless machines of one BatPU-2 program in SIMD lanes.")
+    parser.add_argument("in_file", type=str, help="Path to the input .mc file.")
+
+    parser.add_argument("--lanes", type=int, default=8, help="Number of machines every vector holds.")
+    parser.add_argument("--instances", type=int, default=None, help="Number of machines to run (default: one group of lanes).")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed of the first machine, the others use the following seeds.")
+    parser.add_argument("--controller", type=int, default=0, help="Controller state read from port 255.")
+    parser.add_argument("--max-rounds", type=int, default=None, help="Stop every group of lanes after this many blocks.")
+    parser.add_argument("--opt-level", type=int, default=3, choices=range(4), help="LLVM optimization level of the generated code.")
+    parser.add_argument("--emit-ll", type=str, default=None, metavar="PATH", help="Also write the generated LLVM IR to PATH.")
+    args = parser.parse_args()
+
+    instances = args.instances if args.instances is not None else args.lanes
+
+    if args.emit_ll is not None:
+        recompiler = SimdRecompiler(args.in_file, args.lanes, args.opt_level)
+        recompiler.recompile()
+        with open(args.emit_ll, "w") as output:
+            output.write(str(recompiler.build()))
+
+    start = time.perf_counter()
+    groups = run_sweep(
+        args.in_file,
+        np.arange(args.seed, args.seed + instances),
+        np.full(instances, args.controller),
+        args.lanes,
+        args.max_rounds,
+        opt_level=args.opt_level,
+    )
+    duration = time.perf_counter() - start
+
+    # the output of the first machine, in the same format as the recompiled program
+    sys.stdout.write(groups[0][0].stdout(0))
+
+    steps    = sum(int(machines.steps[:count].sum()) for machines, count in groups)
+    statuses = np.concatenate([machines.status[:count] for machines, count in groups])
+    print(
+        f"{instances} instances in {len(groups)} groups of {args.lanes} lanes, {steps} instructions in {duration:.3f}s "
+        f"({steps / duration / 1e6:.2f}M instructions/s), "
+        f"{int((statuses == Interpreter.HALTED).sum())} halted, {int((statuses == Interpreter.ERROR).sum())} errors, "
+        f"{int((statuses == Interpreter.RUNNING).sum())} still running",
+        file=sys.stderr,
+    )
@@ -5,7 +5,7 @@ New-Item -ItemType Directory -Path "programs"  -Force | Out-Null
 
 # compile the helper functions + raylib
 Set-Location helper_funcs/
-zig build -Doptimize=ReleaseFast -Dtarget=native --prefix-lib-dir "../../build/"
+zig build -Doptimize=ReleaseFast -Dtarget=native --prefix-lib-dir "../../build/" --prefix-exe-dir "../../build/"
 Set-Location ../
 
 # setup the virtual environment
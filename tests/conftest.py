@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the tests import the recompiler modules the same way they import each other
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "recompiler"))
@@ -0,0 +1,255 @@
+import ctypes
+import os
+import random
+import signal
+
+from interp import Interpreter, map_char, seed_state
+from isa import Instruction, read_mc_words
+from recomp import Recompiler
+
+OPS = {
+    "nop": Instruction.NOP, "hlt": Instruction.HLT, "add": Instruction.ADD, "sub": Instruction.SUB,
+    "nor": Instruction.NOR, "and": Instruction.AND, "xor": Instruction.XOR, "rsh": Instruction.RSH,
+    "ldi": Instruction.LDI, "adi": Instruction.ADI, "jmp": Instruction.JMP, "brh": Instruction.BRH,
+    "cal": Instruction.CAL, "ret": Instruction.RET, "lod": Instruction.LOD, "str": Instruction.STR,
+}
+CONDITIONS = {"eq": 0, "ne": 1, "ge": 2, "lt": 3}
+
+def assemble(source:str) -> list[int]:
+    # a minimal assembler for the programs of the tests: one instruction per line, ".name" lines are labels
+    lines = []
+    labels = {}
+    for line in source.splitlines():
+        line = line.split(";")[0].strip()
+        if not line:
+            continue
+        if line.startswith("."):
+            labels[line] = len(lines)
+            continue
+        lines.append(line.split())
+
+    def operand(text:str) -> int:
+        if text.startswith("r"):
+            return int(text[1:])
+        if text.startswith("."):
+            return labels[text]
+        if text in CONDITIONS:
+            return CONDITIONS[text]
+        return int(text, 0)
+
+    words = []
+    for name, *operands in lines:
+        op = OPS[name]
+        args = [operand(text) for text in operands]
+
+        word = op << 12
+        if op in (Instruction.ADD, Instruction.SUB, Instruction.NOR, Instruction.AND, Instruction.XOR):
+            word |= (args[0] << 8) | (args[1] << 4) | args[2]
+        elif op == Instruction.RSH:
+            word |= (args[0] << 8) | args[1]
+        elif op in (Instruction.LDI, Instruction.ADI):
+            word |= (args[0] << 8) | (args[1] & 0xff)
+        elif op in (Instruction.JMP, Instruction.CAL):
+            word |= args[0]
+        elif op == Instruction.BRH:
+            word |= (args[0] << 10) | args[1]
+        elif op in (Instruction.LOD, Instruction.STR):
+            word |= (args[0] << 8) | (args[1] << 4) | ((args[2] if len(args) > 2 else 0) & 0xf)
+        words.append(word)
+
+    return words
+
+def write_program(path, source:str) -> str:
+    with open(path, "w") as file:
+        file.writelines(f"{word:016b}\n" for word in assemble(source))
+    return str(path)
+
+def random_program(rng:random.Random, length:int) -> list[int]:
+    # random instructions, biased towards branches, calls and io ports so the control flow and port handling get exercised
+    words = []
+    for _ in range(length):
+        op = rng.choice([
+            Instruction.HLT, Instruction.ADD, Instruction.SUB, Instruction.NOR, Instruction.AND, Instruction.XOR,
+            Instruction.RSH, Instruction.LDI, Instruction.LDI, Instruction.ADI, Instruction.ADI, Instruction.JMP,
+            Instruction.BRH, Instruction.BRH, Instruction.CAL, Instruction.RET, Instruction.LOD, Instruction.LOD,
+            Instruction.STR, Instruction.STR,
+        ])
+
+        word = op << 12
+        if op in (Instruction.JMP, Instruction.BRH, Instruction.CAL):
+            word |= rng.randrange(length + 1)
+            if op == Instruction.BRH:
+                word |= rng.randrange(4) << 10
+        elif op in (Instruction.LDI, Instruction.ADI):
+            word |= (rng.randrange(16) << 8) | rng.choice([rng.randrange(256), 240 + rng.randrange(16), 255, 1])
+        elif op in (Instruction.LOD, Instruction.STR):
+            word |= (rng.randrange(4) << 8) | rng.randrange(0x100)
+        elif op == Instruction.RSH:
+            word |= rng.randrange(0x1000) & 0x0f0f
+        else:
+            word |= rng.randrange(0x1000)
+        words.append(word)
+
+    return words
+
+def run_interpreter(program:str, seed:int=1, max_steps:int=200_000, **options) -> Interpreter|None:
+    # a single machine, None if it doesn't halt in time or over- or underflows the call stack,
+    # which the recompiled code has no defined behaviour for
+    interp = Interpreter.from_file(program, 1, seeds=[seed], **options)
+    interp.run(max_steps)
+
+    if interp.status[0] == Interpreter.RUNNING:
+        return None
+    if interp.status[0] == Interpreter.ERROR:
+        words = read_mc_words(program)
+        pc = int(interp.pc[0]) - 1
+        if pc < len(words) and words[pc] >> 12 in (Instruction.CAL, Instruction.RET):
+            return None
+    return interp
+
+class MockHelpers:
+    # python versions of the headless helper functions, registered with llvm in place of the helper library,
+    # they collect the output of the program like the interpreter does and send it to out_fd when it exits
+    SIGNATURES = {
+        "init_headless":     (None,),
+        "deinit_headless":   (None,),
+        "raise_error":       (None,),
+        "push_char":         (None, ctypes.c_uint8),
+        "clear_char_buffer": (None,),
+        "flush_char_buffer": (None,),
+        "set_num":           (None, ctypes.c_uint8),
+        "set_signedness":    (None, ctypes.c_bool),
+        "get_random_num":    (ctypes.c_uint8,),
+        "get_controller_headless": (ctypes.c_uint8,),
+        "next_input_frame":  (None,),
+        "init_input_replay": (None, ctypes.c_char_p),
+        "init_headless_framebuffer":    (None, ctypes.c_char_p, ctypes.c_uint32),
+        "present_framebuffer_headless": (None, ctypes.POINTER(ctypes.c_uint32)),
+        "set_profile": (None, ctypes.c_char_p, ctypes.POINTER(ctypes.c_char_p), ctypes.POINTER(ctypes.c_uint64), ctypes.c_size_t),
+    }
+
+    def __init__(self, out_fd:int, seed:int=1) -> None:
+        self.out_fd = out_fd
+        self.rng = int(seed_state([seed])[0])
+        self.input_replay = None
+        self.input_frame = 0
+
+        self.char_buffer = []
+        self.output = []
+        self.num = 0
+        self.signedness = False
+        self.frames = 0
+        self.profile = None
+
+        # kept alive for as long as the jitted code can call them
+        self.funcs = {
+            name: ctypes.CFUNCTYPE(*signature)(getattr(self, name))
+            for name, signature in self.SIGNATURES.items()
+        }
+
+    def register(self) -> None:
+        from llvmlite import binding
+        for name, func in self.funcs.items():
+            binding.add_symbol(name, ctypes.cast(func, ctypes.c_void_p).value)
+
+    def init_headless(self) -> None:
+        pass
+
+    def deinit_headless(self) -> None:
+        if self.profile is not None:
+            path, keys, counts, length = self.profile
+            with open(path, "w") as file:
+                file.writelines(f"{keys[i].decode()} {counts[i]}\n" for i in range(length))
+
+        num = self.num
+        self.output.append(str((num & 0x7f) * -(num >> 7)) if self.signedness else str(num))
+        self.output.append(f"frames {self.frames}")
+        os.write(self.out_fd, "".join(line + "\n" for line in self.output).encode())
+        os._exit(0)
+
+    def raise_error(self) -> None:
+        self.output.append("CRITICAL ERROR")
+        self.deinit_headless()
+
+    def push_char(self, c) -> None:
+        if len(self.char_buffer) < 32:
+            self.char_buffer.append(map_char(c))
+
+    def clear_char_buffer(self) -> None:
+        self.char_buffer = []
+
+    def flush_char_buffer(self) -> None:
+        if self.char_buffer:
+            self.output.append("".join(self.char_buffer).ljust(32, "\0"))
+            self.char_buffer = []
+
+    def set_num(self, n) -> None:
+        self.num = n
+
+    def set_signedness(self, signed) -> None:
+        self.signedness = signed
+
+    def get_random_num(self) -> int:
+        # the generator of the interpreter
+        self.rng ^= (self.rng << 13) & 0xffffffff
+        self.rng ^= self.rng >> 17
+        self.rng ^= (self.rng << 5) & 0xffffffff
+        return self.rng & 0xff
+
+    def get_controller_headless(self) -> int:
+        # every button is released once the trace has ended
+        if self.input_replay is None or self.input_frame >= len(self.input_replay):
+            return 0
+        return self.input_replay[self.input_frame]
+
+    def next_input_frame(self) -> None:
+        self.input_frame += 1
+
+    def init_input_replay(self, path) -> None:
+        with open(path, "rb") as file:
+            self.input_replay = file.read()
+
+    def init_headless_framebuffer(self, path, slots) -> None:
+        pass
+
+    def present_framebuffer_headless(self, framebuffer) -> None:
+        self.frames += 1
+
+    def set_profile(self, path, keys, counts, length) -> None:
+        self.profile = (path.decode(), keys, counts, length)
+
+def run_recompiled(program:str, rng_seed:int=1, timeout:int=30, **options) -> str|None:
+    # jit compiles the headless program and runs it against MockHelpers in a forked child, as the helper functions
+    # exit the process, returns what it printed (in the format of interpreter_output) or None if it crashed or hung.
+    # rng_seed seeds the python get_random_num, options are those of the Recompiler
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            signal.alarm(timeout)
+
+            helpers = MockHelpers(write_fd, rng_seed)
+            helpers.register()
+
+            recompiler = Recompiler(program, headless=True, **options)
+            recompiler.recompile()
+            recompiler.run(None)
+            # main returned without exiting through the helper functions
+            helpers.deinit_headless()
+        finally:
+            os._exit(1)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd, "rb") as output:
+        data = output.read()
+    _, status = os.waitpid(pid, 0)
+
+    if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+        return None
+    return data.decode()
+
+def interpreter_output(interp:Interpreter) -> str:
+    # the headless helper functions don't announce that they deinitialize, even when emulating a screen
+    lines = [line for line in interp.output[0] if line != "DEINITIALIZING"]
+    return "".join(line + "\n" for line in lines) + f"frames {int(interp.frames[0])}\n"
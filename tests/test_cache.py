@@ -0,0 +1,52 @@
+import os
+
+import cache
+from cache import BuildCache
+from harness import write_program
+from recomp import Recompiler
+
+def test_key_covers_every_recompiler_module(tmp_path, monkeypatch):
+    program = write_program(tmp_path / "halt.mc", "hlt")
+    build_cache = BuildCache(str(tmp_path / "cache"))
+    key = build_cache.key(program, {}, [])
+
+    # an edit to the decoder, which isn't part of recomp.py
+    hash_file = cache.hash_file
+    monkeypatch.setattr(cache, "hash_file", lambda path: "edited" if os.path.basename(path) == "isa.py" else hash_file(path))
+    monkeypatch.setattr(cache, "source_hash", None)
+
+    assert build_cache.key(program, {}, []) != key
+
+def test_build_evicts_once(tmp_path, monkeypatch):
+    # evicting walks the whole cache, an incremental build puts two files for every region
+    program = write_program(tmp_path / "calls.mc", """
+        cal .sub
+        hlt
+    .sub
+        ret
+    """)
+    evictions = []
+    monkeypatch.setattr(BuildCache, "evict", lambda self: evictions.append(None))
+
+    Recompiler(program, str(tmp_path / "calls.a"), headless=True, emit="obj", incremental=str(tmp_path / "cache")).recompile()
+    assert len(evictions) == 1
+
+    build_cache = BuildCache(str(tmp_path / "cache"))
+    cache.cached_recompile(build_cache, program, str(tmp_path / "calls.ll"), {"headless": True})
+    assert len(evictions) == 2
+    # nothing new to evict for
+    cache.cached_recompile(build_cache, program, str(tmp_path / "calls.ll"), {"headless": True})
+    assert len(evictions) == 2
+
+def test_evict_drops_least_recently_used(tmp_path):
+    build_cache = BuildCache(str(tmp_path / "cache"), max_size=1000)
+    build_cache.put_data("aa", "out", bytes(600))
+    os.utime(build_cache.entry_dir("aa"), (0, 0))
+    build_cache.put_data("bb", "out", bytes(600))
+
+    # puts leave the cache over its size until the build evicts
+    assert build_cache.get("aa", "out") is not None
+    os.utime(build_cache.entry_dir("aa"), (0, 0))
+    build_cache.evict()
+    assert build_cache.get("aa", "out") is None
+    assert build_cache.get("bb", "out") is not None
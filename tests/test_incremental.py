@@ -0,0 +1,43 @@
+from harness import write_program
+from recomp import Recompiler
+
+# main and two subroutines, each of them a region of its own
+CALLS = """
+    ldi r1 3
+.loop
+    cal .twice
+    adi r1 -1
+    brh ne .loop
+    ldi r7 250
+    str r7 r9
+    hlt
+.twice
+    cal .add
+    cal .add
+    ret
+.add
+    add r9 r1 r9
+    ret
+"""
+
+def test_region_modules_have_the_target_layout(tmp_path, monkeypatch):
+    program = write_program(tmp_path / "calls.mc", CALLS)
+
+    layouts = []
+    build_llvm_module = Recompiler.build_llvm_module
+    def record_layout(self):
+        layouts.append(str(self.mod.data_layout))
+        return build_llvm_module(self)
+    monkeypatch.setattr(Recompiler, "build_llvm_module", record_layout)
+
+    recompiler = Recompiler(program, str(tmp_path / "calls.a"), headless=True, emit="obj", incremental=str(tmp_path / "cache"))
+    recompiler.recompile()
+
+    assert len(layouts) == 1 + len(recompiler.subroutines) == 3
+    assert layouts == [str(recompiler.target_machine.target_data)] * 3
+
+    # the second build reuses every region
+    recompiler = Recompiler(program, str(tmp_path / "calls.a"), headless=True, emit="obj", incremental=str(tmp_path / "cache"))
+    recompiler.recompile()
+    assert recompiler.reused_regions == 3
+    assert len(layouts) == 3
@@ -0,0 +1,258 @@
+import random
+
+import pytest
+
+from harness import interpreter_output, random_program, run_interpreter, run_recompiled, write_program
+
+# ram above 127 is out of reach of a sign extended 8 bit address, and ram that was never written reads 0
+HIGH_RAM = """
+    ldi r1 200
+    ldi r2 42
+    str r1 r2
+    ldi r3 130
+    ldi r4 17
+    str r3 r4 5
+    lod r1 r5
+    lod r3 r6 5
+    ldi r7 239
+    lod r7 r8
+    add r5 r6 r9
+    add r9 r8 r9
+    ldi r10 128
+    ldi r11 240
+.fill
+    str r10 r10
+    adi r10 1
+    sub r10 r11 r0
+    brh ne .fill
+    ldi r10 128
+.sum
+    lod r10 r12
+    add r9 r12 r9
+    adi r10 1
+    sub r10 r11 r0
+    brh ne .sum
+    ldi r13 250
+    str r13 r9
+    hlt
+"""
+
+# nested subroutines called from several places, with flags set in a subroutine and read after its return
+SUBROUTINES = """
+    ldi r1 5
+    ldi r9 0
+.loop
+    cal .square
+    brh lt .less
+    adi r9 3
+.less
+    cal .twice
+    adi r1 -1
+    brh ne .loop
+    ldi r7 250
+    str r7 r9
+    hlt
+.twice
+    cal .add
+    cal .add
+    ret
+.add
+    add r9 r1 r9
+    ret
+.square
+    ldi r2 0
+    add r1 r0 r3
+.step
+    add r2 r1 r2
+    adi r3 -1
+    brh ne .step
+    sub r2 r9 r0
+    ret
+"""
+
+# draws a diagonal, reads some of it back and ends every row with a screen update
+SCREEN = """
+    ldi r1 240
+    ldi r2 0
+    ldi r5 0
+    ldi r6 32
+.row
+    str r1 r2
+    str r1 r2 1
+    str r1 r0 2
+    adi r2 1
+    str r1 r2
+    lod r1 r3 4
+    add r5 r3 r5
+    str r1 r0 5
+    sub r2 r6 r0
+    brh ne .row
+    ldi r2 3
+    str r1 r2
+    str r1 r2 1
+    lod r1 r3 4
+    add r5 r3 r5
+    str r1 r0 3
+    lod r1 r3 4
+    add r5 r3 r5
+    ldi r7 250
+    str r7 r5
+    hlt
+"""
+
+# x * 10 through shifts and adds, with branches on the flags of the last add
+MULTIPLY = """
+    ldi r1 0
+    ldi r7 0
+.loop
+    add r1 r1 r2
+    add r2 r2 r3
+    add r3 r3 r3
+    add r3 r2 r4
+    brh lt .no_carry
+    adi r7 1
+.no_carry
+    xor r7 r4 r7
+    add r4 r4 r0
+    brh eq .zero
+    adi r7 3
+.zero
+    adi r1 1
+    brh ne .loop
+    ldi r6 250
+    str r6 r7
+    hlt
+"""
+
+# the doubling, move and compare idioms with branches on their flags, for every value of r1
+IDIOMS = """
+    ldi r1 0
+    ldi r9 0
+    ldi r5 100
+.loop
+    add r1 r0 r2
+    add r2 r2 r2
+    add r2 r2 r2
+    add r2 r2 r2
+    brh lt .no_carry
+    adi r9 1
+.no_carry
+    xor r9 r2 r9
+    sub r1 r0 r3
+    brh lt .borrow
+    adi r9 5
+.borrow
+    xor r1 r0 r4
+    brh eq .zero
+    adi r9 7
+.zero
+    sub r1 r5 r0
+    brh ge .big
+    adi r9 11
+.big
+    and r1 r5 r6
+    brh ne .bits
+    adi r9 13
+.bits
+    xor r1 r5 r0
+    brh eq .same
+    adi r9 17
+.same
+    add r1 r0 r10
+    adi r10 200
+    brh lt .small
+    adi r9 19
+.small
+    add r1 r9 r9
+    adi r1 37
+    brh ne .loop
+    ldi r7 250
+    str r7 r9
+    hlt
+"""
+
+# prints random numbers and the controller state
+INPUT = """
+    ldi r1 248
+    ldi r2 8
+.loop
+    lod r1 r3 6
+    xor r4 r3 r4
+    adi r2 -1
+    brh ne .loop
+    lod r1 r3 7
+    add r4 r3 r4
+    str r1 r4 2
+    hlt
+"""
+
+def check(program, interp_options=None, **options) -> None:
+    interp = run_interpreter(program, **(interp_options or {"headless": True}))
+    assert interp is not None
+    assert run_recompiled(program, **options) == interpreter_output(interp)
+
+@pytest.mark.parametrize("opt_level", range(4))
+def test_high_ram_addresses(tmp_path, opt_level):
+    check(write_program(tmp_path / "ram.mc", HIGH_RAM), opt_level=opt_level)
+
+@pytest.mark.parametrize("opt_level", [0, 3])
+def test_random_programs(tmp_path, opt_level):
+    # compares every random program that halts in the interpreter, across branches, calls, io ports and idioms
+    compared = 0
+    for i in range(60):
+        rng = random.Random(i)
+        program = str(tmp_path / f"random_{i}.mc")
+        with open(program, "w") as file:
+            file.writelines(f"{word:016b}\n" for word in random_program(rng, rng.randrange(5, 40)))
+
+        interp = run_interpreter(program, headless=True)
+        if interp is None:
+            continue
+
+        assert run_recompiled(program, opt_level=opt_level) == interpreter_output(interp), f"random program {i}"
+        compared += 1
+
+    assert compared >= 20
+
+@pytest.mark.parametrize("opt_level", range(4))
+def test_subroutines(tmp_path, opt_level):
+    check(write_program(tmp_path / "subroutines.mc", SUBROUTINES), opt_level=opt_level)
+
+def test_profile_round_trip(tmp_path):
+    program = write_program(tmp_path / "subroutines.mc", SUBROUTINES)
+    profile = tmp_path / "profile.txt"
+    expected = interpreter_output(run_interpreter(program, headless=True))
+
+    assert run_recompiled(program, opt_level=2, profile=str(profile)) == expected
+    assert profile.read_text().strip()
+    assert run_recompiled(program, opt_level=2, profile_use=str(profile)) == expected
+
+@pytest.mark.parametrize("opt_level", [0, 3])
+def test_framebuffer(tmp_path, opt_level):
+    # with a framebuffer the headless program emulates the screen like the interpreter with a screen does
+    program = write_program(tmp_path / "screen.mc", SCREEN)
+    check(program, {"headless": False}, opt_level=opt_level, framebuffer=str(tmp_path / "frames.bin"))
+
+@pytest.mark.parametrize("opt_level", range(4))
+def test_multiply_idiom(tmp_path, opt_level):
+    check(write_program(tmp_path / "multiply.mc", MULTIPLY), opt_level=opt_level)
+
+@pytest.mark.parametrize("opt_level", range(4))
+def test_idioms(tmp_path, opt_level):
+    check(write_program(tmp_path / "idioms.mc", IDIOMS), opt_level=opt_level)
+
+def test_replayed_input(tmp_path):
+    program = write_program(tmp_path / "input.mc", INPUT)
+    trace = tmp_path / "input.trace"
+    trace.write_bytes(bytes([0b10100000]))
+
+    interp = run_interpreter(program, headless=False, controller=0b10100000)
+    assert run_recompiled(program, opt_level=2, replay_input=str(trace)) == interpreter_output(interp)
+
+def test_seeded_random_numbers(tmp_path):
+    # the inline generator doesn't call get_random_num, whose python version would start from another seed
+    program = write_program(tmp_path / "input.mc", INPUT)
+    interp = run_interpreter(program, seed=7, headless=True)
+    seeded = run_recompiled(program, rng_seed=99, opt_level=2, seed=7)
+    assert seeded == interpreter_output(interp)
+    assert seeded != run_recompiled(program, rng_seed=99, opt_level=2)
@@ -0,0 +1,21 @@
+from llvmlite import binding
+
+from harness import write_program
+from recomp import Recompiler
+
+def test_llvm_is_initialized_once(tmp_path, monkeypatch):
+    # like the server, which initializes llvm before it handles any request
+    program = write_program(tmp_path / "halt.mc", "hlt")
+    calls = []
+    initialize_native_target = binding.initialize_native_target
+    def count_initialization():
+        calls.append(None)
+        initialize_native_target()
+    monkeypatch.setattr(binding, "initialize_native_target", count_initialization)
+    monkeypatch.setattr(Recompiler, "llvm_initialized", False)
+
+    Recompiler.init_llvm_binding()
+    for i in range(3):
+        Recompiler(program, str(tmp_path / f"halt_{i}.ll"), headless=True).recompile()
+
+    assert len(calls) == 1
@@ -0,0 +1,46 @@
+import numpy as np
+
+from harness import write_program
+from interp import Interpreter
+from simd import run_sweep
+
+# the lanes with an odd random number spin at a lower pc than the ones that keep working
+DIVERGENT = """
+    jmp .start
+.spin
+    jmp .spin
+.start
+    ldi r1 254
+    lod r1 r2
+    ldi r3 1
+    and r2 r3 r0
+    brh ne .spin
+    ldi r4 0
+    ldi r5 10
+.loop
+    add r4 r5 r4
+    adi r5 -1
+    brh ne .loop
+    ldi r6 250
+    str r6 r4
+    hlt
+"""
+
+def test_divergent_lanes_make_progress(tmp_path):
+    program = write_program(tmp_path / "divergent.mc", DIVERGENT)
+    seeds = np.arange(1, 17)
+
+    interp = Interpreter.from_file(program, len(seeds), seeds=seeds, headless=True)
+    interp.run(1000)
+    spinning = interp.status == Interpreter.RUNNING
+    assert spinning.any() and not spinning.all()
+
+    # far more rounds than the working lanes need, but the spinning lanes never stop
+    lanes = 8
+    for group, (machines, count) in enumerate(run_sweep(program, seeds, lanes=lanes, max_rounds=10_000)):
+        for lane in range(count):
+            i = group * lanes + lane
+            assert machines.status[lane] == interp.status[i]
+            if not spinning[i]:
+                assert machines.stdout(lane) == interp.stdout(i) == "55\n"
+                assert machines.steps[lane] == interp.steps[i]